@@ -1,6 +1,8 @@
-# auth_models.py — v1.1.2 (12/08/2025)
+# auth_models.py — v1.1.3 (16/10/2026)
+# - v1.1.3: índice funcional lower(trim(username)) para as buscas por username normalizado
+#   (tabelas novas via create_all; existentes via alembic: 20261016_users_lower_username).
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, inspect, text
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, Index, func, inspect, text
 from sqlalchemy.engine import Engine
 from models import Base
 from database import engine
@@ -18,6 +20,10 @@ class User(Base):
     email = Column(String(255), nullable=True)  # <— NOVO
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
 
+    __table_args__ = (
+        Index("ix_users_lower_username", func.lower(func.trim(username))),
+    )
+
     @property
     def is_admin(self) -> bool:
         return (self.role or "user").lower() == "admin"
@@ -0,0 +1,48 @@
+"""índice funcional lower(trim(username)) em users
+
+Revision ID: 20261016_users_lower_username
+Revises: 2f9dbfc324ad
+Create Date: 2026-10-16 12:00:00
+
+Buscas de login por username normalizado (auth_models.User, v1.1.3).
+Compat: SQLite e Postgres; idempotente (pula se a tabela não existir ou o índice já existir).
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "20261016_users_lower_username"
+down_revision = "2f9dbfc324ad"
+
+branch_labels = None
+depends_on = None
+
+INDEX_NAME = "ix_users_lower_username"
+
+
+def _has_table(insp, table):
+    try:
+        return insp.has_table(table)
+    except Exception:
+        return False
+
+
+def _has_index(insp, table, name):
+    try:
+        return any(ix.get("name") == name for ix in insp.get_indexes(table))
+    except Exception:
+        return False
+
+
+def upgrade():
+    insp = sa.inspect(op.get_bind())
+    if not _has_table(insp, "users") or _has_index(insp, "users", INDEX_NAME):
+        return
+    op.create_index(INDEX_NAME, "users", [sa.text("lower(trim(username))")], unique=False)
+
+
+def downgrade():
+    insp = sa.inspect(op.get_bind())
+    if _has_table(insp, "users") and _has_index(insp, "users", INDEX_NAME):
+        op.drop_index(INDEX_NAME, table_name="users")
@@ -1,5 +1,5 @@
 # scripts/fixup_lote_importado.py
-# Versão: 1.2 (2025-08-26)
+# Versão: 1.3 (2026-10-16)
 # Uso:
 #   python scripts/fixup_lote_importado.py --lote 38 [--dry-run] [--verbose] [--incluir-retorno-troca]
 #
@@ -13,16 +13,52 @@
 #    e (apenas para ENVIO/TROCA-ENVIO) valor_mensal e data_envio (nomes flexíveis).
 #  - v1.2: normaliza ativo em notação científica do Excel (ex. "3,50176E+14").
 #  - v1.2: opção para incluir RETORNO/TROCA no preenchimento de num/cli/período.
+#  - v1.3: normalize_ativo com caminho rápido via regex pré-compilada + aritmética inteira.
+#  - v1.3: estratégias (B)/(C)/(D) resolvidas numa única consulta (OR) por linha.
+#  - v1.3: campos do payload lidos uma vez por linha; apply_enrichment recebe valores prontos.
+#  - v1.3: parse_money detecta formato BR/US (antes "1234.56" virava 123456.0);
+#          um único ponto seguido de exatamente 3 dígitos ("1.234", "R$ 12.345") segue
+#          lido como milhar BR, como antes (1234.0) — "0.125" continua decimal.
+#  - v1.3: estratégia (A) resolvida no próprio SELECT do lote (JOIN payload->mov_hash / ContratoLog).
+#  - v1.3: checagens de unicidade só com Contrato.id; contrato carregado com load_only.
+#  - v1.3: cabeçalhos do lote pré-carregados num único IN (...) (sem SELECT por linha).
+#  - v1.3: parse_money/normalize_ativo trocam separadores com str.translate (uma passada).
+#  - v1.3: payload com "ativo_norm" não passa por normalize_ativo.
+#  - v1.3: SELECT de find_contrato_combined pré-montado com bindparams (reuso do SQL compilado).
+#  - v1.3: find_contrato_combined limitado: UNION ALL de num+ativo / num / ativo, LIMIT 2 cada;
+#          removidos os helpers find_contrato_via_* e find_cabecalho_por_num (sem uso).
+#  - v1.3: linhas descartadas pelo tipo não entram no pré-carregamento de cabeçalhos.
+#  - v1.3: nomes de colunas flexíveis resolvidos uma vez no import (ATTRS), sem hasattr por linha.
+#  - v1.3: commit parcial a cada 1000 contratos alterados (dry-run: só flush).
+#  - v1.3: usa orjson (se instalado) para o resumo e o JSONL de diagnósticos.
+#  - v1.3: SELECT do lote projeta só as chaves usadas do payload (não traz o JSON inteiro),
+#          cada uma com o tipo JSON original (número continua número, texto continua texto).
+#  - v1.3: diagnósticos gravados em streaming (runtime/fixup_lote_<id>_<timestamp>.jsonl);
+#          o resumo guarda só o total e uma amostra de até 100.
+#          MUDANÇA NO JSON DO RESUMO: "diagnostics" continua existindo, mas passa a ser a
+#          amostra (primeiros 100); a lista completa fica no .jsonl. Chaves novas:
+#          "diagnostics_total" (int), "diagnostics_path" (str ou null) e
+#          "diagnostics_truncated" (true quando a amostra não traz todos).
 #  - Gera resumo JSON em runtime/fixup_lote_<id>_<timestamp>.json
 
 import os
+import re
 import sys
 import json
 import argparse
 import datetime
+from collections import namedtuple
 from decimal import Decimal, InvalidOperation
 from typing import Any, Dict, Optional, Tuple, List
 
+try:
+    import orjson  # opcional: serialização JSON em C (bem mais rápida)
+except Exception:
+    orjson = None
+
+from sqlalchemy import bindparam, literal, select, union_all
+from sqlalchemy.orm import load_only
+
 # --- Ajuste do sys.path para achar seus módulos do app ---
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 if BASE_DIR not in sys.path:
@@ -33,6 +69,10 @@ from database import SessionLocal
 import models as M  # modelos
 
 RUNTIME_DIR = os.path.join(BASE_DIR, "runtime")
+# quantos diagnósticos ficam no resumo JSON (o restante só no .jsonl)
+DIAG_SAMPLE_SIZE = 100
+# contratos alterados por commit parcial (mantém o flush/UOW e os locks pequenos)
+COMMIT_EVERY = 1000
 
 # --------- Helpers de introspecção ---------
 def get_model(name: str):
@@ -68,14 +108,65 @@ VALOR_MENSAL_ATTRS = ("valor_mensal", "valor", "mensalidade")
 DATA_ENVIO_ATTRS   = ("data_envio", "dt_envio", "data_inicio", "inicio")
 ATIVO_ATTRS        = ("ativo", "codigo_ativo", "id_ativo")
 
+# Nomes efetivos resolvidos uma vez no import (em vez de hasattr/pick_attr por linha)
+ResolvedAttrs = namedtuple("ResolvedAttrs", "num cli valor data ativo periodo cab_num")
+
+def resolve_attrs() -> ResolvedAttrs:
+    if Contrato is None:
+        return ResolvedAttrs(None, None, None, None, None, None, None)
+    return ResolvedAttrs(
+        num=pick_attr(Contrato, *NUM_CONTRATO_ATTRS),
+        cli=pick_attr(Contrato, *COD_CLI_ATTRS),
+        valor=pick_attr(Contrato, *VALOR_MENSAL_ATTRS),
+        data=pick_attr(Contrato, *DATA_ENVIO_ATTRS),
+        ativo=pick_attr(Contrato, *ATIVO_ATTRS),
+        periodo=pick_attr(Contrato, "periodo_contratual"),
+        cab_num=pick_attr(ContratoCab, *NUM_CONTRATO_ATTRS) if ContratoCab else None,
+    )
+
+ATTRS = resolve_attrs()
+
 # --------- Normalizações ---------
+# Ativo "limpo" (só dígitos) e notação científica do Excel (ex. "3,50176E+14")
+_PLAIN_RE = re.compile(r'^\s*([+-]?\d+)\s*$')
+_SCI_RE = re.compile(r'^\s*([+-]?)(\d+)(?:[.,](\d+))?[Ee]([+-]?\d+)\s*$')
+# Tudo que não é dígito/separador/sinal (ex. "R$", espaços)
+_MONEY_RE = re.compile(r'[^\d,.-]')
+# "1.234" / "-12.345": ponto único + 3 dígitos = milhar BR (parte inteira sem zero à esquerda)
+_BR_MILHAR_RE = re.compile(r'-?[1-9]\d{0,2}\.\d{3}')
+# Trocas de separador numa única passada (str.translate)
+_BR_MONEY_TBL = str.maketrans({".": None, ",": "."})
+_ATIVO_TBL = str.maketrans({",": "."})
+# Decimal (contexto padrão) não passa de 28 dígitos; acima disso cai no fallback
+_MAX_ATIVO_DIGITS = 28
+
 def parse_money(val: Any) -> Optional[float]:
+    """Converte valores BR ("1.234,56", "1.234") ou US ("1,234.56" / "1234.56") para float.
+    Ambíguo ("1.234": ponto único + 3 dígitos) é lido como milhar BR.
+    Notação científica ("1e5", "1,5E+3") vai direto para float()."""
+    if val is None:
+        return None
+    if isinstance(val, (int, float)):
+        return float(val)
     try:
-        if val is None or val == "":
+        s = str(val)
+        # notação científica ("1e5", "1.5E+3"): a limpeza abaixo descartaria o "e"
+        if "e" in s or "E" in s:
+            return float(s.strip().replace(",", "."))
+        s = _MONEY_RE.sub("", s)
+        if not s:
             return None
-        if isinstance(val, (int, float)):
-            return float(val)
-        s = str(val).strip().replace(".", "").replace(",", ".")
+        last_comma = s.rfind(",")
+        last_dot = s.rfind(".")
+        if last_comma > last_dot:
+            # BR: vírgula é o separador decimal
+            s = s.translate(_BR_MONEY_TBL)
+        elif last_comma != -1:
+            # US: vírgula é separador de milhar
+            s = s.replace(",", "")
+        elif s.count(".") > 1 or _BR_MILHAR_RE.fullmatch(s):
+            # "1.234.567" / "1.234": pontos só como milhar (dado de origem BR)
+            s = s.replace(".", "")
         return float(s)
     except Exception:
         return None
@@ -93,7 +184,37 @@ def normalize_ativo(raw: Optional[str]) -> Optional[str]:
     """Normaliza ativos, inclusive valores vindos como notação científica do Excel."""
     if raw is None:
         return None
-    s = str(raw).strip()
+    if isinstance(raw, int):
+        return str(raw)
+
+    s = raw if isinstance(raw, str) else str(raw)
+
+    # caminho rápido: só dígitos (mantém zeros à esquerda)
+    m = _PLAIN_RE.match(s)
+    if m:
+        return m.group(1)
+
+    # caminho rápido: notação científica resolvida com inteiros (sem Decimal)
+    m = _SCI_RE.match(s)
+    if m:
+        frac = m.group(3) or ""
+        shift = int(m.group(4)) - len(frac)
+        mantissa = m.group(2) + frac
+        # expoente muito negativo (ex. "1E-10000000") faria 10 ** -shift enorme:
+        # fora da faixa, segue pelo Decimal
+        if shift >= -(_MAX_ATIVO_DIGITS + 1) and len(mantissa) + shift <= _MAX_ATIVO_DIGITS:
+            n = int(mantissa)
+            if shift >= 0:
+                n *= 10 ** shift
+            else:
+                # arredondamento half-even, igual ao Decimal.quantize
+                div = 10 ** -shift
+                n, r = divmod(n, div)
+                if 2 * r > div or (2 * r == div and n % 2):
+                    n += 1
+            return str(n)
+
+    s = s.strip()
 
     # já está 'limpo'?
     if "E" not in s.upper():
@@ -101,7 +222,7 @@ def normalize_ativo(raw: Optional[str]) -> Optional[str]:
         return s
 
     # troca vírgula por ponto para Decimal
-    s2 = s.replace(",", ".")
+    s2 = s.translate(_ATIVO_TBL)
     try:
         # tenta converter e formatar sem expoente
         d = Decimal(s2)
@@ -140,84 +261,120 @@ def safe_get_payload_field(payload: dict, *names) -> Optional[Any]:
     return None
 
 # --------- Resolvedores ---------
-def find_contrato_via_log(db, mov_hash: str) -> Optional[Any]:
-    if not ContratoLog:
-        return None
-    log = db.query(ContratoLog).filter(getattr(ContratoLog, "mov_hash") == mov_hash).first()
-    if not log:
-        return None
-    contrato_id = getattr(log, "contrato_id", None)
-    if not contrato_id:
-        return None
-    try:
-        c = db.get(Contrato, contrato_id)
-    except Exception:
-        c = db.query(Contrato).get(contrato_id)
-    return c
+def enrich_load_options() -> list:
+    """load_only com as colunas que apply_enrichment lê/escreve (Contrato é largo)."""
+    if Contrato is None:
+        return []
+    names = (ATTRS.num, ATTRS.cli, ATTRS.valor, ATTRS.data, ATTRS.periodo)
+    cols = [getattr(Contrato, n) for n in names if n]
+    return [load_only(*cols)] if cols else []
 
-def find_contrato_via_num_ativo(db, num: str, ativo: str) -> Optional[Any]:
-    num_attr = pick_attr(Contrato, *NUM_CONTRATO_ATTRS)
-    ativo_attr = pick_attr(Contrato, *ATIVO_ATTRS)
-    if not num_attr or not ativo_attr:
-        return None
-    results = db.query(Contrato).filter(
-        getattr(Contrato, num_attr) == num,
-        getattr(Contrato, ativo_attr) == ativo
-    ).all()
-    if len(results) == 1:
-        return results[0]
-    return None
+ENRICH_LOAD_OPTIONS = enrich_load_options()
 
-def find_contrato_via_num(db, num: str) -> Optional[Any]:
-    num_attr = pick_attr(Contrato, *NUM_CONTRATO_ATTRS)
-    if not num_attr:
-        return None
-    results = db.query(Contrato).filter(getattr(Contrato, num_attr) == num).all()
-    if len(results) == 1:
-        return results[0]
-    return None
+def get_contrato_enrich(db, contrato_id) -> Optional[Any]:
+    return db.get(Contrato, contrato_id, options=ENRICH_LOAD_OPTIONS)
 
-def find_contrato_via_ativo(db, ativo: str) -> Optional[Any]:
-    ativo_attr = pick_attr(Contrato, *ATIVO_ATTRS)
-    if not ativo_attr:
-        return None
-    results = db.query(Contrato).filter(getattr(Contrato, ativo_attr) == ativo).all()
-    if len(results) == 1:
-        return results[0]
-    return None
+def build_combined_stmts() -> Dict[Tuple[bool, bool], Any]:
+    """SELECTs de find_contrato_combined montados uma vez, com bindparams.
 
-def find_cabecalho_por_num(db, num: str) -> Optional[Any]:
-    if not ContratoCab:
-        return None
-    cab_num_attr = pick_attr(ContratoCab, *NUM_CONTRATO_ATTRS)
-    if not cab_num_attr:
-        return None
-    return db.query(ContratoCab).filter(getattr(ContratoCab, cab_num_attr) == num).first()
+    Chave: (tem_num, tem_ativo). Com os dois, é um UNION ALL dos predicados
+    num+ativo, num e ativo, cada um com LIMIT 2 (basta saber se há 0, 1 ou
+    mais de 1) e marcado por "k". O SQL compilado fica no cache do SQLAlchemy
+    e cada linha só troca os parâmetros.
+    """
+    if Contrato is None:
+        return {}
+    num_attr, ativo_attr = ATTRS.num, ATTRS.ativo
+    num_col = getattr(Contrato, num_attr) if num_attr else None
+    ativo_col = getattr(Contrato, ativo_attr) if ativo_attr else None
+
+    def ramo(k: int, *conds):
+        # subquery: LIMIT dentro de UNION ALL exige parênteses (SQLite não aceita)
+        sub = select(Contrato.id, literal(k).label("k")).where(*conds).limit(2).subquery()
+        return select(sub.c.id, sub.c.k)
+
+    stmts: Dict[Tuple[bool, bool], Any] = {}
+    if num_col is not None and ativo_col is not None:
+        stmts[(True, True)] = union_all(
+            ramo(0, num_col == bindparam("n"), ativo_col == bindparam("a")),
+            ramo(1, num_col == bindparam("n")),
+            ramo(2, ativo_col == bindparam("a")),
+        )
+    if num_col is not None:
+        stmts[(True, False)] = ramo(1, num_col == bindparam("n"))
+    if ativo_col is not None:
+        stmts[(False, True)] = ramo(2, ativo_col == bindparam("a"))
+    return stmts
+
+_STMTS_COMBINED = build_combined_stmts()
+_RESOLUCOES = ("via_num_ativo", "via_num", "via_ativo")
+
+def find_contrato_combined(db, num: Optional[str], ativo: Optional[str]) -> Tuple[Optional[Any], Optional[str]]:
+    """Estratégias (B), (C) e (D) numa única consulta.
+
+    Traz no máximo 2 ids por predicado (num+ativo, num, ativo) e decide no
+    Python, nessa ordem de prioridade: vence o primeiro com match único.
+    Retorna (contrato, resolucao) ou (None, None).
+    """
+    tem_num = bool(num) and ((True, False) in _STMTS_COMBINED)
+    tem_ativo = bool(ativo) and ((False, True) in _STMTS_COMBINED)
+    stmt = _STMTS_COMBINED.get((tem_num, tem_ativo))
+    if stmt is None:
+        return None, None
+
+    params = {}
+    if tem_num:
+        params["n"] = num
+    if tem_ativo:
+        params["a"] = ativo
+
+    ids: List[List[Any]] = [[], [], []]
+    for cid, k in db.execute(stmt, params).all():
+        ids[k].append(cid)
+    for k, resolucao in enumerate(_RESOLUCOES):
+        if len(ids[k]) == 1:
+            return get_contrato_enrich(db, ids[k][0]), resolucao
+    return None, None
+
+def prefetch_cabecalhos_por_num(db, nums, chunk: int = 1000) -> Dict[str, Any]:
+    """Carrega de uma vez os cabeçalhos dos números informados: {numero: cab}."""
+    out: Dict[str, Any] = {}
+    cab_num_attr = ATTRS.cab_num
+    if not ContratoCab or not cab_num_attr:
+        return out
+    num_col = getattr(ContratoCab, cab_num_attr)
+    nums = list(nums)
+    for i in range(0, len(nums), chunk):
+        for cab in db.query(ContratoCab).filter(num_col.in_(nums[i:i + chunk])).order_by(ContratoCab.id):
+            out.setdefault(getattr(cab, cab_num_attr), cab)
+    return out
 
 # --------- Atualização de um contrato com dados do payload ---------
-def apply_enrichment(contrato, cab, payload, permitir_valor_data: bool) -> Dict[str, int]:
-    """Aplica preenchimentos se faltando. Retorna contadores alterados."""
+def apply_enrichment(contrato, cab, num_payload, cli_payload, val_raw, data_raw,
+                     permitir_valor_data: bool) -> Dict[str, int]:
+    """Aplica preenchimentos se faltando. Retorna contadores alterados.
+
+    Recebe os campos do payload já extraídos (uma leitura por linha em fixup_lote).
+    """
     changed = {"num": 0, "cli": 0, "periodo": 0, "valor": 0, "data": 0}
 
     # numero do contrato
-    num_payload = safe_get_payload_field(payload, "contrato_num_norm", "contrato_num")
-    num_attr = pick_attr(contrato, *NUM_CONTRATO_ATTRS)
+    num_attr = ATTRS.num
     if num_attr and num_payload and not getattr(contrato, num_attr, None):
         setattr(contrato, num_attr, str(num_payload))
         changed["num"] += 1
 
     # cod_cli (nomes flexíveis)
-    cli_payload = safe_get_payload_field(payload, "cod_cli_norm", "cod_cli")
-    cli_attr = pick_attr(contrato, *COD_CLI_ATTRS)
+    cli_attr = ATTRS.cli
     if cli_attr and cli_payload and not getattr(contrato, cli_attr, None):
         setattr(contrato, cli_attr, str(cli_payload))
         changed["cli"] += 1
 
     # valor_mensal (só quando permitido)
     if permitir_valor_data:
-        val_attr = pick_attr(contrato, *VALOR_MENSAL_ATTRS)
+        val_attr = ATTRS.valor
         if val_attr:
-            val_payload = parse_money(safe_get_payload_field(payload, "valor_mensal", "valor"))
+            val_payload = parse_money(val_raw)
             atual = getattr(contrato, val_attr, None)
             atual_f = 0.0
             try:
@@ -230,19 +387,19 @@ def apply_enrichment(contrato, cab, payload, permitir_valor_data: bool) -> Dict[
                 changed["valor"] += 1
 
         # data_envio (nomes flexíveis)
-        data_attr = pick_attr(contrato, *DATA_ENVIO_ATTRS)
+        data_attr = ATTRS.data
         if data_attr:
-            dt = to_date_iso(safe_get_payload_field(payload, "data_mov_iso"))
+            dt = to_date_iso(data_raw)
             if dt and not getattr(contrato, data_attr, None):
                 setattr(contrato, data_attr, dt)
                 changed["data"] += 1
 
     # periodo_contratual (via cabeçalho)
-    if hasattr(contrato, "periodo_contratual"):
+    if ATTRS.periodo:
         per = None
         if cab:
             per = getattr(cab, "prazo_contratual", None) or getattr(cab, "periodo_contratual", None)
-        if per and not getattr(contrato, "periodo_contratual", None):
+        if per and not contrato.periodo_contratual:
             try:
                 contrato.periodo_contratual = int(per)
                 changed["periodo"] += 1
@@ -251,108 +408,239 @@ def apply_enrichment(contrato, cab, payload, permitir_valor_data: bool) -> Dict[
 
     return changed
 
+# Chaves do payload que o fixup realmente lê (projetadas no SQL, sem trazer o JSON inteiro)
+PAYLOAD_KEYS = (
+    "mov_hash", "tp_norm", "tp_transacao",
+    "contrato_num_norm", "contrato_num", "ativo_norm", "ativo",
+    "cod_cli_norm", "cod_cli", "valor_mensal", "valor", "data_mov_iso",
+)
+
+def payload_columns() -> list:
+    # payload[k] (sem .as_string()): o valor volta desserializado com o tipo do JSON,
+    # então ativo/valor numéricos chegam como int/float aos caminhos rápidos
+    return [MovimentacaoItem.payload[k].label(k) for k in PAYLOAD_KEYS]
+
+def fetch_itens_com_contrato_via_log(db, lote_id: int) -> List[Tuple[Any, Optional[Any]]]:
+    """Itens do lote já cruzados com o Contrato da estratégia (A), num único SELECT.
+
+    MovimentacaoItem.payload->mov_hash JOIN ContratoLog.mov_hash JOIN Contrato.
+    Cada item vem como linha (id, linha_idx, <PAYLOAD_KEYS>) — só os campos usados,
+    não o JSON completo. Retorna [(linha, contrato_ou_None)], um par por item (se
+    houver mais de um log com o mesmo hash, vale o primeiro que aponta para um contrato).
+    """
+    lote_col = MovimentacaoItem.lote_id
+    item_cols = [MovimentacaoItem.id, MovimentacaoItem.linha_idx, *payload_columns()]
+    if not (ContratoLog and hasattr(ContratoLog, "mov_hash") and hasattr(ContratoLog, "contrato_id")):
+        return [(row, None) for row in db.query(*item_cols).filter(lote_col == lote_id).all()]
+
+    log_hash_col = ContratoLog.mov_hash
+    log_contrato_col = ContratoLog.contrato_id
+    n_cols = len(item_cols)
+    q = (
+        db.query(*item_cols, Contrato)
+        .options(*ENRICH_LOAD_OPTIONS)
+        .outerjoin(ContratoLog, log_hash_col == MovimentacaoItem.payload["mov_hash"].as_string())
+        .outerjoin(Contrato, Contrato.id == log_contrato_col)
+        .filter(lote_col == lote_id)
+    )
+    por_item: Dict[Any, Tuple[Any, Optional[Any]]] = {}
+    for row in q:
+        contrato = row[n_cols]
+        atual = por_item.get(row.id)
+        if atual is None or atual[1] is None:
+            por_item[row.id] = (row, contrato)
+    return list(por_item.values())
+
+def payload_tp(payload: dict) -> str:
+    return str(payload.get("tp_norm") or payload.get("tp_transacao") or "").upper()
+
+def tp_elegivel(tp: str, incluir_retorno_troca: bool) -> bool:
+    """Mesmo filtro do loop de fixup_lote: ENVIO/TROCA-ENVIO/vazio sempre; RETORNO/TROCA só com a flag."""
+    if tp in ("ENVIO", "TROCA-ENVIO", ""):
+        return True
+    return tp in ("RETORNO", "TROCA") and incluir_retorno_troca
+
+# --------- Diagnósticos ---------
+def json_line(d: Dict[str, Any]) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(d, option=orjson.OPT_NON_STR_KEYS) + b"\n"
+    return (json.dumps(d, ensure_ascii=False) + "\n").encode("utf-8")
+
+def dump_json(obj: Any, path: str) -> None:
+    """Grava JSON indentado; usa orjson quando instalado."""
+    if orjson is not None:
+        with open(path, "wb") as f:
+            f.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+    else:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(obj, f, ensure_ascii=False, indent=2)
+
+class DiagnosticsSink:
+    """Grava diagnósticos em JSONL à medida que surgem.
+
+    Em memória ficam só o total e uma amostra; o arquivo só é criado se houver
+    ao menos um diagnóstico.
+    """
+
+    def __init__(self, path: str, sample_size: int = DIAG_SAMPLE_SIZE):
+        self.path = path
+        self.sample_size = sample_size
+        self.total = 0
+        self.sample: List[Dict[str, Any]] = []
+        self._fh = None
+
+    def add(self, d: Dict[str, Any]) -> None:
+        if self._fh is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._fh = open(self.path, "wb")
+        self._fh.write(json_line(d))
+        self.total += 1
+        if len(self.sample) < self.sample_size:
+            self.sample.append(d)
+
+    def close(self) -> None:
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
 # --------- Executor principal ---------
-def fixup_lote(db, lote_id: int, incluir_retorno_troca: bool, verbose: bool = False) -> Dict[str, Any]:
+def fixup_lote(db, lote_id: int, incluir_retorno_troca: bool, verbose: bool = False,
+               diag_path: Optional[str] = None, dry_run: bool = False,
+               commit_every: int = COMMIT_EVERY) -> Dict[str, Any]:
+    """Enriquece os contratos do lote.
+
+    Grava em blocos de `commit_every` contratos alterados (commit parcial); em
+    dry-run só faz flush nesses pontos e o chamador desfaz tudo com rollback.
+    """
     ensure_models()
 
-    itens = db.query(MovimentacaoItem).filter(getattr(MovimentacaoItem, "lote_id") == lote_id).all()
+    itens = fetch_itens_com_contrato_via_log(db, lote_id)
     if not itens:
         return {"lote_id": lote_id, "contratos_atualizados": 0, "msg": "Nenhum item no lote."}
 
+    # Cabeçalhos (para período) de todos os números do lote num único IN (...)
+    # (só linhas com tipo elegível: as demais são descartadas no loop antes de qualquer parse)
+    nums_lote = set()
+    for it, _ in itens:
+        p = it._mapping
+        if not tp_elegivel(payload_tp(p), incluir_retorno_troca):
+            continue
+        n = p.get("contrato_num_norm") or p.get("contrato_num")
+        if n is not None:
+            nums_lote.add(str(n))
+    cabs_por_num = prefetch_cabecalhos_por_num(db, nums_lote)
+
     total = 0
     updated = 0
     set_num = set_cli = set_periodo = set_valor = set_data = 0
-    diagnostics: List[Dict[str, Any]] = []
-
-    for it in itens:
-        total += 1
-        payload = getattr(it, "payload", {}) or {}
-        mov_hash = payload.get("mov_hash")
-        tp = (payload.get("tp_norm") or payload.get("tp_transacao") or "").upper()
-
-        # Tipos que podem preencher valor/data
-        permitir_valor_data = tp in ("ENVIO", "TROCA-ENVIO")
-        # Incluir num/cli/período também para RETORNO/TROCA se a flag estiver ligada
-        if tp not in ("ENVIO", "TROCA-ENVIO", "RETORNO", "TROCA") and tp != "":
-            # tipos estranhos — registra e segue
-            diagnostics.append({"linha_idx": getattr(it, "linha_idx", None),
-                                "motivo": "ignorado_por_tipo_desconhecido", "tp": tp})
-            continue
-        if tp in ("RETORNO", "TROCA") and not incluir_retorno_troca:
-            diagnostics.append({"linha_idx": getattr(it, "linha_idx", None),
-                                "motivo": "ignorado_por_tipo", "tp": tp})
-            continue
 
-        # Dados do payload
-        num_raw = safe_get_payload_field(payload, "contrato_num_norm", "contrato_num")
-        ativo_raw = safe_get_payload_field(payload, "ativo_norm", "ativo")
-        ativo = normalize_ativo(ativo_raw) if ativo_raw else None
-        num = str(num_raw) if num_raw is not None else None
-
-        contrato_ref = None
-
-        # (A) via log
-        if mov_hash and ContratoLog:
-            contrato_ref = find_contrato_via_log(db, mov_hash)
-            if contrato_ref and verbose:
-                diagnostics.append({"linha_idx": getattr(it, "linha_idx", None),
-                                    "resolucao": "via_log",
-                                    "contrato_id": getattr(contrato_ref, "id", None)})
-
-        # (B) via numero + ativo
-        if not contrato_ref and num and ativo:
-            contrato_ref = find_contrato_via_num_ativo(db, num, ativo)
-            if contrato_ref and verbose:
-                diagnostics.append({"linha_idx": getattr(it, "linha_idx", None),
-                                    "resolucao": "via_num_ativo",
-                                    "contrato_id": getattr(contrato_ref, "id", None)})
-
-        # (C) via numero
-        if not contrato_ref and num:
-            contrato_ref = find_contrato_via_num(db, num)
-            if contrato_ref and verbose:
-                diagnostics.append({"linha_idx": getattr(it, "linha_idx", None),
-                                    "resolucao": "via_num",
-                                    "contrato_id": getattr(contrato_ref, "id", None)})
-
-        # (D) via ativo
-        if not contrato_ref and ativo:
-            contrato_ref = find_contrato_via_ativo(db, ativo)
-            if contrato_ref and verbose:
-                diagnostics.append({"linha_idx": getattr(it, "linha_idx", None),
-                                    "resolucao": "via_ativo",
-                                    "contrato_id": getattr(contrato_ref, "id", None)})
-
-        if not contrato_ref:
-            diagnostics.append({
-                "linha_idx": getattr(it, "linha_idx", None),
-                "tp": tp,
-                "contrato_num_payload": num_raw,
-                "ativo_payload": ativo_raw,
-                "ativo_norm": ativo,
-                "tem_log_model": bool(ContratoLog),
-                "mov_hash": mov_hash,
-                "motivo": "nao_localizado"
-            })
-            continue
+    if diag_path is None:
+        ts = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        diag_path = os.path.join(RUNTIME_DIR, f"fixup_lote_{lote_id}_{ts}.jsonl")
+    diag = DiagnosticsSink(diag_path)
+    pending_updates = 0
+    # os commits parciais não devem expirar os itens/cabeçalhos já carregados
+    expire_on_commit = db.expire_on_commit
+    db.expire_on_commit = False
 
-        # Cabeçalho (para período)
-        cab = find_cabecalho_por_num(db, num) if num else None
-
-        # Aplica enriquecimento
-        changed = apply_enrichment(contrato_ref, cab, payload, permitir_valor_data)
-        if any(changed.values()):
-            updated += 1
-            set_num     += changed["num"]
-            set_cli     += changed["cli"]
-            set_periodo += changed["periodo"]
-            set_valor   += changed["valor"]
-            set_data    += changed["data"]
-        else:
-            if verbose:
-                diagnostics.append({"linha_idx": getattr(it, "linha_idx", None),
-                                    "contrato_id": getattr(contrato_ref, "id", None),
-                                    "motivo": "sem_alteracoes"})
+    try:
+        for it, contrato_via_log in itens:
+            total += 1
+            payload = it._mapping  # campos do payload já projetados no SELECT
+            mov_hash = payload.get("mov_hash")
+            tp = payload_tp(payload)
+
+            # Tipos que podem preencher valor/data
+            permitir_valor_data = tp in ("ENVIO", "TROCA-ENVIO")
+            # Incluir num/cli/período também para RETORNO/TROCA se a flag estiver ligada
+            if tp not in ("ENVIO", "TROCA-ENVIO", "RETORNO", "TROCA") and tp != "":
+                # tipos estranhos — registra e segue
+                diag.add({"linha_idx": getattr(it, "linha_idx", None),
+                          "motivo": "ignorado_por_tipo_desconhecido", "tp": tp})
+                continue
+            if tp in ("RETORNO", "TROCA") and not incluir_retorno_troca:
+                diag.add({"linha_idx": getattr(it, "linha_idx", None),
+                          "motivo": "ignorado_por_tipo", "tp": tp})
+                continue
+
+            # Dados do payload
+            num_raw = payload.get("contrato_num_norm") or payload.get("contrato_num")
+            cli_raw = payload.get("cod_cli_norm") or payload.get("cod_cli")
+            val_raw = payload.get("valor_mensal")
+            if val_raw is None or val_raw == "":
+                val_raw = payload.get("valor")
+            data_raw = payload.get("data_mov_iso")
+            ativo_raw = payload.get("ativo_norm")
+            if ativo_raw:
+                # já normalizado no preview/importação: usa como está
+                ativo = str(ativo_raw)
+            else:
+                ativo_raw = payload.get("ativo")
+                if isinstance(ativo_raw, int):
+                    ativo = str(ativo_raw)
+                else:
+                    ativo = normalize_ativo(ativo_raw) if ativo_raw else None
+            num = str(num_raw) if num_raw is not None else None
+
+            contrato_ref = None
+
+            # (A) via log (já resolvido no JOIN de fetch_itens_com_contrato_via_log)
+            if mov_hash and contrato_via_log is not None:
+                contrato_ref = contrato_via_log
+                if verbose:
+                    diag.add({"linha_idx": getattr(it, "linha_idx", None),
+                              "resolucao": "via_log",
+                              "contrato_id": getattr(contrato_ref, "id", None)})
+
+            # (B) num+ativo, (C) num, (D) ativo — uma única consulta
+            if not contrato_ref and (num or ativo):
+                contrato_ref, resolucao = find_contrato_combined(db, num, ativo)
+                if contrato_ref and verbose:
+                    diag.add({"linha_idx": getattr(it, "linha_idx", None),
+                              "resolucao": resolucao,
+                              "contrato_id": getattr(contrato_ref, "id", None)})
+
+            if not contrato_ref:
+                diag.add({
+                    "linha_idx": getattr(it, "linha_idx", None),
+                    "tp": tp,
+                    "contrato_num_payload": num_raw,
+                    "ativo_payload": ativo_raw,
+                    "ativo_norm": ativo,
+                    "tem_log_model": bool(ContratoLog),
+                    "mov_hash": mov_hash,
+                    "motivo": "nao_localizado"
+                })
+                continue
+
+            # Cabeçalho (para período)
+            cab = cabs_por_num.get(num) if num else None
+
+            # Aplica enriquecimento
+            changed = apply_enrichment(contrato_ref, cab, num_raw, cli_raw, val_raw, data_raw,
+                                       permitir_valor_data)
+            if any(changed.values()):
+                updated += 1
+                set_num     += changed["num"]
+                set_cli     += changed["cli"]
+                set_periodo += changed["periodo"]
+                set_valor   += changed["valor"]
+                set_data    += changed["data"]
+                pending_updates += 1
+                if pending_updates >= commit_every:
+                    if dry_run:
+                        db.flush()
+                    else:
+                        db.commit()
+                    pending_updates = 0
+            else:
+                if verbose:
+                    diag.add({"linha_idx": getattr(it, "linha_idx", None),
+                              "contrato_id": getattr(contrato_ref, "id", None),
+                              "motivo": "sem_alteracoes"})
+    finally:
+        diag.close()
+        db.expire_on_commit = expire_on_commit
 
     return {
         "lote_id": lote_id,
@@ -363,7 +651,10 @@ def fixup_lote(db, lote_id: int, incluir_retorno_troca: bool, verbose: bool = Fa
         "set_periodo": set_periodo,
         "set_valor": set_valor,
         "set_data": set_data,
-        "diagnostics": diagnostics,
+        "diagnostics_total": diag.total,
+        "diagnostics_path": diag.path if diag.total else None,
+        "diagnostics": diag.sample,
+        "diagnostics_truncated": diag.total > len(diag.sample),
     }
 
 def main():
@@ -377,17 +668,19 @@ def main():
 
     os.makedirs(RUNTIME_DIR, exist_ok=True)
 
+    ts = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    out = os.path.join(RUNTIME_DIR, f"fixup_lote_{args.lote}_{ts}.json")
+    diag_path = os.path.join(RUNTIME_DIR, f"fixup_lote_{args.lote}_{ts}.jsonl")
+
     with SessionLocal() as db:
-        res = fixup_lote(db, args.lote, incluir_retorno_troca=args.incluir_retorno_troca, verbose=args.verbose)
+        res = fixup_lote(db, args.lote, incluir_retorno_troca=args.incluir_retorno_troca,
+                         verbose=args.verbose, diag_path=diag_path, dry_run=args.dry_run)
         if args.dry_run:
             db.rollback()
         else:
             db.commit()
 
-    ts = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    out = os.path.join(RUNTIME_DIR, f"fixup_lote_{args.lote}_{ts}.json")
-    with open(out, "w", encoding="utf-8") as f:
-        json.dump(res, f, ensure_ascii=False, indent=2)
+    dump_json(res, out)
 
     print(json.dumps(res, ensure_ascii=False, indent=2))
     print(f"[ok] Resumo salvo em: {out}")
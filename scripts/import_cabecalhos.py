@@ -1,7 +1,13 @@
 #!/usr/bin/env python3
 # scripts/import_cabecalhos.py
-# Versão 1.0.0 — 11/08/2025
+# Versão 1.1.0 — 16/10/2026
 # CHANGELOG:
+# 1.1.0: CSV lido em streaming (csv.reader direto no arquivo), sem carregar tudo em memória
+#        upsert em lote: um SELECT ... IN (...) + bulk_insert/bulk_update_mappings (blocos de 5000)
+#        PostgreSQL: INSERT multi-VALUES (1000 linhas por comando) e, havendo UNIQUE no nº do contrato,
+#        INSERT ... ON CONFLICT DO UPDATE com --on-duplicate update (sem SELECT prévio)
+#        aliases de colunas normalizados uma vez no import; normalize_header com lru_cache
+#        import_cabecalhos_result.json gravado com orjson quando disponível
 # 1.0.0: Importador simples de cabeçalhos (CSV) com:
 #        - detecção automática de delimitador/encoding
 #        - aliases de colunas mais comuns
@@ -14,6 +20,7 @@
 #   Opções: --encoding utf-8-sig|latin1|utf-8 | --delimiter auto|;|,|||\\t
 
 import os, sys, csv, argparse, json
+from functools import lru_cache
 from datetime import datetime
 
 # Garanta que estamos na raiz do projeto (onde ficam database.py e models.py)
@@ -24,12 +31,19 @@ if ROOT not in sys.path:
 
 from database import SessionLocal  # usa sua conexão existente
 from models import ContratoCabecalho  # usa seu modelo existente
+try:
+    import orjson  # opcional: serialização JSON em C (bem mais rápida)
+except Exception:
+    orjson = None
+
 from sqlalchemy.orm import Session
-from sqlalchemy import func
+from sqlalchemy import func, inspect as sa_inspect, literal_column
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 
-__version__ = "1.0.0"
+__version__ = "1.1.0"
 
 # ------------------ Helpers ------------------ #
+@lru_cache(maxsize=1024)
 def normalize_header(s: str) -> str:
     return (s or "").strip().lower().replace(" ", "_").replace("-", "_")
 
@@ -42,8 +56,17 @@ ALIASES = {
     "vendedor": ["vendedor", "seller", "responsavel", "responsável"],
 }
 
+# tamanho dos blocos para IN (...) e bulk insert/update
+BULK_CHUNK = 5000
+# linhas por INSERT ... VALUES (...), (...) no PostgreSQL
+PG_VALUES_CHUNK = 1000
+
 OBRIGATORIAS = ["contrato", "nome_cliente", "cnpj", "prazo_contratual", "indice_reajuste", "vendedor"]
 
+# Tabelas normalizadas uma única vez (resolve_indexes vira só consultas em dict)
+_ALIASES_NORM = {canon: [normalize_header(a) for a in vals] for canon, vals in ALIASES.items()}
+_CANON_NORM = {c: normalize_header(c) for c in OBRIGATORIAS}
+
 def detect_delimiter(sample: str) -> str:
     try:
         return csv.Sniffer().sniff(sample[:2000], delimiters=[",", ";", "|", "\t"]).delimiter
@@ -65,12 +88,12 @@ def resolve_indexes(header: list[str], mapping_json: str | None = None) -> dict:
         if canon in mapping:
             return index_map.get(normalize_header(str(mapping[canon])))
         # 2) aliases
-        for a in ALIASES.get(canon, []):
-            i = index_map.get(normalize_header(a))
+        for a in _ALIASES_NORM.get(canon, ()):
+            i = index_map.get(a)
             if i is not None:
                 return i
         # 3) nome exato
-        return index_map.get(normalize_header(canon))
+        return index_map.get(_CANON_NORM.get(canon) or normalize_header(canon))
 
     out = {k: idx_for(k) for k in set(OBRIGATORIAS)}
     return out
@@ -83,6 +106,50 @@ def get_contract_field(model) -> str:
     # fallback: contrato_n (vai quebrar se não existir)
     return "contrato_n"
 
+def is_postgres(db: Session) -> bool:
+    return db.get_bind().dialect.name == "postgresql"
+
+def has_unique_on(db: Session, model, column: str) -> bool:
+    """True se existe UNIQUE (constraint ou índice) só na coluna — exigido pelo ON CONFLICT."""
+    try:
+        insp = sa_inspect(db.get_bind())
+        table = model.__tablename__
+        uniques = [u.get("column_names") for u in insp.get_unique_constraints(table)]
+        uniques += [i.get("column_names") for i in insp.get_indexes(table) if i.get("unique")]
+        return [column] in uniques
+    except Exception:
+        return False
+
+def pg_upsert(db: Session, new_rows: list, contract_field: str) -> tuple[int, int]:
+    """INSERT ... ON CONFLICT DO UPDATE em blocos; dispensa o SELECT prévio.
+
+    Linhas repetidas no CSV são mescladas antes (o PG não aceita afetar a mesma
+    linha duas vezes no mesmo comando). Retorna (inseridos, atualizados).
+    """
+    merged: dict[str, dict] = {}
+    repetidos = 0
+    for _, contrato, kwargs in new_rows:
+        if contrato in merged:
+            merged[contrato].update(kwargs)
+            repetidos += 1
+        else:
+            merged[contrato] = {contract_field: contrato, **kwargs}
+
+    rows = list(merged.values())
+    inserted = updated = 0
+    for i in range(0, len(rows), PG_VALUES_CHUNK):
+        stmt = pg_insert(ContratoCabecalho).values(rows[i:i + PG_VALUES_CHUNK])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[contract_field],
+            set_={k: stmt.excluded[k] for k in rows[0] if k != contract_field},
+        ).returning(literal_column("(xmax = 0)"))
+        for (foi_insert,) in db.execute(stmt):
+            if foi_insert:
+                inserted += 1
+            else:
+                updated += 1
+    return inserted, updated + repetidos
+
 def to_int(x):
     try:
         return int(str(x).strip())
@@ -105,46 +172,50 @@ def importar_cabecalhos(
         print(f"ERRO: arquivo não encontrado: {csv_path}")
         sys.exit(1)
 
-    with open(csv_path, "rb") as f:
-        raw = f.read()
-
     try:
-        text = raw.decode(encoding, errors="replace")
-    except Exception:
+        fh = open(csv_path, "r", encoding=encoding, errors="replace", newline="")
+    except LookupError:
         print(f"AVISO: não consegui usar encoding='{encoding}', tentando latin1…")
-        text = raw.decode("latin1", errors="replace")
-
-    use_delim = detect_delimiter(text) if delimiter == "auto" else {";": ";", ",": ",", "|": "|", "\\t": "\t"}.get(delimiter, delimiter)
-
-    reader = csv.reader(text.splitlines(), delimiter=use_delim)
-    try:
-        header = next(reader)
-    except StopIteration:
-        print("ERRO: CSV vazio.")
-        sys.exit(1)
-
-    idx = resolve_indexes(header, mapping_json)
-    faltando = [c for c in OBRIGATORIAS if idx.get(c) is None]
-    if faltando:
-        print(f"ERRO: Colunas obrigatórias ausentes no CSV: {faltando}")
-        print("Header lido:", header)
-        sys.exit(1)
-
-    contract_field = get_contract_field(ContratoCabecalho)
-    print(f"→ Delimitador: {repr(use_delim)}  |  Encoding: {encoding}")
-    print(f"→ Campo de contrato no modelo: {contract_field}")
-    print(f"→ Estratégia duplicados: {on_duplicate}  |  {'DRY-RUN (não grava)' if not commit else 'COMMIT (grava)'}")
-    print("-" * 80)
-
-    db: Session = SessionLocal()
-    inserted = updated = skipped = errors = 0
-    erros_detalhes: list[dict] = []
-
-    def get(row, c):
-        i = idx.get(c)
-        return (row[i].strip() if (i is not None and i < len(row)) else "").strip()
-
-    try:
+        encoding = "latin1"
+        fh = open(csv_path, "r", encoding=encoding, errors="replace", newline="")
+
+    with fh:
+        if delimiter == "auto":
+            # só uma amostra para o Sniffer; o restante é lido em streaming
+            use_delim = detect_delimiter(fh.read(2048))
+            fh.seek(0)
+        else:
+            use_delim = {";": ";", ",": ",", "|": "|", "\\t": "\t"}.get(delimiter, delimiter)
+
+        reader = csv.reader(fh, delimiter=use_delim)
+        try:
+            header = next(reader)
+        except StopIteration:
+            print("ERRO: CSV vazio.")
+            sys.exit(1)
+
+        idx = resolve_indexes(header, mapping_json)
+        faltando = [c for c in OBRIGATORIAS if idx.get(c) is None]
+        if faltando:
+            print(f"ERRO: Colunas obrigatórias ausentes no CSV: {faltando}")
+            print("Header lido:", header)
+            sys.exit(1)
+
+        contract_field = get_contract_field(ContratoCabecalho)
+        print(f"→ Delimitador: {repr(use_delim)}  |  Encoding: {encoding}")
+        print(f"→ Campo de contrato no modelo: {contract_field}")
+        print(f"→ Estratégia duplicados: {on_duplicate}  |  {'DRY-RUN (não grava)' if not commit else 'COMMIT (grava)'}")
+        print("-" * 80)
+
+        inserted = updated = skipped = errors = 0
+        erros_detalhes: list[dict] = []
+
+        def get(row, c):
+            i = idx.get(c)
+            return (row[i].strip() if (i is not None and i < len(row)) else "").strip()
+
+        # 1ª passada: só parse/validação do CSV (sem tocar no banco)
+        new_rows: list[tuple[int, str, dict]] = []  # (linha, contrato, kwargs)
         for ln, row in enumerate(reader, start=2):  # inicia em 2 por causa do header
             try:
                 dados = {
@@ -170,40 +241,61 @@ def importar_cabecalhos(
                     indice_reajuste=str(dados["indice_reajuste"]),
                     vendedor=dados["vendedor"],
                 )
-
-                # upsert por contrato
-                existente = db.query(ContratoCabecalho).filter(
-                    getattr(ContratoCabecalho, contract_field) == dados["contrato"]
-                ).first()
-
-                if existente:
-                    if on_duplicate == "skip":
-                        skipped += 1
-                        continue
-                    elif on_duplicate == "error":
-                        errors += 1
-                        erros_detalhes.append({"linha": ln, "erro": f"Contrato já existe: {dados['contrato']}"})
-                        continue
-                    elif on_duplicate == "update":
-                        if commit:
-                            existente.nome_cliente = kwargs["nome_cliente"]
-                            existente.cnpj = kwargs["cnpj"]
-                            existente.prazo_contratual = kwargs["prazo_contratual"]
-                            existente.indice_reajuste = kwargs["indice_reajuste"]
-                            existente.vendedor = kwargs["vendedor"]
-                        updated += 1
-                        continue
-                else:
-                    if commit:
-                        novo = ContratoCabecalho(**kwargs)
-                        setattr(novo, contract_field, dados["contrato"])
-                        db.add(novo)
-                    inserted += 1
+                new_rows.append((ln, dados["contrato"], kwargs))
             except Exception as e:
                 errors += 1
                 erros_detalhes.append({"linha": ln, "erro": str(e)})
 
-        if commit:
+    # 2ª passada: um SELECT ... IN (...) por bloco + bulk insert/update
+    db: Session = SessionLocal()
+    contract_col = getattr(ContratoCabecalho, contract_field)
+    try:
+        pg = is_postgres(db)
+        if commit and on_duplicate == "update" and pg and has_unique_on(db, ContratoCabecalho, contract_field):
+            # PostgreSQL com UNIQUE no nº do contrato: upsert nativo, sem SELECT
+            inserted, updated = pg_upsert(db, new_rows, contract_field)
+            db.commit()
+            new_rows = []
+
+        all_keys = list(dict.fromkeys(c for _, c, _ in new_rows))
+        existing: dict[str, int] = {}
+        for i in range(0, len(all_keys), BULK_CHUNK):
+            chunk = all_keys[i:i + BULK_CHUNK]
+            for cab_id, key in db.query(ContratoCabecalho.id, contract_col).filter(contract_col.in_(chunk)).all():
+                existing.setdefault(key, cab_id)
+
+        to_insert: dict[str, dict] = {}  # contrato -> mapping (dedup dentro do próprio CSV)
+        to_update: dict[int, dict] = {}  # id -> mapping
+        for ln, contrato, kwargs in new_rows:
+            if contrato in existing or contrato in to_insert:
+                if on_duplicate == "skip":
+                    skipped += 1
+                elif on_duplicate == "error":
+                    errors += 1
+                    erros_detalhes.append({"linha": ln, "erro": f"Contrato já existe: {contrato}"})
+                elif on_duplicate == "update":
+                    if contrato in to_insert:
+                        to_insert[contrato].update(kwargs)
+                    else:
+                        cab_id = existing[contrato]
+                        to_update[cab_id] = {"id": cab_id, **kwargs}
+                    updated += 1
+                continue
+            to_insert[contrato] = {contract_field: contrato, **kwargs}
+            inserted += 1
+
+        if commit and (to_insert or to_update):
+            ins = list(to_insert.values())
+            upd = list(to_update.values())
+            if pg:
+                # INSERT multi-VALUES (executemany "values" do driver)
+                for i in range(0, len(ins), PG_VALUES_CHUNK):
+                    db.execute(pg_insert(ContratoCabecalho).values(ins[i:i + PG_VALUES_CHUNK]))
+            else:
+                for i in range(0, len(ins), BULK_CHUNK):
+                    db.bulk_insert_mappings(ContratoCabecalho, ins[i:i + BULK_CHUNK])
+            for i in range(0, len(upd), BULK_CHUNK):
+                db.bulk_update_mappings(ContratoCabecalho, upd[i:i + BULK_CHUNK])
             db.commit()
     finally:
         db.close()
@@ -227,8 +319,12 @@ def importar_cabecalhos(
             "detalhes": erros_detalhes[:200],  # limita para não explodir o arquivo
         }
         path = os.path.join("runtime", "import_cabecalhos_result.json")
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(out, f, ensure_ascii=False, indent=2)
+        if orjson is not None:
+            with open(path, "wb") as f:
+                f.write(orjson.dumps(out, option=orjson.OPT_INDENT_2))
+        else:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(out, f, ensure_ascii=False, indent=2)
         print(f"→ Detalhes de erros salvos em: {path}")
 
 def main():
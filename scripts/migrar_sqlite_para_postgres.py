@@ -8,20 +8,38 @@
 #   python scripts/migrar_sqlite_para_postgres.py
 #
 # Observações:
-# - O script cria o schema no Postgres usando seus models (Base.metadata.create_all).
-# - Copia linha a linha (em lotes) preservando as colunas simples.
+# - O script cria no Postgres o schema das tabelas de TABLES (Base.metadata.create_all).
+# - Carga via COPY ... FROM STDIN (CSV em blocos de 50k linhas); se o driver não
+#   suportar COPY, cai para INSERTs em lote (Core executemany, 5000 linhas por
+#   savepoint, um commit por tabela). Bloco cujo COPY falhar é regravado por esse
+#   mesmo caminho de INSERT; só conflitos de integridade descartam linhas (com aviso
+#   e contagem separada) e o total informado é só do que foi de fato gravado.
 # - Se você tiver MAIS tabelas (ex.: Usuario, Log, etc.), inclua no array TABLES.
-# - Se suas PKs forem autoincrement no Postgres, pode ser necessário ajustar sequences depois.
+# - Tabelas independentes são copiadas em paralelo (processos), respeitando as FKs
+#   (pais antes dos filhos).
+# - Durante a carga, índices secundários (não-únicos) são removidos e as conexões
+#   de carga usam session_replication_role=replica (sem checagem de FK por linha);
+#   sem permissão para isso, cai para ALTER TABLE ... DISABLE TRIGGER ALL/USER.
+#   Tudo é restaurado ao final (mesmo em caso de erro) e as FKs são conferidas em lote.
+#   Antes do DROP, o DDL dos índices é salvo em runtime/migrar_indices_<timestamp>.sql:
+#   se o processo for morto no meio da carga, recrie com psql -f nesse arquivo.
+# - Ao final, as sequences/identities das PKs são ajustadas para MAX(id)+1
+#   (PK sem sequence/identity só gera aviso).
 # -----------------------------------------------------------------------------
 
 import os, sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+import io
+import json
+import queue
+import threading
 import time
-from typing import List, Type
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.exc import IntegrityError
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Dict, List, Set, Type
+from sqlalchemy import JSON, Boolean, create_engine, event, select, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import DBAPIError, IntegrityError
 
 # Ajuste estes imports ao seu projeto:
 # - Base: declarative_base
@@ -49,14 +67,19 @@ if not POSTGRES_URL:
 
 # 2) Engines
 src_connect_args = {"check_same_thread": False} if SQLITE_URL.startswith("sqlite") else {}
-src_engine = create_engine(SQLITE_URL, connect_args=src_connect_args)
-dst_engine = create_engine(POSTGRES_URL, pool_pre_ping=True)
+src_engine = create_engine(
+    SQLITE_URL,
+    connect_args=src_connect_args,
+    execution_options={"stream_results": True},
+)
+# executemany em lotes: insertmanyvalues (SA 2.0, qualquer driver) e, no psycopg2,
+# execute_values/execute_batch para os demais statements.
+dst_engine_kwargs = {"pool_pre_ping": True, "insertmanyvalues_page_size": 1000}
+if make_url(POSTGRES_URL).drivername in {"postgresql", "postgresql+psycopg2"}:
+    dst_engine_kwargs.update(executemany_mode="values_plus_batch", executemany_batch_page_size=500)
+dst_engine = create_engine(POSTGRES_URL, **dst_engine_kwargs)
 
-# 3) Sessions
-SrcSession = sessionmaker(bind=src_engine, autocommit=False, autoflush=False)
-DstSession = sessionmaker(bind=dst_engine, autocommit=False, autoflush=False)
-
-# 4) Liste aqui as tabelas a migrar (ordem importa se houver FKs)
+# 3) Liste aqui as tabelas a migrar (ordem importa se houver FKs)
 TABLES: List[Type] = [
     ContratoCabecalho,
     Contrato,
@@ -64,59 +87,498 @@ TABLES: List[Type] = [
 ]
 
 
-def copy_table(src_sess, dst_sess, model, batch_commit=1000, fetch_batch=500) -> int:
+# Linhas acumuladas no buffer CSV antes de cada COPY
+COPY_FLUSH_ROWS = 50_000
+COPY_NULL = r"\N"
+
+
+def _csv_quote(s: str) -> str:
+    # campo entre aspas nunca é lido como NULL no COPY csv (nem um texto "\N" de verdade)
+    return '"' + s.replace('"', '""') + '"'
+
+
+def _copy_encoders(table) -> list:
     """
-    Copia todos os registros de uma tabela do SQLite para o Postgres.
-    - batch_commit: a cada N inserts faz commit;
-    - fetch_batch: usa yield_per para reduzir memória.
+    Uma função valor -> campo CSV por coluna, escolhida pelo TIPO da coluna (não pelo
+    tipo Python do valor): JSON sempre via json.dumps (inclusive str/int/bool escalares),
+    Boolean como t/f, o resto como texto. None vira \\N sem aspas; todo o resto vai
+    entre aspas.
     """
-    table_name = getattr(model, "__tablename__", model.__table__.name)
-    print(f"[...] Copiando tabela: {table_name}")
-    total = 0
-
-    query = src_sess.query(model).yield_per(fetch_batch)
-    for i, row in enumerate(query, start=1):
-        # Copia colunas simples (ignora relationships)
-        data = {col.name: getattr(row, col.name) for col in model.__table__.columns}
-        dst_sess.add(model(**data))
-        total += 1
-
-        if i % batch_commit == 0:
+    def enc_json(v):
+        return COPY_NULL if v is None else _csv_quote(json.dumps(v, ensure_ascii=False))
+
+    def enc_bool(v):
+        return COPY_NULL if v is None else ("t" if v else "f")
+
+    def enc_text(v):
+        return COPY_NULL if v is None else _csv_quote(str(v))
+
+    encs = []
+    for c in table.columns:
+        if isinstance(c.type, JSON):
+            encs.append(enc_json)
+        elif isinstance(c.type, Boolean):
+            encs.append(enc_bool)
+        else:
+            encs.append(enc_text)
+    return encs
+
+
+def _copy_line(encs, row) -> str:
+    return "\t".join([f(v) for f, v in zip(encs, row)]) + "\n"
+
+
+def _supports_copy(raw_conn) -> bool:
+    cur = raw_conn.cursor()
+    try:
+        return hasattr(cur, "copy_expert") or hasattr(cur, "copy")
+    finally:
+        cur.close()
+
+
+def _copy_buffer(raw_conn, copy_sql: str, buf: io.StringIO) -> None:
+    """Envia o buffer via COPY FROM STDIN (psycopg2: copy_expert; psycopg 3: cursor.copy)."""
+    cur = raw_conn.cursor()
+    try:
+        if hasattr(cur, "copy_expert"):
+            buf.seek(0)
+            cur.copy_expert(copy_sql, buf)
+        else:
+            with cur.copy(copy_sql) as cp:
+                cp.write(buf.getvalue())
+    finally:
+        cur.close()
+
+
+# Linhas por lote na leitura em streaming da origem
+FETCH_BATCH = 5000
+
+
+def stream_partitions(src_conn, table, size=FETCH_BATCH):
+    """Lê a tabela de origem via Core em streaming (sem ORM/identity map), em blocos de `size`."""
+    result = src_conn.execution_options(stream_results=True, yield_per=size).execute(select(table))
+    return result.partitions(size)
+
+
+# Progresso (stderr, mesma linha) a cada N linhas — nunca por linha
+PROGRESS_EVERY = 10_000
+
+
+def _progress(nome: str, total: int, lidas: int) -> None:
+    if total // PROGRESS_EVERY != (total - lidas) // PROGRESS_EVERY:
+        sys.stderr.write(f"{nome}: {total}\r")
+
+
+# Blocos lidos à frente pela thread leitora
+PREFETCH_DEPTH = 4
+_FIM = object()
+
+
+def prefetch_partitions(src_conn, table, size=FETCH_BATCH, depth=PREFETCH_DEPTH):
+    """
+    Mesmo contrato de stream_partitions, mas a leitura do SQLite roda numa thread
+    produtora com fila limitada: enquanto o PG grava um bloco, os próximos já são lidos.
+    """
+    fila = queue.Queue(maxsize=depth)
+    parar = threading.Event()
+
+    def put(item) -> bool:
+        while not parar.is_set():
             try:
-                dst_sess.commit()
-            except IntegrityError as e:
-                dst_sess.rollback()
-                print(f"[WARN] conflito de integridade ao commitar {table_name}: {e}")
+                fila.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def producer():
+        try:
+            for part in stream_partitions(src_conn, table, size):
+                if not put(part):
+                    return
+        except BaseException as e:
+            put(e)
+            return
+        put(_FIM)
 
-    # commit final
+    t = threading.Thread(target=producer, name=f"leitor-{table.name}", daemon=True)
+    t.start()
     try:
-        dst_sess.commit()
-    except IntegrityError as e:
-        dst_sess.rollback()
-        print(f"[WARN] conflito de integridade no commit final de {table_name}: {e}")
+        while True:
+            item = fila.get()
+            if item is _FIM:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        parar.set()
+        t.join()
+
+
+def _report(table_name: str, total: int, perdidas: int) -> None:
+    if perdidas:
+        print(f"[WARN] {table_name}: {total} registro(s) gravado(s), "
+              f"{perdidas} descartado(s) por conflito de integridade")
+    else:
+        print(f"[OK ] {table_name}: {total} registro(s)")
+
+
+def copy_table_copy(src_conn, model, flush_rows=COPY_FLUSH_ROWS) -> int:
+    """
+    Copia uma tabela via COPY do PostgreSQL (uma checagem de lock/tipos por bloco,
+    sem INSERT por linha). Commit a cada bloco de `flush_rows` linhas; se o COPY de
+    um bloco falhar, o bloco é regravado via INSERT em lote (insert_rows).
+    Devolve só as linhas efetivamente gravadas.
+    """
+    table = model.__table__
+    q = dst_engine.dialect.identifier_preparer.quote
+    columns = [c.name for c in table.columns]
+    copy_sql = (
+        f"COPY {q(table.name)} ({', '.join(q(c) for c in columns)}) "
+        f"FROM STDIN WITH (FORMAT csv, DELIMITER E'\\t', NULL '{COPY_NULL}')"
+    )
+    encs = _copy_encoders(table)
+    print(f"[...] Copiando tabela (COPY): {table.name}")
 
-    print(f"[OK ] {table_name}: {total} registro(s)")
+    raw = dst_engine.raw_connection()
+    total = lidas = perdidas = 0
+    try:
+        buf = io.StringIO()
+        rows: list = []  # linhas do bloco atual, para o fallback por INSERT
+
+        def flush():
+            nonlocal buf, rows, total, perdidas
+            if not rows:
+                return
+            try:
+                _copy_buffer(raw, copy_sql, buf)
+                raw.commit()
+                total += len(rows)
+            except dst_engine.dialect.dbapi.Error as e:
+                raw.rollback()
+                print(f"[WARN] falha no COPY de {table.name} ({len(rows)} linha(s)); regravando via INSERT: {e}")
+                with dst_engine.begin() as dst_conn:
+                    gravadas = insert_rows(dst_conn, table, rows)
+                total += gravadas
+                perdidas += len(rows) - gravadas
+            buf = io.StringIO()
+            rows = []
+
+        for part in prefetch_partitions(src_conn, table):
+            for row in part:
+                buf.write(_copy_line(encs, row))
+            rows.extend(part)
+            lidas += len(part)
+            _progress(table.name, lidas, len(part))
+            if len(rows) >= flush_rows:
+                flush()
+        flush()
+    finally:
+        raw.close()
+
+    _report(table.name, total, perdidas)
     return total
 
 
+def ajustar_sequences(models) -> None:
+    """Após inserir IDs explícitos: sequence (SERIAL) ou IDENTITY -> MAX(pk)+1.
+
+    PK sem sequence/identity (pg_get_serial_sequence NULL) é avisada e ignorada.
+    """
+    with dst_engine.begin() as conn:
+        for model in models:
+            pks = list(model.__table__.primary_key.columns)
+            if len(pks) != 1:
+                continue
+            tabela, pk = model.__table__.name, pks[0].name
+            seq = conn.execute(text("SELECT pg_get_serial_sequence(:tbl, :col)"),
+                               {"tbl": tabela, "col": pk}).scalar()
+            if not seq:
+                # pg_get_serial_sequence também cobre IDENTITY: NULL = PK sem gerador
+                print(f"[WARN] {tabela}.{pk}: sem sequence/identity; ignorado")
+                continue
+            max_id = conn.execute(text(f'SELECT COALESCE(MAX("{pk}"), 0) FROM "{tabela}"')).scalar() or 0
+            proximo = max_id + 1 if max_id > 0 else 1
+            conn.execute(text("SELECT setval(:seq, :val, false)"), {"seq": seq, "val": proximo})
+            print(f"[OK ] {tabela}.{pk}: próximo valor = {proximo}")
+
+
+# Linhas por savepoint no fallback (o driver ainda pagina em insertmanyvalues_page_size)
+INSERT_CHUNK = 5000
+
+
+RUNTIME_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "runtime")
+
+
+def drop_secondary_indexes(models, ddl_path: str) -> List[str]:
+    """
+    Remove os índices não-únicos (fora PK/UNIQUE) das tabelas de destino e devolve
+    os `indexdef` para recriá-los depois da carga — um sort por índice em vez de
+    manutenção linha a linha. O DDL é gravado em `ddl_path` ANTES do DROP, para
+    restauração manual se o processo morrer antes de recreate_indexes.
+    """
+    q = dst_engine.dialect.identifier_preparer.quote
+    with dst_engine.begin() as conn:
+        rows = []
+        for model in models:
+            rows += conn.execute(text("""
+                SELECT n.nspname, i.relname, pg_get_indexdef(x.indexrelid)
+                FROM pg_index x
+                JOIN pg_class i ON i.oid = x.indexrelid
+                JOIN pg_class t ON t.oid = x.indrelid
+                JOIN pg_namespace n ON n.oid = t.relnamespace
+                WHERE t.relname = :tbl AND n.nspname = current_schema()
+                  AND NOT x.indisunique AND NOT x.indisprimary
+            """), {"tbl": model.__table__.name}).all()
+        if not rows:
+            return []
+        os.makedirs(os.path.dirname(ddl_path), exist_ok=True)
+        with open(ddl_path, "w", encoding="utf-8") as f:
+            f.write("-- índices secundários removidos por migrar_sqlite_para_postgres.py\n")
+            for _schema, _nome, indexdef in rows:
+                f.write(indexdef + ";\n")
+        print(f"DDL dos índices salvo em {ddl_path}")
+        print(f'  (se a carga for interrompida, restaure com: psql "$POSTGRES_URL" -f "{ddl_path}")')
+        for schema, nome, _indexdef in rows:
+            conn.execute(text(f"DROP INDEX {q(schema)}.{q(nome)}"))
+    return [indexdef for _schema, _nome, indexdef in rows]
+
+
+def recreate_indexes(defs: List[str]) -> None:
+    if not defs:
+        return
+    with dst_engine.begin() as conn:
+        conn.execute(text("SET LOCAL maintenance_work_mem = '1GB'"))
+        conn.execute(text("SET LOCAL max_parallel_maintenance_workers = 4"))
+        for indexdef in defs:
+            conn.execute(text(indexdef))
+            print(f"[OK ] {indexdef}")
+
+
+def set_user_triggers(models, enabled: bool, which: str = "USER") -> None:
+    q = dst_engine.dialect.identifier_preparer.quote
+    acao = "ENABLE" if enabled else "DISABLE"
+    with dst_engine.begin() as conn:
+        for model in models:
+            conn.execute(text(f"ALTER TABLE {q(model.__table__.name)} {acao} TRIGGER {which}"))
+
+
+def _set_replica_role(dbapi_conn, _record):
+    """Listener 'connect': sessão em modo réplica (triggers e FKs não disparam)."""
+    cur = dbapi_conn.cursor()
+    try:
+        cur.execute("SET session_replication_role = replica")
+    finally:
+        cur.close()
+    dbapi_conn.commit()  # o reset do pool faria ROLLBACK do SET
+
+
+def can_use_replica_role() -> bool:
+    """session_replication_role exige superusuário (ou papel equivalente no PG gerenciado)."""
+    try:
+        with dst_engine.connect() as conn:
+            conn.execute(text("SET session_replication_role = replica"))
+            conn.rollback()
+        return True
+    except DBAPIError:
+        return False
+
+
+def disable_triggers(models) -> str:
+    """Fallback sem modo réplica: tenta TRIGGER ALL (inclui FKs); sem permissão, só USER."""
+    try:
+        set_user_triggers(models, enabled=False, which="ALL")
+        return "ALL"
+    except DBAPIError:
+        set_user_triggers(models, enabled=False, which="USER")
+        return "USER"
+
+
+def verificar_fks(models) -> None:
+    """Revalida em lote as FKs entre as tabelas migradas (a carga não as checou linha a linha)."""
+    q = dst_engine.dialect.identifier_preparer.quote
+    with dst_engine.connect() as conn:
+        for model in models:
+            filho = model.__table__
+            for fk in filho.foreign_keys:
+                pai, col_pai = fk.column.table, fk.column
+                orfaos = conn.execute(text(
+                    f"SELECT COUNT(*) FROM {q(filho.name)} c "
+                    f"WHERE c.{q(fk.parent.name)} IS NOT NULL AND NOT EXISTS ("
+                    f"SELECT 1 FROM {q(pai.name)} p WHERE p.{q(col_pai.name)} = c.{q(fk.parent.name)})"
+                )).scalar() or 0
+                if orfaos:
+                    print(f"[WARN] {filho.name}.{fk.parent.name}: {orfaos} linha(s) sem {pai.name}.{col_pai.name}")
+
+
+def insert_rows(dst_conn, table, rows, chunk=INSERT_CHUNK) -> int:
+    """
+    Grava `rows` (tuplas na ordem de table.columns) via executemany do driver
+    (exec_driver_sql) na transação de `dst_conn`, um SAVEPOINT por bloco de `chunk`
+    linhas para isolar conflitos. Devolve quantas linhas foram gravadas; blocos com
+    conflito de integridade são pulados com aviso.
+    """
+    q = dst_engine.dialect.identifier_preparer.quote
+    cols = tuple(sys.intern(c.name) for c in table.columns)  # mesma ordem do select(table)
+    sql = (
+        f"INSERT INTO {q(table.name)} ({', '.join(q(c) for c in cols)}) "
+        f"VALUES ({', '.join(['%s'] * len(cols))})"
+    )
+    # sem o processamento de tipos do Core, JSON precisa ir serializado
+    json_idx = [i for i, c in enumerate(table.columns) if isinstance(c.type, JSON)]
+
+    def params(r):
+        if not json_idx:
+            return tuple(r)
+        v = list(r)
+        for i in json_idx:
+            if v[i] is not None:
+                v[i] = json.dumps(v[i], ensure_ascii=False)
+        return tuple(v)
+
+    gravadas = 0
+    for i in range(0, len(rows), chunk):
+        bloco = [params(r) for r in rows[i:i + chunk]]
+        try:
+            with dst_conn.begin_nested():
+                dst_conn.exec_driver_sql(sql, bloco)
+            gravadas += len(bloco)
+        except IntegrityError as e:
+            print(f"[WARN] conflito de integridade ao gravar {table.name} ({len(bloco)} linha(s)): {e}")
+    return gravadas
+
+
+def copy_table(src_conn, dst_conn, model, chunk=INSERT_CHUNK) -> int:
+    """
+    Copia todos os registros de uma tabela do SQLite para o Postgres (fallback sem COPY).
+    Lê em streaming e grava tuplas posicionais (sem dict por linha) via insert_rows
+    na transação de `dst_conn`:
+    - chunk: linhas por INSERT em lote (um SAVEPOINT por lote, para isolar conflitos).
+    Devolve só as linhas efetivamente gravadas.
+    """
+    table = model.__table__
+    print(f"[...] Copiando tabela: {table.name}")
+    total = lidas = 0
+
+    for part in prefetch_partitions(src_conn, table, chunk):
+        total += insert_rows(dst_conn, table, part, chunk)
+        lidas += len(part)
+        _progress(table.name, lidas, len(part))
+
+    _report(table.name, total, lidas - total)
+    return total
+
+
+# Processos para copiar tabelas independentes em paralelo
+MAX_WORKERS = 4
+
+
+def table_deps(models) -> Dict[str, Set[str]]:
+    """DAG das FKs entre as tabelas migradas: {tabela: {tabelas-pai}}."""
+    names = {m.__table__.name for m in models}
+    deps = {}
+    for m in models:
+        parents = {fk.column.table.name for fk in m.__table__.foreign_keys}
+        deps[m.__table__.name] = (parents & names) - {m.__table__.name}
+    return deps
+
+
+def _init_worker(replica: bool = False):
+    """Cada processo recria suas engines (pools herdados do pai não são fork-safe)."""
+    global src_engine, dst_engine
+    src_engine.dispose(close=False)
+    dst_engine.dispose(close=False)
+    src_engine = create_engine(
+        SQLITE_URL,
+        connect_args=src_connect_args,
+        execution_options={"stream_results": True},
+    )
+    dst_engine = create_engine(POSTGRES_URL, pool_size=1, max_overflow=0, **dst_engine_kwargs)
+    if replica:
+        event.listen(dst_engine, "connect", _set_replica_role)
+
+
+def _copy_worker(table_name: str, use_copy: bool) -> int:
+    model = next(m for m in TABLES if m.__table__.name == table_name)
+    with src_engine.connect() as src_conn:
+        if use_copy:
+            return copy_table_copy(src_conn, model)
+        with dst_engine.begin() as dst_conn:
+            return copy_table(src_conn, dst_conn, model)
+
+
+def copy_tables(use_copy: bool, replica: bool = False) -> int:
+    """Copia TABLES num pool de processos; uma tabela só começa quando seus pais terminaram."""
+    pending = table_deps(TABLES)
+    running = {}
+    grand_total = 0
+    workers = max(1, min(MAX_WORKERS, len(TABLES)))
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(replica,)) as ex:
+        while pending or running:
+            for name in [n for n, d in pending.items() if not d]:
+                running[ex.submit(_copy_worker, name, use_copy)] = name
+                del pending[name]
+            if not running:
+                raise SystemExit(f"Ciclo de FKs entre as tabelas: {sorted(pending)}")
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                name = running.pop(fut)
+                grand_total += fut.result()
+                for d in pending.values():
+                    d.discard(name)
+    return grand_total
+
+
 def main():
     t0 = time.time()
     print("= MIGRAÇÃO: SQLite -> PostgreSQL ================================")
     print(f"SQLITE_URL   = {SQLITE_URL}")
     print(f"POSTGRES_URL = {POSTGRES_URL.split('@')[-1]}  (credenciais ocultas)")
     print("Criando schema no destino (se necessário)...")
-    Base.metadata.create_all(bind=dst_engine)
+    # só as tabelas migradas, numa única transação (um snapshot do catálogo)
+    with dst_engine.begin() as conn:
+        Base.metadata.create_all(bind=conn, tables=[m.__table__ for m in TABLES], checkfirst=True)
+
+    raw = dst_engine.raw_connection()
+    try:
+        use_copy = _supports_copy(raw)
+    finally:
+        raw.close()
+
+    print("Removendo índices secundários durante a carga...")
+    ddl_path = os.path.join(RUNTIME_DIR, f"migrar_indices_{time.strftime('%Y%m%d_%H%M%S')}.sql")
+    index_defs = drop_secondary_indexes(TABLES, ddl_path)
+    triggers = None
+    try:
+        replica = can_use_replica_role()
+        if replica:
+            print("Carga com session_replication_role=replica (FKs/triggers não disparam).")
+        else:
+            triggers = disable_triggers(TABLES)
+            print(f"Sem permissão para modo réplica: TRIGGER {triggers} desabilitado durante a carga.")
+        grand_total = copy_tables(use_copy, replica)
+    finally:
+        # índices primeiro: não dependem dos triggers e são o que mais custa perder
+        try:
+            print(f"Recriando {len(index_defs)} índice(s)...")
+            recreate_indexes(index_defs)
+        finally:
+            if triggers:
+                set_user_triggers(TABLES, enabled=True, which=triggers)
+    if index_defs:
+        os.remove(ddl_path)  # índices recriados: o arquivo de restauração não é mais necessário
+
+    if replica or triggers == "ALL":
+        print("Conferindo FKs em lote...")
+        verificar_fks(TABLES)
 
-    with SrcSession() as s_src, DstSession() as s_dst:
-        grand_total = 0
-        for model in TABLES:
-            grand_total += copy_table(s_src, s_dst, model)
+    print("Ajustando sequences/identities das PKs...")
+    ajustar_sequences(TABLES)
 
     dt = time.time() - t0
     print(f"\nConcluído. Total inserido: {grand_total} registro(s) em {dt:0.1f}s.")
     print("=================================================================")
-    print("Se suas PKs são autoincrement no Postgres e você inseriu IDs manualmente,")
-    print("talvez seja preciso ajustar sequences (posso te passar um script se quiser).")
 
 
 if __name__ == "__main__":
@@ -1,13 +1,20 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """
-migrate_10_to_11.py  |  Versão: 1.1.0  (2025-08-26)
+migrate_10_to_11.py  |  Versão: 1.1.1  (2026-10-16)
 Objetivo: migrar estrutura do schema de v1.0 para v1.1 sem levar dados.
 - Idempotente: roda quantas vezes precisar.
 - Foca nas tabelas usadas pelo app: contratos_cabecalho, contratos, logs_importacao, import_lotes, app_meta.
 - Cria colunas/índices ausentes.
 - (Opcional) Recalcula backlog = valor_mensal * meses_restantes, se --calc-backlog for passado.
 
+Alterações 1.1.1:
+- Colunas checadas com um único PRAGMA table_info por tabela (ensure_columns).
+- Toda a migração roda numa única transação (BEGIN IMMEDIATE) com journal em memória
+  e synchronous=OFF; app_meta gravada com um único INSERT ... ON CONFLICT DO UPDATE.
+- ensure_table vira um único CREATE TABLE IF NOT EXISTS (sem a tabela "dummy").
+- --calc-backlog só reescreve as linhas cujo backlog está divergente (ou NULL).
+
 Uso:
   python migrate_10_to_11.py --db "C:\\caminho\\para\\dados.db" [--calc-backlog]
 
@@ -24,52 +31,52 @@ def connect(db_path):
     conn.execute("PRAGMA foreign_keys = ON;")
     return conn
 
-def table_has_column(conn, table, column):
-    cur = conn.execute(f"PRAGMA table_info('{table}')")
-    cols = [r[1].lower() for r in cur.fetchall()]
-    return column.lower() in cols
+def tune_for_migration(conn):
+    """PRAGMAs de carga (valem só para esta conexão) — um fsync no COMMIT final."""
+    conn.execute("PRAGMA journal_mode=MEMORY;")
+    conn.execute("PRAGMA synchronous=OFF;")
+    conn.execute("PRAGMA temp_store=MEMORY;")
+    conn.execute("PRAGMA cache_size=-200000;")
+
+def get_columns(conn, table):
+    return {r[1].lower() for r in conn.execute(f"PRAGMA table_info('{table}')")}
 
 def ensure_table(conn, name, create_sql):
-    # cria tabela se não existir
-    conn.execute(f"CREATE TABLE IF NOT EXISTS {name} (dummy_col__will_be_dropped INTEGER)")
-    # se for tabela “dummy” recém-criada, substitui pelo schema correto
-    # detecta pela existência da coluna dummy
-    if table_has_column(conn, name, "dummy_col__will_be_dropped"):
-        conn.execute("PRAGMA foreign_keys=OFF;")
-        conn.execute("BEGIN;")
-        try:
-            conn.execute(f"DROP TABLE {name};")
-            conn.execute(create_sql)
-            conn.execute("COMMIT;")
-        except Exception:
-            conn.execute("ROLLBACK;")
-            raise
-        finally:
-            conn.execute("PRAGMA foreign_keys=ON;")
+    # create_sql já é CREATE TABLE IF NOT EXISTS: tabela existente (inclusive v1.0
+    # alterada) fica intocada; colunas faltantes vêm de ensure_columns.
+    conn.execute(create_sql)
 
 def ensure_index(conn, name, create_sql):
     conn.execute(create_sql)
 
-def add_column_if_missing(conn, table, col_def):
+def ensure_columns(conn, table, col_defs):
     """
-    col_def exemplo: "cod_cli TEXT", "meses_restantes INTEGER DEFAULT 0"
+    Adiciona as colunas ausentes com um único PRAGMA table_info por tabela.
+    col_defs exemplo: ["cod_cli TEXT", "meses_restantes INTEGER DEFAULT 0"]
     """
-    col_name = col_def.split()[0]
-    if not table_has_column(conn, table, col_name):
-        conn.execute(f"ALTER TABLE {table} ADD COLUMN {col_def}")
-
-def set_meta(conn, key, value):
+    existing = get_columns(conn, table)
+    for col_def in col_defs:
+        col_name = col_def.split()[0].lower()
+        if col_name not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {col_def}")
+            existing.add(col_name)
+
+def set_meta(conn, items):
+    """Grava vários pares (key, value) em app_meta com um único upsert (SQLite >= 3.24)."""
     conn.execute("""
         CREATE TABLE IF NOT EXISTS app_meta (
           key TEXT PRIMARY KEY,
           value TEXT
         )
     """)
-    cur = conn.execute("SELECT value FROM app_meta WHERE key=?", (key,))
-    if cur.fetchone() is None:
-        conn.execute("INSERT INTO app_meta(key, value) VALUES(?,?)", (key, value))
-    else:
-        conn.execute("UPDATE app_meta SET value=? WHERE key=?", (value, key))
+    items = list(items.items())
+    placeholders = ",".join("(?,?)" for _ in items)
+    params = [v for kv in items for v in kv]
+    conn.execute(
+        f"INSERT INTO app_meta(key, value) VALUES {placeholders} "
+        "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+        params,
+    )
 
 def main():
     p = argparse.ArgumentParser()
@@ -82,6 +89,8 @@ def main():
         sys.exit(2)
 
     conn = connect(args.db)
+    tune_for_migration(conn)
+    conn.execute("BEGIN IMMEDIATE;")
     try:
         # --- TABELAS-CHAVE (schema v1.1) ---
         contratos_cabecalho_sql = """
@@ -99,13 +108,15 @@ def main():
         ensure_table(conn, "contratos_cabecalho", contratos_cabecalho_sql)
 
         # Garantir colunas essenciais (caso a tabela já existisse em v1.0)
-        add_column_if_missing(conn, "contratos_cabecalho", "cod_cli TEXT")
-        add_column_if_missing(conn, "contratos_cabecalho", "nome_cliente TEXT")
-        add_column_if_missing(conn, "contratos_cabecalho", "cnpj TEXT")
-        add_column_if_missing(conn, "contratos_cabecalho", "contrato_num TEXT")
-        add_column_if_missing(conn, "contratos_cabecalho", "prazo_contratual INTEGER")
-        add_column_if_missing(conn, "contratos_cabecalho", "indice_reajuste REAL")
-        add_column_if_missing(conn, "contratos_cabecalho", "vendedor TEXT")
+        ensure_columns(conn, "contratos_cabecalho", [
+            "cod_cli TEXT",
+            "nome_cliente TEXT",
+            "cnpj TEXT",
+            "contrato_num TEXT",
+            "prazo_contratual INTEGER",
+            "indice_reajuste REAL",
+            "vendedor TEXT",
+        ])
 
         # Índices úteis
         ensure_index(conn, "idx_cab_contrato_num",
@@ -135,20 +146,22 @@ def main():
         ensure_table(conn, "contratos", contratos_sql)
 
         # Garantir colunas essenciais
-        add_column_if_missing(conn, "contratos", "cabecalho_id INTEGER")
-        add_column_if_missing(conn, "contratos", "ativo TEXT")
-        add_column_if_missing(conn, "contratos", "serial TEXT")
-        add_column_if_missing(conn, "contratos", "cod_pro TEXT")
-        add_column_if_missing(conn, "contratos", "descricao_produto TEXT")
-        add_column_if_missing(conn, "contratos", "cod_cli TEXT")
-        add_column_if_missing(conn, "contratos", "nome_cli TEXT")
-        add_column_if_missing(conn, "contratos", "data_envio TEXT")
-        add_column_if_missing(conn, "contratos", "contrato_n TEXT")
-        add_column_if_missing(conn, "contratos", "valor_mensal REAL")
-        add_column_if_missing(conn, "contratos", "periodo_contratual INTEGER")
-        add_column_if_missing(conn, "contratos", "meses_restantes INTEGER DEFAULT 0")
-        add_column_if_missing(conn, "contratos", "valor_global_contrato REAL")
-        add_column_if_missing(conn, "contratos", "backlog REAL DEFAULT 0")
+        ensure_columns(conn, "contratos", [
+            "cabecalho_id INTEGER",
+            "ativo TEXT",
+            "serial TEXT",
+            "cod_pro TEXT",
+            "descricao_produto TEXT",
+            "cod_cli TEXT",
+            "nome_cli TEXT",
+            "data_envio TEXT",
+            "contrato_n TEXT",
+            "valor_mensal REAL",
+            "periodo_contratual INTEGER",
+            "meses_restantes INTEGER DEFAULT 0",
+            "valor_global_contrato REAL",
+            "backlog REAL DEFAULT 0",
+        ])
 
         ensure_index(conn, "idx_contratos_cabecalho",
             "CREATE INDEX IF NOT EXISTS idx_contratos_cabecalho ON contratos(cabecalho_id)")
@@ -205,14 +218,21 @@ def main():
             conn.execute("""
                 UPDATE contratos
                 SET backlog = COALESCE(valor_mensal,0) * COALESCE(meses_restantes,0)
+                WHERE backlog IS NULL
+                   OR backlog != COALESCE(valor_mensal,0) * COALESCE(meses_restantes,0)
             """)
 
         # Marcar versão de schema
-        set_meta(conn, "schema_version", V_TARGET)
-        set_meta(conn, "schema_version_set_at", datetime.now().isoformat(timespec="seconds"))
+        set_meta(conn, {
+            "schema_version": V_TARGET,
+            "schema_version_set_at": datetime.now().isoformat(timespec="seconds"),
+        })
 
         conn.commit()
         print(f"[ok] Migração concluída. schema_version={V_TARGET}")
+    except Exception:
+        conn.rollback()
+        raise
     finally:
         conn.close()
 
@@ -1,7 +1,12 @@
 import os
 import sys
 import argparse
+import hashlib
+import hmac
+import json
+from pathlib import Path
 from sqlalchemy import create_engine, text
+from sqlalchemy.exc import DBAPIError
 
 parser = argparse.ArgumentParser(description="Resetar/definir senha de um usuário (tabela 'users').")
 parser.add_argument("--username", "-u", default=os.getenv("ADMIN_USERNAME", "admin"),
@@ -23,86 +28,142 @@ except Exception:
     print("ERRO: 'passlib[bcrypt]' não instalado. Garanta no requirements.txt: passlib[bcrypt]>=1.7.4 e bcrypt==3.2.2")
     sys.exit(1)
 
+# Em dev (ENV=dev): custo bcrypt menor e cache do hash entre execuções repetidas.
+# A chave do cache é um HMAC com SECRET_KEY (nunca o sha256 puro da senha).
+DEV = os.getenv("ENV", "").strip().lower() == "dev"
+BCRYPT_ROUNDS = 10 if DEV else 12
+BCRYPT_CACHE_DIR = Path.home() / ".cache" / "app-contratos"
+
+def _hash_cache_path(password):
+    secret = os.getenv("SECRET_KEY")
+    if not (DEV and secret):
+        return None
+    key = hmac.new(secret.encode(), f"{BCRYPT_ROUNDS}:{password}".encode(), hashlib.sha256).hexdigest()
+    return BCRYPT_CACHE_DIR / f"bcrypt_{key}.txt"
+
+def hash_password(password):
+    path = _hash_cache_path(password)
+    if path and path.exists():
+        cached = path.read_text(encoding="utf-8").strip()
+        if bcrypt.identify(cached):
+            return cached
+    h = bcrypt.using(rounds=BCRYPT_ROUNDS).hash(password)
+    if path:
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(h, encoding="utf-8")
+            path.chmod(0o600)
+        except OSError:
+            pass
+    return h
+
+def _cols_cache_path():
+    key = hashlib.sha256(DB_URL.encode()).hexdigest()[:16]
+    return BCRYPT_CACHE_DIR / f"users_cols_{key}.json"
+
+def load_cached_cols():
+    try:
+        return json.loads(_cols_cache_path().read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+
+def save_cached_cols(cols):
+    try:
+        path = _cols_cache_path()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(cols), encoding="utf-8")
+    except OSError:
+        pass
+
+def fetch_cols(conn):
+    return [r[0] for r in conn.execute(text(
+        "select column_name from information_schema.columns "
+        "where table_schema='public' and table_name='users'"
+    ))]
+
+def build_upsert(cols):
+    """
+    Um único round-trip: INSERT ... ON CONFLICT (username) DO UPDATE ... RETURNING.
+    No conflito só a senha (e updated_at) muda, como no UPDATE antigo; os demais
+    campos só entram na criação. `inserted` = (xmax = 0).
+    """
+    # identificar coluna de senha
+    passcol = next((c for c in ("password_hash","hashed_password","password") if c in cols), None)
+    if not passcol:
+        print("ERRO: não achei coluna de senha na tabela 'users'. Colunas:", cols)
+        sys.exit(1)
+
+    insert_cols = ["username", passcol]
+    value_parts = [":username", ":h"]
+    params = {"username": args.username}
+    # campos comuns que vamos tentar inserir se existirem
+    extras = {
+        "is_active": True,
+        "is_admin": True,
+        "role": "admin",
+        "email": f"{args.username}@local",
+        "name": args.username.title(),
+    }
+    for c, v in extras.items():
+        if c in cols:
+            insert_cols.append(c)
+            value_parts.append(f":{c}")
+            params[c] = v
+
+    # timestamps no lado do servidor
+    set_parts = [f"{passcol} = excluded.{passcol}"]
+    if "created_at" in cols:
+        insert_cols.append("created_at")
+        value_parts.append("now()")
+    if "updated_at" in cols:
+        insert_cols.append("updated_at")
+        value_parts.append("now()")
+        set_parts.append("updated_at = now()")
+
+    sql = text(f"""
+        insert into users ({", ".join(insert_cols)})
+        values ({", ".join(value_parts)})
+        on conflict (username) do update
+           set {", ".join(set_parts)}
+        returning id, (xmax = 0) as inserted
+    """)
+    return sql, params, passcol
+
+def upsert_user(conn, cols, h):
+    sql, params, passcol = build_upsert(cols)
+    row = conn.execute(sql, {**params, "h": h}).first()
+    return row, passcol
+
 def main():
     engine = create_engine(DB_URL, pool_pre_ping=True)
-    with engine.begin() as conn:
-        # pegar colunas reais da tabela
-        cols = [r[0] for r in conn.execute(text(
-            "select column_name from information_schema.columns "
-            "where table_schema='public' and table_name='users'"
-        ))]
-
-        # identificar coluna de senha
-        passcol = next((c for c in ("password_hash","hashed_password","password") if c in cols), None)
-        if not passcol:
-            print("ERRO: não achei coluna de senha na tabela 'users'. Colunas:", cols)
-            sys.exit(1)
-
-        # se existir, vamos também atualizar updated_at no update
-        has_updated = "updated_at" in cols
-        has_created = "created_at" in cols
-
-        h = bcrypt.hash(args.new_password)
-
-        # 1) tentar UPDATE
-        if has_updated:
-            upd_sql = text(f"""
-                update users
-                   set {passcol}=:h,
-                       updated_at = now()
-                 where username=:u
-            """)
-        else:
-            upd_sql = text(f"update users set {passcol}=:h where username=:u")
-
-        upd = conn.execute(upd_sql, {"h": h, "u": args.username})
-
-        if upd.rowcount > 0:
-            print(f"Senha atualizada: {args.username} (coluna de senha: {passcol})")
-            return
-
-        # 2) se não atualizou, INSERT novo usuário
-        # campos comuns que vamos tentar inserir se existirem
-        values = {"username": args.username, passcol: h}
-        if "is_active" in cols: values["is_active"] = True
-        if "is_admin"  in cols: values["is_admin"]  = True
-        if "role"      in cols: values["role"]      = "admin"
-        if "email"     in cols: values.setdefault("email", f"{args.username}@local")
-        if "name"      in cols: values.setdefault("name", args.username.title())
-
-        insert_cols = ["username", passcol]
-        if "is_active" in values: insert_cols.append("is_active")
-        if "is_admin"  in values: insert_cols.append("is_admin")
-        if "role"      in values: insert_cols.append("role")
-        if "email"     in values: insert_cols.append("email")
-        if "name"      in values: insert_cols.append("name")
-
-        # timestamps no lado do servidor:
-        # se a coluna existir, vamos pôr "now()" direto no SQL (sem parâmetro)
-        if has_created: insert_cols.append("created_at")
-        if has_updated: insert_cols.append("updated_at")
-
-        # montar a parte dos VALUES
-        value_parts = []
-        params = {}
-        for c in insert_cols:
-            if c in ("created_at", "updated_at"):
-                value_parts.append("now()")
-            else:
-                value_parts.append(f":{c}")
-                params[c] = values[c]
-
-        ins_sql = text(f"""
-            insert into users ({", ".join(insert_cols)})
-            values ({", ".join(value_parts)})
-        """)
-
-        conn.execute(ins_sql, params)
-        print(f"Usuário criado: {args.username} (coluna de senha: {passcol})")
-
-        print("Credenciais:")
-        print(" - username:", args.username)
-        print(" - senha   :", args.new_password)
+    h = hash_password(args.new_password)
+
+    row = None
+    cols = load_cached_cols()
+    if cols:
+        # colunas já conhecidas: nenhuma consulta ao information_schema
+        try:
+            with engine.begin() as conn:
+                row, passcol = upsert_user(conn, cols, h)
+        except DBAPIError:
+            row = None  # cache desatualizado -> reintrospecta abaixo
+
+    if row is None:
+        with engine.begin() as conn:
+            # pegar colunas reais da tabela
+            cols = fetch_cols(conn)
+            row, passcol = upsert_user(conn, cols, h)
+        save_cached_cols(cols)
+
+    if not row.inserted:
+        print(f"Senha atualizada: {args.username} (coluna de senha: {passcol})")
+        return
+
+    print(f"Usuário criado: {args.username} (coluna de senha: {passcol})")
+
+    print("Credenciais:")
+    print(" - username:", args.username)
+    print(" - senha   :", args.new_password)
 
 if __name__ == "__main__":
     main()
@@ -1,16 +1,41 @@
 # scripts/teste_login_db.py
+import json
 import os
 from sqlalchemy import create_engine, text
+from concurrent.futures import ThreadPoolExecutor
 from passlib.context import CryptContext
 
-def get_user_columns(conn, table="users"):
-    cols = conn.execute(text("""
-        select column_name
+try:
+    import bcrypt as _bcrypt  # checkpw direto: sem a detecção de esquema do passlib
+except Exception:
+    _bcrypt = None
+
+SENHAS_TESTE = ("NovaSenha@2025!", "admin", "123456", "senha")
+
+# Diagnóstico inteiro num único round-trip: colunas de users, a linha do usuário
+# e todos os IDs "admin" (duplicados). Os filtros usam a mesma expressão do índice
+# ix_users_lower_username (lower(trim(username))).
+DIAG_SQL = text("""
+    with cols as (
+        select array_agg(column_name::text) as cs
           from information_schema.columns
-         where table_name = :t
-           and table_schema = current_schema()
-    """), {"t": table}).scalars().all()
-    return set(c.lower() for c in cols)
+         where table_schema = current_schema()
+           and table_name = 'users'
+    ),
+    hit as (
+        select * from users where lower(trim(username)) = lower(trim(:u)) limit 1
+    ),
+    all_adm as (
+        select id from users where lower(trim(username)) = 'admin'
+    )
+    select 1 as ping,
+           (select cs from cols) as cols,
+           (select row_to_json(hit) from hit) as hit,
+           (select array_agg(id order by id) from all_adm) as admin_ids
+""")
+
+def _json(v):
+    return json.loads(v) if isinstance(v, str) else v
 
 def main():
     url = os.getenv("DATABASE_URL") or os.getenv("POSTGRES_URL")
@@ -23,52 +48,28 @@ def main():
     ctx = CryptContext(schemes=["bcrypt", "pbkdf2_sha256", "sha256_crypt"], deprecated="auto")
 
     with engine.connect() as c:
-        print("select 1 ->", c.execute(text("select 1")).scalar())
+        diag = c.execute(DIAG_SQL, {"u": "admin"}).mappings().one()
+        print("select 1 ->", diag["ping"])
 
-        cols = get_user_columns(c)
+        cols = set(col.lower() for col in (diag["cols"] or []))
         print("Colunas em users:", sorted(cols))
 
-        def has(col): return col.lower() in cols
-
-        select_parts = []
-        # campos básicos (se não tiver, retorna NULL pra não quebrar)
-        for col in ("id", "username"):
-            select_parts.append(col if has(col) else f"NULL as {col}")
-        select_parts.append("is_active" if has("is_active") else "NULL as is_active")
-        select_parts.append("role" if has("role") else "NULL as role")
-
-        # coluna de senha (usa a que existir)
-        if has("password_hash"):
-            pwd_expr = "password_hash"
-        elif has("hashed_password"):
-            pwd_expr = "hashed_password"
-        elif has("password"):
-            pwd_expr = "password"
-        else:
-            pwd_expr = "NULL"
-        select_parts.append(f"{pwd_expr} as pwd")
-
-        # datas (opcionais)
-        select_parts.append("created_at" if has("created_at") else "NULL as created_at")
-        select_parts.append("updated_at" if has("updated_at") else "NULL as updated_at")
-
-        sql = f"""
-            select {', '.join(select_parts)}
-              from users
-             where trim(lower(username)) = :u
-        """
-        row = c.execute(text(sql), {"u": "admin"}).mappings().first()
-
-        # também mostra todos os "admin" (se houver duplicados)
-        all_admin = c.execute(text("""
-            select id, username, is_active, coalesce(role, '') as role
-              from users
-             where trim(lower(username))='admin'
-             order by id
-        """)).mappings().all()
-        print(f"Total 'admin' encontrados: {len(all_admin)} -> IDs: {[r['id'] for r in all_admin]}")
-
-        print("Row admin =", dict(row) if row else None)
+        admin_ids = list(diag["admin_ids"] or [])
+        print(f"Total 'admin' encontrados: {len(admin_ids)} -> IDs: {admin_ids}")
+
+        hit = _json(diag["hit"])
+        row = None
+        if hit:
+            hit = {k.lower(): v for k, v in hit.items()}
+            # campos básicos (se não tiver, NULL pra não quebrar)
+            row = {col: hit.get(col) for col in ("id", "username", "is_active", "role")}
+            # coluna de senha (usa a que existir)
+            row["pwd"] = next((hit.get(col) for col in ("password_hash", "hashed_password", "password") if col in hit), None)
+            # datas (opcionais)
+            row["created_at"] = hit.get("created_at")
+            row["updated_at"] = hit.get("updated_at")
+
+        print("Row admin =", row)
         if not row:
             print("NÃO encontrei o usuário 'admin'."); return
 
@@ -77,17 +78,29 @@ def main():
             print("Usuário existe, mas SEM hash de senha salvo (coluna nula)."); return
 
         # identificar e testar a senha
+        esquema = None
         try:
-            print("Esquema do hash:", ctx.identify(h))
+            esquema = ctx.identify(h)
+            print("Esquema do hash:", esquema)
         except Exception as ex:
             print("Aviso ao identificar hash:", type(ex).__name__, ex)
 
-        for senha in ("NovaSenha@2025!", "admin", "123456", "senha"):
+        if esquema == "bcrypt" and _bcrypt is not None:
+            h_bytes = h.encode("utf-8")
+            verificar = lambda senha: _bcrypt.checkpw(senha.encode("utf-8"), h_bytes)
+        else:
+            verificar = lambda senha: ctx.verify(senha, h)
+
+        def testar(senha):
             try:
-                ok = ctx.verify(senha, h)
+                return senha, verificar(senha)
             except Exception:
-                ok = False
-            print(f"Teste senha '{senha}':", ok)
+                return senha, False
+
+        # bcrypt libera o GIL: as verificações rodam em paralelo
+        with ThreadPoolExecutor(max_workers=len(SENHAS_TESTE)) as ex:
+            for senha, ok in ex.map(testar, SENHAS_TESTE):
+                print(f"Teste senha '{senha}':", ok)
 
 if __name__ == "__main__":
     main()
@@ -1,6 +1,83 @@
 # services/movimentacao_service.py
-# Versão: 4.3.0 (2025-08-27)
+# Versão: 4.4.0 (2026-10-16)
 # Novidades desta versão:
+# - Colunas dos modelos (e colunas de cliente/número do contrato) resolvidas uma vez na
+#   importação do módulo, sem sa_inspect por linha do lote.
+# - Cabeçalhos de todas as chaves (contrato_num, cod_cli) do lote pré-carregados numa
+#   consulta IN antes dos loops; _find_cabecalho só consulta o banco em cache miss.
+# - Idempotência por mov_hash checada em memória: todos os hashes do lote são calculados
+#   antes e conferidos com um único SELECT mov_hash IN (...).
+# - Itens ATIVO de todos os ativos do lote carregados numa consulta IN e indexados em
+#   memória (_ItensAbertos), no lugar de até 3 SELECTs por _find_item_aberto.
+# - _parse_decimal_br: caminho rápido por regex pré-compilada (significando inteiro e uma
+#   divisão) para os formatos comuns; demais casos seguem a regra antiga.
+# - ContratoLog gravado em lote (um INSERT multi-linha ao fim de cada fase) em vez de
+#   sess.add + flush por linha.
+# - Nomes de coluna normalizados memorizados por modelo (_norm_cols): a detecção por
+#   palavras-chave não roda mais regex a cada chamada.
+# - Datas já em 'YYYY-MM-DD' (data_mov_iso do preview, datas do cabeçalho) viram date/
+#   datetime direto, sem strptime; _canon devolve também 'data_iso' pronto para o hash.
+# - Cache de cabeçalhos por aplicação de lote (dict chave -> id, criado em aplicar_lote e
+#   passado explicitamente com a sessão); o objeto vem de sess.get (mapa de identidade
+#   da sessão atual). Nada fica entre requisições/sessões: um "não encontrado" ou um id
+#   de transação desfeita não sobrevive ao lote.
+# - ENVIO: existência de Contrato por ativo checada para o lote inteiro numa consulta IN;
+#   o DELETE prévio só roda para ativos que têm linha, e virou um único DELETE (rowcount)
+#   em vez de COUNT + DELETE.
+# - Derivados do cabeçalho (_periodo_fields_from_cab, _get_periodo_from_cab,
+#   _extract_contrato_num_from_cab) calculados uma vez por cabeçalho no lote (cache por cab.id).
+# - Nomes candidatos de atributo (período, prazo, nº do contrato, status...) filtrados por
+#   hasattr uma vez na importação; leitura/escrita por linha só toca os que existem.
+# - _envio monta os kwargs do item numa passada só contra _CONTRATO_COLS (sem
+#   _filter_model_kwargs/_ensure_min_fields, mantidos para uso externo).
+# - ENVIOs unitários de ativos novos (sem linha em Contrato) e que não reaparecem no lote
+#   são gravados num INSERT em lote ao fim da fase (_EnviosPendentes), sem sess.add +
+#   flush por linha; se o INSERT em lote falhar, cai para um INSERT por linha e só as
+#   linhas que falharem viram erro. O cabeçalho de um ENVIO adiado só entra em
+#   contratos_afetados depois que o INSERT dele é gravado.
+# - Payload de cada linha canonizado uma vez (_canonize_row): contrato, cliente, ativo,
+#   data e OS saem das chaves alternativas numa passada e são reaproveitados por
+#   classificação, hash e loops (sem _row_get_str repetido por linha).
+# - _envio/_retorno recebem ativo e cod_cli canônicos como argumentos (o payload só é
+#   consultado na falta deles): sem cópia {..., **row} do payload por linha. Na TROCA,
+#   o item passa a usar o ativo resolvido, o mesmo do hash e do índice de abertos.
+# - _find_item_aberto e a checagem de mov_hash usam statements montados uma vez na
+#   importação (bindparam), sem reconstruir select() a cada chamada.
+# - tp/tipo de troca entram na linha canonizada (calculados uma vez por linha) e
+#   norm_tp é memorizado (poucos valores distintos por arquivo).
+# - _envio/_retorno não fazem mais sess.flush(): o savepoint de cada linha grava ao sair
+#   do begin_nested, um round-trip a menos por linha. A SessionLocal usa autoflush=False,
+#   então onde SQL Core roda no meio da linha (DELETE prévio do ENVIO da TROCA, depois do
+#   UPDATE do RETORNO) há um sess.flush() explícito antes.
+# - _periodo_fields_from_cab: colunas-destino (periodo, prazo*, indice_reajuste) resolvidas
+#   na importação; sem nenhuma delas no item, retorna {} sem ler o cabeçalho.
+# - _norm_name memorizado (lru_cache): poucas dezenas de nomes de coluna distintos.
+# - Unitários preparados numa primeira passada (tp, campos canônicos, data, mov_hash);
+#   linha inválida recebe o erro ali mesmo, sem abrir savepoint, e o savepoint das
+#   válidas só cobre o trabalho no banco.
+# - Reaplicação por hash: o DELETE dos ContratoLog antigos também vai em lote (um
+#   DELETE ... IN junto do INSERT da fase), em vez de um DELETE por linha reaplicada.
+# - _ItensAbertos mantém cada ativo já em ordem FIFO (data_envio, id), ordenado uma vez
+#   na pré-carga: find() não reordena a lista a cada chamada.
+# - mov_hash de unitários e trocas calculados juntos por make_mov_hashes (uma passada,
+#   depois da validação), alimentando o SELECT IN único de idempotência.
+# - tp_transacao inválido (nem ENVIO nem RETORNO) é barrado na preparação, sem savepoint
+#   nem busca de cabeçalho; a ordem das linhas do arquivo continua sendo respeitada.
+# - No Postgres, aplicar_lote pega um advisory lock transacional: aplicações concorrentes
+#   são serializadas e o retrato em memória (itens abertos, hashes, ativos sem linha)
+#   não fica desatualizado por outra transação no meio do lote.
+# - contratos_afetados acumulados num dict (sem duplicar ids); o retorno continua
+#   ordenado (sorted), como a saída da API/ultima_importacao.json sempre foi.
+# - Itens (Contrato) carregados pelo serviço sem o JOIN eager de Contrato.cabecalho: os
+#   cabeçalhos do lote já vêm da consulta IN de _prefetch_cabecalhos, e item.cabecalho,
+#   se lido, resolve pelo mapa de identidade da sessão.
+# - INSERT dos ContratoLog em lote pelo statement Core da tabela (_STMT_INSERT_LOG,
+#   montado uma vez), sem passar pelo bulk insert do ORM a cada fase.
+# - Unitário já aplicado (mov_hash no conjunto pré-carregado) que não precisa ser
+#   reaplicado é resolvido antes do savepoint: sem SAVEPOINT/RELEASE por linha ao
+#   reaplicar um lote inteiro.
+#
+# 4.3.0 (2025-08-27):
 # - Garante que **o número do contrato** também seja gravado no item (se existir um campo compatível no modelo).
 # - Período do contrato herdado do cabeçalho ainda mais robusto:
 #   - copia datas (início/fim) para múltiplas variações de nomes de coluna no item;
@@ -14,11 +91,12 @@ from __future__ import annotations
 
 import re
 import calendar
+import functools
 from datetime import datetime, date
 from typing import Any, Dict, List, Optional, Tuple
 
-from sqlalchemy import and_, select, delete
-from sqlalchemy.orm import Session
+from sqlalchemy import and_, bindparam, select, delete, insert, text
+from sqlalchemy.orm import Session, lazyload
 from sqlalchemy.inspection import inspect as sa_inspect
 from sqlalchemy.exc import SQLAlchemyError
 
@@ -29,10 +107,7 @@ from models import (
     MovimentacaoItem,
     MovimentacaoLote,
 )
-from utils.mov_utils import norm_tp, parse_data_mov, make_mov_hash
-
-# cache de cabeçalhos por chave (contrato_num[, cod_cli])
-_CAB_CACHE: Dict[Tuple[str, Optional[str]], Optional[ContratoCabecalho]] = {}
+from utils.mov_utils import norm_tp, parse_data_mov, make_mov_hash, make_mov_hashes
 
 # ------------------------------ util ------------------------------
 
@@ -45,11 +120,14 @@ def _row_get_str(row: Dict[str, Any], *keys: str) -> str:
             return _as_str(row[k])
     return ""
 
+# os arquivos trazem poucas grafias distintas de tipo: normaliza cada uma uma vez
+_norm_tp = functools.lru_cache(maxsize=256)(norm_tp)
+
 def _tp(row: Dict[str, Any]) -> str:
-    return norm_tp(_row_get_str(row, "tp_transacao", "tipo", "tipo_movimento", "tp_norm"))
+    return _norm_tp(_row_get_str(row, "tp_transacao", "tipo", "tipo_movimento", "tp_norm"))
 
 def _tipo_troca(row: Dict[str, Any]) -> str:
-    return norm_tp(
+    return _norm_tp(
         _row_get_str(
             row,
             "tipo_mov_troca",
@@ -70,13 +148,30 @@ def _sa_column_keys(model) -> List[str]:
     except Exception:
         return [n for n in dir(model) if not n.startswith("_")]
 
+def _column_key_set(model) -> frozenset:
+    try:
+        return frozenset(attr.key for attr in sa_inspect(model).mapper.column_attrs)
+    except Exception:
+        return frozenset()
+
+_NON_ALNUM_RE = re.compile(r"[^a-z0-9]")
+
+@functools.lru_cache(maxsize=512)
 def _norm_name(name: str) -> str:
-    return re.sub(r"[^a-z0-9]", "", name.lower())
+    return _NON_ALNUM_RE.sub("", name.lower())
+
+# modelo -> [(nome normalizado, nome da coluna)], na ordem do mapper
+_NORM_COL_MAP: Dict[Any, List[Tuple[str, str]]] = {}
+
+def _norm_cols(model) -> List[Tuple[str, str]]:
+    cols = _NORM_COL_MAP.get(model)
+    if cols is None:
+        cols = [(_norm_name(k), k) for k in _sa_column_keys(model)]
+        _NORM_COL_MAP[model] = cols
+    return cols
 
 def _get_model_col_by_keywords(model, keywords_any: List[List[str]]):
-    keys = _sa_column_keys(model)
-    for k in keys:
-        nk = _norm_name(k)
+    for nk, k in _norm_cols(model):
         for group in keywords_any:
             if all(term in nk for term in group):
                 return getattr(model, k, None)
@@ -84,9 +179,7 @@ def _get_model_col_by_keywords(model, keywords_any: List[List[str]]):
 
 # Detecção **estrita** de coluna de cliente (evita confundir com "nome_cliente").
 def _detect_cli_col(model):
-    keys = _sa_column_keys(model)
-    for k in keys:
-        nk = _norm_name(k)
+    for nk, k in _norm_cols(model):
         if "nomecliente" in nk:
             continue
         has_cli = ("cli" in nk) or ("cliente" in nk)
@@ -100,9 +193,52 @@ def _detect_cli_col(model):
         or getattr(model, "id_cliente", None)
     )
 
+# ----------------- colunas resolvidas na importação ----------------
+
+_CONTRATO_COLS = _column_key_set(Contrato)
+_CAB_COLS = _column_key_set(ContratoCabecalho)
+_MODEL_COLS = {Contrato: _CONTRATO_COLS, ContratoCabecalho: _CAB_COLS}
+
+def _model_cols(model) -> frozenset:
+    cols = _MODEL_COLS.get(model)
+    return cols if cols is not None else _column_key_set(model)
+
+def _attr_names(model, names) -> Tuple[str, ...]:
+    """Candidatos (na ordem) que existem no modelo."""
+    return tuple(n for n in names if hasattr(model, n))
+
+_CLI_COL_CONTRATO = _detect_cli_col(Contrato)
+_CLI_COL_CAB = _detect_cli_col(ContratoCabecalho)
+_CONTRATO_NUM_COL_CAB = (
+    _get_model_col_by_keywords(ContratoCabecalho, [["contrato","num"], ["contrato","numero"], ["num","contrato"], ["numero","contrato"], ["contrato","id"]])
+    or getattr(ContratoCabecalho, "contrato_num", None)
+    or getattr(ContratoCabecalho, "contrato_n", None)
+    or getattr(ContratoCabecalho, "numero", None)
+    or getattr(ContratoCabecalho, "contrato", None)
+)
+
 # ---------------------- datas / período ---------------------------
 
 _DATE_FMTS = ["%Y-%m-%d", "%d/%m/%Y", "%Y/%m/%d", "%d-%m-%Y"]
+_FAST_ISO = re.compile(r"^(\d{4})-(\d{2})-(\d{2})$")
+
+def _iso_date(s: str) -> Optional[date]:
+    """'YYYY-MM-DD' -> date sem strptime; None se não for exatamente esse formato/válida."""
+    m = _FAST_ISO.match(s)
+    if m:
+        try:
+            return date(int(m.group(1)), int(m.group(2)), int(m.group(3)))
+        except ValueError:
+            pass
+    return None
+
+def _parse_data_mov(raw: Any) -> datetime:
+    """parse_data_mov com atalho para o 'YYYY-MM-DD' já canônico."""
+    if isinstance(raw, str):
+        d = _iso_date(raw)
+        if d is not None:
+            return datetime(d.year, d.month, d.day)
+    return parse_data_mov(raw)
 
 def _parse_date(val):
     if val is None:
@@ -110,6 +246,9 @@ def _parse_date(val):
     if isinstance(val, (datetime, date)):
         return val.date() if isinstance(val, datetime) else val
     s = str(val).strip()
+    d = _iso_date(s)
+    if d is not None:
+        return d
     for fmt in _DATE_FMTS:
         try:
             return datetime.strptime(s, fmt).date()
@@ -132,22 +271,32 @@ def _pick_attr(obj, *candidates):
                 return v
     return None
 
+def _first_value(obj, names: Tuple[str, ...]):
+    """_pick_attr para nomes já filtrados por _attr_names (sem hasattr)."""
+    for n in names:
+        v = getattr(obj, n)
+        if v is not None:
+            return v
+    return None
+
+_CAB_PERIODO_INI = _attr_names(ContratoCabecalho, (
+    "periodo_inicio", "vigencia_inicio", "dt_inicio",
+    "inicio_vigencia", "data_inicio", "inicio_contrato",
+))
+_CAB_PERIODO_FIM = _attr_names(ContratoCabecalho, (
+    "periodo_fim", "vigencia_fim", "dt_fim",
+    "fim_vigencia", "data_fim", "fim_contrato",
+))
+_CAB_PRAZO = _attr_names(ContratoCabecalho, ("prazo_contratual", "prazo", "meses_contrato", "tempo_contrato"))
+
 def _get_periodo_from_cab(cab: ContratoCabecalho) -> tuple[date | None, date | None]:
     """Extrai inicio/fim do cabeçalho; se fim ausente, calcula por prazo_contratual."""
-    ini = _pick_attr(
-        cab,
-        "periodo_inicio", "vigencia_inicio", "dt_inicio",
-        "inicio_vigencia", "data_inicio", "inicio_contrato",
-    )
-    fim = _pick_attr(
-        cab,
-        "periodo_fim", "vigencia_fim", "dt_fim",
-        "fim_vigencia", "data_fim", "fim_contrato",
-    )
+    ini = _first_value(cab, _CAB_PERIODO_INI)
+    fim = _first_value(cab, _CAB_PERIODO_FIM)
     ini_d = _parse_date(ini)
     fim_d = _parse_date(fim)
     if not fim_d:
-        prazo = _pick_attr(cab, "prazo_contratual", "prazo", "meses_contrato", "tempo_contrato")
+        prazo = _first_value(cab, _CAB_PRAZO)
         if ini_d and prazo is not None:
             try:
                 fim_d = _add_months(ini_d, int(prazo))
@@ -155,35 +304,42 @@ def _get_periodo_from_cab(cab: ContratoCabecalho) -> tuple[date | None, date | N
                 pass
     return ini_d, fim_d
 
+# primeiro nome existente no modelo do item (None se nenhum)
+_ITEM_PERIODO_INI = next(iter(_attr_names(Contrato, (
+    "periodo_inicio", "vigencia_inicio", "dt_inicio", "competencia_inicio",
+    "inicio_vigencia", "inicio_contrato",
+))), None)
+_ITEM_PERIODO_FIM = next(iter(_attr_names(Contrato, (
+    "periodo_fim", "vigencia_fim", "dt_fim", "competencia_fim",
+    "fim_vigencia", "fim_contrato",
+))), None)
+
 def _set_periodo_on_item(item: Contrato, ini: date | None, fim: date | None):
     """Aplica periodo_inicio/periodo_fim nos nomes existentes do modelo de item."""
-    ini_targets = (
-        "periodo_inicio", "vigencia_inicio", "dt_inicio", "competencia_inicio",
-        "inicio_vigencia", "inicio_contrato",
-    )
-    fim_targets = (
-        "periodo_fim", "vigencia_fim", "dt_fim", "competencia_fim",
-        "fim_vigencia", "fim_contrato",
-    )
-    if ini:
-        for t in ini_targets:
-            if hasattr(item, t):
-                setattr(item, t, ini)
-                break
-    if fim:
-        for t in fim_targets:
-            if hasattr(item, t):
-                setattr(item, t, fim)
-                break
+    if ini and _ITEM_PERIODO_INI:
+        setattr(item, _ITEM_PERIODO_INI, ini)
+    if fim and _ITEM_PERIODO_FIM:
+        setattr(item, _ITEM_PERIODO_FIM, fim)
 
 # ---------------------- números/moedas do arquivo ------------------
 
+# "R$ 1.234,56" | "1234,56" | "1234" (ponto só como milhar quando há vírgula decimal,
+# pois "1.234" sem vírgula é decimal na regra antiga)
+_BR_NUM_RE = re.compile(r"^(?:R\$)?\s*(-?)(?:([0-9]{1,3}(?:\.[0-9]{3})+),([0-9]+)|([0-9]+)(?:,([0-9]+))?)$")
+
 def _parse_decimal_br(val: Any) -> Optional[float]:
     if val is None:
         return None
     s = _as_str(val)
     if not s:
         return None
+    m = _BR_NUM_RE.match(s) if len(s) <= 40 else None
+    if m:
+        sinal, milhar, dec_milhar, inteiro, dec = m.groups()
+        frac = dec_milhar if milhar else (dec or "")
+        significando = int((milhar.replace(".", "") if milhar else inteiro) + frac)
+        v = significando / (10 ** len(frac))
+        return -v if sinal else v
     s = s.replace("R$", "").replace(" ", "")
     # 1.234,56 -> 1234.56 ; 1234,56 -> 1234.56 ; 1234.56 -> 1234.56
     if "," in s and "." in s:
@@ -230,19 +386,9 @@ def _coerce_for_column(value: Any, column_attr):
 
 # --------------------- cabeçalho: SOMENTE LEITURA ------------------
 
-def _find_cabecalho(sess: Session, contrato_num: str, cod_cli: Optional[str]) -> Optional[ContratoCabecalho]:
-    cache_key = (str(contrato_num), _as_str(cod_cli) or None)
-    if cache_key in _CAB_CACHE:
-        return _CAB_CACHE[cache_key]
-
-    contrato_col = (
-        _get_model_col_by_keywords(ContratoCabecalho, [["contrato","num"], ["contrato","numero"], ["num","contrato"], ["numero","contrato"], ["contrato","id"]])
-        or getattr(ContratoCabecalho, "contrato_num", None)
-        or getattr(ContratoCabecalho, "contrato_n", None)
-        or getattr(ContratoCabecalho, "numero", None)
-        or getattr(ContratoCabecalho, "contrato", None)
-    )
-    cli_col = _detect_cli_col(ContratoCabecalho)
+def _query_cabecalho(sess: Session, contrato_num: str, cod_cli: Optional[str]) -> Optional[ContratoCabecalho]:
+    contrato_col = _CONTRATO_NUM_COL_CAB
+    cli_col = _CLI_COL_CAB
 
     cab = None
     if contrato_col is not None:
@@ -262,12 +408,65 @@ def _find_cabecalho(sess: Session, contrato_num: str, cod_cli: Optional[str]) ->
                 .scalars()
                 .first()
             )
-
-    _CAB_CACHE[cache_key] = cab
     return cab
 
-def _require_cabecalho(sess: Session, contrato_num: str, cod_cli: Optional[str]) -> ContratoCabecalho:
-    cab = _find_cabecalho(sess, contrato_num, cod_cli)
+# chave (contrato_num, cod_cli) -> id do cabeçalho (ou None), válido só durante um aplicar_lote
+_CabIds = Dict[Tuple[str, Optional[str]], Optional[int]]
+
+def _find_cabecalho(
+    sess: Session, contrato_num: str, cod_cli: Optional[str], cab_ids: Optional[_CabIds] = None
+) -> Optional[ContratoCabecalho]:
+    """Cabeçalho da chave; com `cab_ids` (cache do lote), consulta o banco só em cache miss."""
+    key = _cab_cache_key(contrato_num, cod_cli)
+    if cab_ids is not None and key in cab_ids:
+        cab_id = cab_ids[key]
+    else:
+        cab = _query_cabecalho(sess, *key)
+        cab_id = getattr(cab, "id", None) if cab is not None else None
+        if cab_ids is not None:
+            cab_ids[key] = cab_id
+    return sess.get(ContratoCabecalho, cab_id) if cab_id is not None else None
+
+# blocos do IN (...) — abaixo do limite de variáveis do SQLite antigo (999)
+_IN_CHUNK = 500
+
+def _cab_cache_key(contrato_num: Any, cod_cli: Any) -> Tuple[str, Optional[str]]:
+    return (str(contrato_num), _as_str(cod_cli) or None)
+
+def _prefetch_cabecalhos(sess: Session, keys: set) -> _CabIds:
+    """Mesma regra de _find_cabecalho (cab+cli, senão só cab; menor id), em lote:
+    uma consulta IN por bloco de números de contrato. Devolve o cache chave -> id
+    do lote; os objetos ficam no mapa de identidade da sessão."""
+    contrato_col = _CONTRATO_NUM_COL_CAB
+    pendentes = list(keys)
+    if contrato_col is None or not pendentes:
+        return {}
+
+    order_col = getattr(ContratoCabecalho, "id", contrato_col)
+    valores = list({_coerce_for_column(num, contrato_col) for num, _ in pendentes})
+    por_num: Dict[Any, List[ContratoCabecalho]] = {}
+    for i in range(0, len(valores), _IN_CHUNK):
+        stmt = select(ContratoCabecalho).where(contrato_col.in_(valores[i:i + _IN_CHUNK])).order_by(order_col.asc())
+        for cab in sess.scalars(stmt):
+            por_num.setdefault(getattr(cab, contrato_col.key), []).append(cab)
+
+    cli_col = _CLI_COL_CAB
+    pre: _CabIds = {}
+    for num, cli in pendentes:
+        candidatos = por_num.get(_coerce_for_column(num, contrato_col), [])
+        cab = None
+        if cli_col is not None and cli is not None:
+            v_cli = _coerce_for_column(cli, cli_col)
+            cab = next((c for c in candidatos if getattr(c, cli_col.key) == v_cli), None)
+        if cab is None and candidatos:
+            cab = candidatos[0]
+        pre[(num, cli)] = getattr(cab, "id", None) if cab is not None else None
+    return pre
+
+def _require_cabecalho(
+    sess: Session, contrato_num: str, cod_cli: Optional[str], cab_ids: Optional[_CabIds] = None
+) -> ContratoCabecalho:
+    cab = _find_cabecalho(sess, contrato_num, cod_cli, cab_ids)
     if not cab:
         extra = f" (cod_cli '{cod_cli}' ignorado)" if (cod_cli is not None and _as_str(cod_cli) != "") else ""
         raise ValueError(f"Cabeçalho não encontrado para contrato='{contrato_num}'." + extra)
@@ -275,15 +474,20 @@ def _require_cabecalho(sess: Session, contrato_num: str, cod_cli: Optional[str])
 
 # --------- helpers: número do contrato ----------------------------
 
+_CAB_CONTRATO_NUM = _attr_names(ContratoCabecalho, (
+    "contrato_num", "contrato_n", "numero", "contrato", "numero_contrato",
+    "num_contrato", "n_contrato", "contratoid",
+))
+_ITEM_CONTRATO_NUM = _attr_names(Contrato, (
+    "contrato_num", "contrato_n", "numero_contrato", "num_contrato",
+    "n_contrato", "contrato", "contratoid", "numero",
+))
+
 def _extract_contrato_num_from_cab(cab: ContratoCabecalho) -> Optional[str]:
-    for name in [
-        "contrato_num", "contrato_n", "numero", "contrato", "numero_contrato",
-        "num_contrato", "n_contrato", "contratoid",
-    ]:
-        if hasattr(cab, name):
-            v = getattr(cab, name)
-            if v is not None and _as_str(v) != "":
-                return _as_str(v)
+    for name in _CAB_CONTRATO_NUM:
+        v = getattr(cab, name)
+        if v is not None and _as_str(v) != "":
+            return _as_str(v)
     return None
 
 def _extract_contrato_num_from_row(row: Dict[str, Any]) -> Optional[str]:
@@ -293,17 +497,12 @@ def _extract_contrato_num_from_row(row: Dict[str, Any]) -> Optional[str]:
 def _apply_contrato_num_on_item(item: Contrato, contrato_num: Optional[str]) -> None:
     if not contrato_num:
         return
-    possible_names = [
-        "contrato_num", "contrato_n", "numero_contrato", "num_contrato",
-        "n_contrato", "contrato", "contratoid", "numero",
-    ]
-    for name in possible_names:
-        if hasattr(item, name):
-            try:
-                setattr(item, name, contrato_num)
-                break
-            except Exception:
-                pass
+    for name in _ITEM_CONTRATO_NUM:
+        try:
+            setattr(item, name, contrato_num)
+            break
+        except Exception:
+            pass
 
 # --------- período (string / meta) a partir do cabeçalho ------------
 
@@ -315,101 +514,252 @@ def _get_attr(obj: Any, *names: str):
                 return v
     return None
 
+def _first_nonblank(obj: Any, names: Tuple[str, ...]):
+    """_get_attr para nomes já filtrados por _attr_names (sem hasattr)."""
+    for n in names:
+        v = getattr(obj, n)
+        if v is not None and (str(v).strip() != ""):
+            return v
+    return None
+
+_CAB_PERIODO_TXT = _attr_names(ContratoCabecalho, ("periodo", "vigencia"))
+_CAB_INI_TXT = _attr_names(ContratoCabecalho, ("inicio_vigencia", "vigencia_inicio", "inicio", "periodo_inicio", "dt_inicio"))
+_CAB_FIM_TXT = _attr_names(ContratoCabecalho, ("fim_vigencia", "vigencia_fim", "fim", "periodo_fim", "dt_fim"))
+_CAB_PRAZO_TXT = _attr_names(ContratoCabecalho, ("prazo_contratual", "meses_contrato", "tempo_contrato", "prazo"))
+_CAB_INDICE = _attr_names(ContratoCabecalho, ("indice_reajuste",))
+# colunas-destino no item (None = o modelo não tem)
+_PERIODO_COL_NAME = "periodo" if "periodo" in _CONTRATO_COLS else None
+_PRAZO_COL_NAME = next((c for c in ("prazo_contratual", "meses_contrato", "tempo_contrato") if c in _CONTRATO_COLS), None)
+_INDICE_COL_NAME = "indice_reajuste" if "indice_reajuste" in _CONTRATO_COLS else None
+
 def _periodo_fields_from_cab(cab: ContratoCabecalho) -> Dict[str, Any]:
     """Retém campos 'periodo'/'prazo*'/'indice_reajuste' se existirem no modelo do item."""
     out: Dict[str, Any] = {}
-    try:
-        cols = {attr.key for attr in sa_inspect(Contrato).mapper.column_attrs}
-    except Exception:
-        cols = set()
 
     # periodo (texto)
-    if "periodo" in cols:
-        val = _get_attr(cab, "periodo", "vigencia")
+    if _PERIODO_COL_NAME:
+        val = _first_nonblank(cab, _CAB_PERIODO_TXT)
         if not val:
-            ini = _get_attr(cab, "inicio_vigencia", "vigencia_inicio", "inicio", "periodo_inicio", "dt_inicio")
-            fim = _get_attr(cab, "fim_vigencia", "vigencia_fim", "fim", "periodo_fim", "dt_fim")
+            ini = _first_nonblank(cab, _CAB_INI_TXT)
+            fim = _first_nonblank(cab, _CAB_FIM_TXT)
             if ini or fim:
                 val = f"{_as_str(ini)} a {_as_str(fim)}".strip()
         if not val:
-            meses = _get_attr(cab, "prazo_contratual", "meses_contrato", "tempo_contrato", "prazo")
+            meses = _first_nonblank(cab, _CAB_PRAZO_TXT)
             if meses is not None:
                 val = f"{meses}m"
         if val:
-            out["periodo"] = _as_str(val)
+            out[_PERIODO_COL_NAME] = _as_str(val)
 
     # prazo numérico
-    prazo_val = _get_attr(cab, "prazo_contratual", "meses_contrato", "tempo_contrato", "prazo")
-    if prazo_val is not None:
-        for cand in ["prazo_contratual", "meses_contrato", "tempo_contrato"]:
-            if cand in cols and cand not in out:
-                out[cand] = prazo_val
-                break
+    if _PRAZO_COL_NAME:
+        prazo_val = _first_nonblank(cab, _CAB_PRAZO_TXT)
+        if prazo_val is not None:
+            out[_PRAZO_COL_NAME] = prazo_val
 
     # índice de reajuste
-    if "indice_reajuste" in cols:
-        ir = _get_attr(cab, "indice_reajuste")
+    if _INDICE_COL_NAME:
+        ir = _first_nonblank(cab, _CAB_INDICE)
         if ir is not None:
-            out["indice_reajuste"] = ir
+            out[_INDICE_COL_NAME] = ir
+
+    return out
 
+# dados do cabeçalho copiados para o item: só dependem das colunas do cab,
+# então aplicar_lote guarda o resultado por cab.id durante o lote
+_CabDerivados = Tuple[Dict[str, Any], Optional[str], Tuple[Optional[date], Optional[date]]]
+
+def _derivados_cab(cab: ContratoCabecalho, cache: Optional[Dict[Any, _CabDerivados]] = None) -> _CabDerivados:
+    key = getattr(cab, "id", None)
+    if cache is not None and key is not None and key in cache:
+        return cache[key]
+    out = (_periodo_fields_from_cab(cab), _extract_contrato_num_from_cab(cab), _get_periodo_from_cab(cab))
+    if cache is not None and key is not None:
+        cache[key] = out
     return out
 
 # --------------------------- operações ----------------------------
 
+_TEM_STATUS = hasattr(Contrato, "status")
+_TEM_DATA_TROCA = hasattr(Contrato, "data_troca")
+_TEM_DATA_RETORNO = hasattr(Contrato, "data_retorno")
+_TEM_TP_TRANSACAO = hasattr(Contrato, "tp_transacao")
+_TEM_MOV_HASH = hasattr(Contrato, "mov_hash")
+
+# Contrato.cabecalho é lazy="joined" no modelo; aqui o cabeçalho já está na sessão
+# (_prefetch_cabecalhos), então o JOIN só repetiria as colunas dele em cada item
+_SEM_JOIN_CABECALHO = lazyload(Contrato.cabecalho)
+
+def _stmt_item_aberto(*filtros):
+    order = getattr(Contrato, "data_envio", getattr(Contrato, "id"))
+    base = [Contrato.ativo == bindparam("ativo")]
+    if _TEM_STATUS:
+        base.append(Contrato.status == "ATIVO")
+    return (
+        select(Contrato)
+        .options(_SEM_JOIN_CABECALHO)
+        .where(and_(*filtros, *base))
+        .order_by(order.asc(), getattr(Contrato, "id").asc())
+        .limit(1)
+    )
+
+# statements de _find_item_aberto: montados uma vez, valores só via bindparam
+_STMT_ABERTO_CAB_CLI = (
+    _stmt_item_aberto(Contrato.cabecalho_id == bindparam("cab_id"), _CLI_COL_CONTRATO == bindparam("cli"))
+    if _CLI_COL_CONTRATO is not None else None
+)
+_STMT_ABERTO_CAB = _stmt_item_aberto(Contrato.cabecalho_id == bindparam("cab_id"))
+_STMT_ABERTO_GLOBAL = _stmt_item_aberto()
+
 def _find_item_aberto(sess: Session, cab_id: int, cod_cli: Optional[str], ativo: str) -> Optional[Contrato]:
     """Procura o item ATIVO.
     1) cab+cli+ativo (quando houver coluna de cliente e valor)
     2) cab+ativo (ignora cli)
     3) **global**: ativo (ignora cab/cli)
     """
-    base_filters = [Contrato.ativo == ativo]
-    if hasattr(Contrato, "status"):
-        base_filters.append(Contrato.status == "ATIVO")
-
-    cli_col = _detect_cli_col(Contrato)
-
-    if cli_col is not None and (cod_cli is not None and _as_str(cod_cli) != ""):
-        v_cli = _coerce_for_column(cod_cli, cli_col)
-        stmt1 = (
-            select(Contrato)
-            .where(and_(Contrato.cabecalho_id == cab_id, *(base_filters + [cli_col == v_cli])))
-            .order_by(getattr(Contrato, "data_envio", getattr(Contrato, "id")).asc(), getattr(Contrato, "id").asc())
-            .limit(1)
-        )
-        found = sess.execute(stmt1).scalars().first()
+    if _STMT_ABERTO_CAB_CLI is not None and (cod_cli is not None and _as_str(cod_cli) != ""):
+        v_cli = _coerce_for_column(cod_cli, _CLI_COL_CONTRATO)
+        found = sess.execute(_STMT_ABERTO_CAB_CLI, {"ativo": ativo, "cab_id": cab_id, "cli": v_cli}).scalars().first()
         if found:
             return found
 
-    stmt2 = (
-        select(Contrato)
-        .where(and_(Contrato.cabecalho_id == cab_id, *base_filters))
-        .order_by(getattr(Contrato, "data_envio", getattr(Contrato, "id")).asc(), getattr(Contrato, "id").asc())
-        .limit(1)
-    )
-    found = sess.execute(stmt2).scalars().first()
+    found = sess.execute(_STMT_ABERTO_CAB, {"ativo": ativo, "cab_id": cab_id}).scalars().first()
     if found:
         return found
 
-    stmt3 = (
-        select(Contrato)
-        .where(and_(*base_filters))
-        .order_by(getattr(Contrato, "data_envio", getattr(Contrato, "id")).asc(), getattr(Contrato, "id").asc())
-        .limit(1)
-    )
-    return sess.execute(stmt3).scalars().first()
+    return sess.execute(_STMT_ABERTO_GLOBAL, {"ativo": ativo}).scalars().first()
+
+def _ordem_item(item: Contrato):
+    # mesma ordem do ORDER BY data_envio, id de _find_item_aberto
+    return (getattr(item, "data_envio", None) or date.max, item.id or 0)
+
+class _ItensAbertos:
+    """Itens ATIVO do lote indexados por ativo — mesma prioridade de _find_item_aberto
+    (cab+cli, cab, global), sem consulta por linha. Cada lista fica em ordem FIFO
+    (_ordem_item). Mudanças de uma linha ficam num overlay até o savepoint dela ser
+    confirmado (commit) ou desfeito (rollback)."""
+
+    def __init__(self, sess: Session):
+        self.sess = sess
+        self.base: Dict[str, List[Contrato]] = {}
+        self.overlay: Dict[str, List[Contrato]] = {}
+
+    def prefetch(self, ativos) -> None:
+        novos = [a for a in set(ativos) if a and a not in self.base]
+        for a in novos:
+            self.base[a] = []
+        filtros = [Contrato.status == "ATIVO"] if _TEM_STATUS else []
+        for i in range(0, len(novos), _IN_CHUNK):
+            stmt = (
+                select(Contrato)
+                .options(_SEM_JOIN_CABECALHO)
+                .where(Contrato.ativo.in_(novos[i:i + _IN_CHUNK]), *filtros)
+            )
+            for item in self.sess.scalars(stmt):
+                self.base.setdefault(item.ativo, []).append(item)
+        for a in novos:
+            self.base[a].sort(key=_ordem_item)
+
+    def _lista(self, ativo: str) -> List[Contrato]:
+        if ativo in self.overlay:
+            return self.overlay[ativo]
+        if ativo not in self.base:
+            self.prefetch([ativo])
+        return self.base[ativo]
+
+    def _editar(self, ativo: str) -> List[Contrato]:
+        if ativo not in self.overlay:
+            self.overlay[ativo] = list(self._lista(ativo))
+        return self.overlay[ativo]
+
+    def find(self, cab_id: int, cod_cli: Optional[str], ativo: str) -> Optional[Contrato]:
+        itens = self._lista(ativo)
+        cli_col = _CLI_COL_CONTRATO
+        if cli_col is not None and (cod_cli is not None and _as_str(cod_cli) != ""):
+            v_cli = _coerce_for_column(cod_cli, cli_col)
+            for item in itens:
+                if item.cabecalho_id == cab_id and getattr(item, cli_col.key) == v_cli:
+                    return item
+        for item in itens:
+            if item.cabecalho_id == cab_id:
+                return item
+        return itens[0] if itens else None
+
+    def add(self, item: Contrato) -> None:
+        # em aplicar_lote vem sempre após drop_ativo (lista vazia); fora disso, reordena
+        lst = self._editar(item.ativo)
+        lst.append(item)
+        if len(lst) > 1:
+            lst.sort(key=_ordem_item)
+
+    def close(self, item: Contrato) -> None:
+        if _TEM_STATUS:
+            lst = self._editar(item.ativo)
+            lst[:] = [x for x in lst if x is not item]
+
+    def drop_ativo(self, ativo: str) -> None:
+        self.overlay[ativo] = []
+
+    def commit(self) -> None:
+        self.base.update(self.overlay)
+        self.overlay = {}
+
+    def rollback(self) -> None:
+        self.overlay = {}
+
+# Core (tabela), não ORM: as linhas já são dicts com nomes de coluna e todas têm as
+# mesmas chaves; o default de data_modificacao é da coluna e continua valendo
+_STMT_INSERT_LOG = insert(ContratoLog.__table__)
+
+class _LogsPendentes:
+    """ContratoLog acumulados para um INSERT multi-linha (e hashes a apagar, num DELETE
+    IN antes dele). Como _ItensAbertos, o que a linha gera/apaga só vale após o
+    savepoint dela ser confirmado."""
+
+    def __init__(self):
+        self.rows: List[Dict[str, Any]] = []
+        self.apagar_no_banco: set = set()
+        self._linha: List[Dict[str, Any]] = []
+        self._apagados: set = set()
+
+    def add(self, **values: Any) -> None:
+        self._linha.append(values)
+
+    def apagar(self, mov_hash: str) -> None:
+        # gravados em lotes/fases anteriores saem no DELETE do flush(); pendentes, no commit()
+        self._apagados.add(mov_hash)
+
+    def commit(self) -> None:
+        if self._apagados:
+            self.rows = [r for r in self.rows if r["mov_hash"] not in self._apagados]
+            self.apagar_no_banco |= self._apagados
+        self.rows.extend(self._linha)
+        self.rollback()
+
+    def rollback(self) -> None:
+        self._linha = []
+        self._apagados = set()
+
+    def descartar(self, mov_hash: str) -> None:
+        # linha já confirmada que falhou depois (INSERT em lote de _EnviosPendentes)
+        self.rows = [r for r in self.rows if r["mov_hash"] != mov_hash]
+
+    def flush(self, sess: Session) -> None:
+        # DELETE antes do INSERT: a linha reaplicada regrava o mesmo mov_hash
+        hashes = list(self.apagar_no_banco)
+        for i in range(0, len(hashes), _IN_CHUNK):
+            sess.execute(delete(ContratoLog).where(ContratoLog.mov_hash.in_(hashes[i:i + _IN_CHUNK])))
+        self.apagar_no_banco = set()
+        if self.rows:
+            sess.execute(_STMT_INSERT_LOG, self.rows)
+            self.rows = []
 
 def _filter_model_kwargs(model, data: Dict[str, Any]) -> Dict[str, Any]:
-    try:
-        colnames = {attr.key for attr in sa_inspect(model).mapper.column_attrs}
-    except Exception:
-        colnames = set()
+    colnames = _model_cols(model)
     return {k: v for k, v in data.items() if k in colnames}
 
 def _ensure_min_fields(model, data: Dict[str, Any], minimo: Dict[str, Any]) -> Dict[str, Any]:
-    try:
-        colnames = {attr.key for attr in sa_inspect(model).mapper.column_attrs}
-    except Exception:
-        colnames = set()
+    colnames = _model_cols(model)
     for k, v in minimo.items():
         if k in colnames and k not in data:
             data[k] = v
@@ -418,98 +768,265 @@ def _ensure_min_fields(model, data: Dict[str, Any], minimo: Dict[str, Any]) -> D
 def _pre_delete_envio(sess: Session, ativo: str) -> int:
     if not ativo:
         return 0
-    q = sess.query(Contrato).filter(Contrato.ativo == ativo)
-    count = q.count()
-    if count:
-        q.delete(synchronize_session=False)
-    return count
+    res = sess.execute(
+        delete(Contrato).where(Contrato.ativo == ativo).execution_options(synchronize_session=False)
+    )
+    return res.rowcount or 0
 
-def _envio(
-    sess: Session,
+def _ativos_com_contrato(sess: Session, ativos) -> set:
+    """Quais ativos já têm alguma linha em Contrato (qualquer status), em blocos IN."""
+    ativos = [a for a in ativos if a]
+    found: set = set()
+    for i in range(0, len(ativos), _IN_CHUNK):
+        found.update(sess.scalars(select(Contrato.ativo).where(Contrato.ativo.in_(ativos[i:i + _IN_CHUNK])).distinct()))
+    return found
+
+def _envio_kwargs(
     row: Dict[str, Any],
     cab: ContratoCabecalho,
     data_mov: datetime,
     mov_hash: str,
     *,
+    ativo: Optional[str] = None,
+    cod_cli: Optional[str] = None,
     override_data_envio: Optional[date] = None,
     data_troca: Optional[date] = None,
-) -> Contrato:
+    cab_cache: Optional[Dict[Any, _CabDerivados]] = None,
+) -> Dict[str, Any]:
+    """Valores do novo item (chaves = colunas de Contrato) — base de _envio e do INSERT em lote.
+    ativo/cod_cli explícitos têm precedência sobre os do payload."""
+    ativo = ativo or row["ativo"]
+    cod_cli = cod_cli or row.get("cod_cli")
     serial = _row_get_str(row, "serial") or None
 
-    # campos “textuais/meta” derivados do cabeçalho (se existirem no modelo do item)
-    derivados = _periodo_fields_from_cab(cab)
+    # campos “textuais/meta”, número do contrato e período do cabeçalho (cache por cab.id no lote)
+    derivados, contrato_num_cab, (ini, fim) = _derivados_cab(cab, cab_cache)
 
     # valor_mensal do arquivo
     valor_mensal_val = _row_get_valor_mensal(row)
 
     # tentar obter o número do contrato a ser gravado no item
-    contrato_num_str = _extract_contrato_num_from_row(row) or _extract_contrato_num_from_cab(cab)
+    contrato_num_str = _extract_contrato_num_from_row(row) or contrato_num_cab
 
+    data_envio = override_data_envio or data_mov.date()
     raw_kwargs = dict(
         cabecalho_id=cab.id,
-        ativo=row["ativo"],
+        ativo=ativo,
         serial=serial,
         cod_pro=row.get("cod_pro"),
         descricao_produto=row.get("descricao_produto"),
-        cod_cli=row.get("cod_cli"),
+        cod_cli=cod_cli,
         nome_cli=row.get("nome_cli"),
         valor_mensal=valor_mensal_val,
-        data_envio=(override_data_envio or data_mov.date()),
+        data_envio=data_envio,
         tp_transacao="ENVIO",
-        status="ATIVO" if hasattr(Contrato, "status") else None,
+        status="ATIVO" if _TEM_STATUS else None,
         mov_hash=mov_hash,
+        data_troca=data_troca if _TEM_DATA_TROCA else None,
         **derivados,
     )
-    raw_kwargs = {k: v for k, v in raw_kwargs.items() if v is not None}
-
-    if hasattr(Contrato, "data_troca") and data_troca is not None:
-        raw_kwargs["data_troca"] = data_troca
+    # uma passada: descarta None e o que não é coluna do item; depois os mínimos
+    cols = _CONTRATO_COLS
+    item_kwargs = {k: v for k, v in raw_kwargs.items() if v is not None and k in cols}
+    for k, v in (("cabecalho_id", cab.id), ("ativo", ativo), ("data_envio", data_envio)):
+        if k in cols:
+            item_kwargs.setdefault(k, v)
+
+    # Número do contrato e período “de/até” do cabeçalho, nos nomes existentes no item
+    if contrato_num_str and _ITEM_CONTRATO_NUM:
+        item_kwargs[_ITEM_CONTRATO_NUM[0]] = contrato_num_str
+    if ini and _ITEM_PERIODO_INI:
+        item_kwargs[_ITEM_PERIODO_INI] = ini
+    if fim and _ITEM_PERIODO_FIM:
+        item_kwargs[_ITEM_PERIODO_FIM] = fim
+    return item_kwargs
+
+# destinos de nº do contrato/período em _envio_kwargs; se algum não for coluna,
+# _envio aplica por setattr (como antes) e o INSERT em lote fica desligado
+_ENVIO_EXTRAS = _ITEM_CONTRATO_NUM[:1] + tuple(n for n in (_ITEM_PERIODO_INI, _ITEM_PERIODO_FIM) if n)
+_ENVIO_SO_COLUNAS = all(n in _CONTRATO_COLS for n in _ENVIO_EXTRAS)
 
-    item_kwargs = _filter_model_kwargs(Contrato, raw_kwargs)
-    item_kwargs = _ensure_min_fields(
-        Contrato,
-        item_kwargs,
-        minimo={"cabecalho_id": cab.id, "ativo": row["ativo"], "data_envio": (override_data_envio or data_mov.date())},
+def _envio(
+    sess: Session,
+    row: Dict[str, Any],
+    cab: ContratoCabecalho,
+    data_mov: datetime,
+    mov_hash: str,
+    *,
+    ativo: Optional[str] = None,
+    cod_cli: Optional[str] = None,
+    override_data_envio: Optional[date] = None,
+    data_troca: Optional[date] = None,
+    cab_cache: Optional[Dict[Any, _CabDerivados]] = None,
+) -> Contrato:
+    item_kwargs = _envio_kwargs(
+        row, cab, data_mov, mov_hash,
+        ativo=ativo, cod_cli=cod_cli,
+        override_data_envio=override_data_envio, data_troca=data_troca, cab_cache=cab_cache,
     )
-
+    extras = {n: item_kwargs.pop(n) for n in _ENVIO_EXTRAS if n not in _CONTRATO_COLS and n in item_kwargs}
     item = Contrato(**item_kwargs)
+    for name, value in extras.items():
+        setattr(item, name, value)
 
-    # Número do contrato gravado diretamente no item (quando o modelo tiver a coluna)
-    _apply_contrato_num_on_item(item, contrato_num_str)
-
-    # Período “de/até” (datas) copiado do cabeçalho, se os campos existirem no item
-    ini, fim = _get_periodo_from_cab(cab)
-    _set_periodo_on_item(item, ini, fim)
-
+    # sem flush: o begin_nested da linha grava na saída (id disponível a partir daí)
     sess.add(item)
-    sess.flush()
     return item
 
-def _retorno(sess: Session, row: Dict[str, Any], cab: ContratoCabecalho, data_mov: datetime, mov_hash: str) -> Contrato:
-    aberto = _find_item_aberto(sess, cab.id, row.get("cod_cli"), row["ativo"])
+def _colunas_obrigatorias(model) -> frozenset:
+    """NOT NULL sem default nem PK — sem elas o INSERT falharia."""
+    try:
+        return frozenset(
+            attr.key
+            for attr in sa_inspect(model).mapper.column_attrs
+            for col in attr.columns[:1]
+            if not col.nullable and not col.primary_key and col.default is None and col.server_default is None
+        )
+    except Exception:
+        return frozenset()
+
+_CONTRATO_OBRIGATORIAS = _colunas_obrigatorias(Contrato)
+
+class _EnviosPendentes:
+    """Novos itens de ENVIO (kwargs de _envio_kwargs) para um INSERT em lote. Só entram
+    itens que ninguém mais no lote vai procurar/alterar; mesmo ciclo commit/rollback
+    de _LogsPendentes."""
+
+    def __init__(self):
+        # (item do lote, mov_hash, cab.id, kwargs do Contrato)
+        self.rows: List[Tuple[MovimentacaoItem, str, int, Dict[str, Any]]] = []
+        self._linha: List[Tuple[MovimentacaoItem, str, int, Dict[str, Any]]] = []
+
+    @staticmethod
+    def aceita(item_kwargs: Dict[str, Any]) -> bool:
+        return _ENVIO_SO_COLUNAS and _CONTRATO_OBRIGATORIAS.issubset(item_kwargs)
+
+    def add(self, it: MovimentacaoItem, mov_hash: str, cab_id: int, item_kwargs: Dict[str, Any]) -> None:
+        self._linha.append((it, mov_hash, cab_id, item_kwargs))
+
+    def commit(self) -> None:
+        self.rows.extend(self._linha)
+        self._linha = []
+
+    def rollback(self) -> None:
+        self._linha = []
+
+    def flush(
+        self, sess: Session
+    ) -> Tuple[List[int], List[Tuple[MovimentacaoItem, str, BaseException]]]:
+        """Grava tudo; devolve (cab.id das linhas gravadas, [(item do lote, mov_hash, erro)]
+        das linhas que falharam)."""
+        rows, self.rows = self.rows, []
+        if not rows:
+            return [], []
+        try:
+            with sess.begin_nested():
+                sess.execute(insert(Contrato), [kw for _, _, _, kw in rows])
+            return [cab_id for _, _, cab_id, _ in rows], []
+        except SQLAlchemyError:
+            pass
+        gravados, falhas = [], []
+        for it, mov_hash, cab_id, kw in rows:
+            try:
+                with sess.begin_nested():
+                    sess.execute(insert(Contrato), [kw])
+                gravados.append(cab_id)
+            except SQLAlchemyError as e:
+                falhas.append((it, mov_hash, e))
+        return gravados, falhas
+
+def _retorno(
+    sess: Session,
+    row: Dict[str, Any],
+    cab: ContratoCabecalho,
+    data_mov: datetime,
+    mov_hash: str,
+    abertos: Optional[_ItensAbertos] = None,
+    *,
+    ativo: Optional[str] = None,
+    cod_cli: Optional[str] = None,
+) -> Contrato:
+    ativo = ativo or row["ativo"]
+    cod_cli = cod_cli or row.get("cod_cli")
+    if abertos is not None:
+        aberto = abertos.find(cab.id, cod_cli, ativo)
+    else:
+        aberto = _find_item_aberto(sess, cab.id, cod_cli, ativo)
     if not aberto:
-        raise ValueError(f"RETORNO sem item ATIVO para '{row['ativo']}'.")
-    if hasattr(aberto, "status"):
+        raise ValueError(f"RETORNO sem item ATIVO para '{ativo}'.")
+    if _TEM_STATUS:
         aberto.status = "RETORNADO"
-    if hasattr(aberto, "data_retorno"):
+    if _TEM_DATA_RETORNO:
         aberto.data_retorno = data_mov.date()
-    if hasattr(aberto, "tp_transacao"):
+    if _TEM_TP_TRANSACAO:
         aberto.tp_transacao = "RETORNO"
-    if hasattr(aberto, "mov_hash"):
+    if _TEM_MOV_HASH:
         aberto.mov_hash = mov_hash
     sess.add(aberto)
-    sess.flush()
+    if abertos is not None:
+        abertos.close(aberto)
     return aberto
 
 # ----------------------- leitura canônica row ----------------------
 
-def _canon(row: Dict[str, Any]) -> Dict[str, Any]:
-    contrato_num = row.get("contrato_num_norm") or _row_get_str(row, "contrato_num", "contraton", "contrato", "numero_contrato", "num_contrato", "n_contrato")
-    cod_cli = row.get("cod_cli_norm") or _row_get_str(row, "cod_cli", "cliente", "cod_cliente")
-    ativo = row.get("ativo_norm") or _row_get_str(row, "ativo", "patrimonio", "equipamento", "serial")
-    data_raw = row.get("data_mov_iso") or _row_get_str(row, "data_mov", "data", "data_movimento")
-    data_mov = parse_data_mov(data_raw)
-    return {"contrato_num": contrato_num, "cod_cli": cod_cli, "ativo": ativo, "data_mov": data_mov}
+def _canonize_row(row: Dict[str, Any]) -> Dict[str, Any]:
+    """Chaves alternativas do payload resolvidas uma vez por linha (só texto, sem parse).
+    As famílias da TROCA mantêm as listas de chaves próprias que já usavam."""
+    return {
+        "tp": _tp(row),
+        "tp_troca": _tipo_troca(row),
+        "contrato_num": row.get("contrato_num_norm") or _row_get_str(row, "contrato_num", "contraton", "contrato", "numero_contrato", "num_contrato", "n_contrato"),
+        "cod_cli": row.get("cod_cli_norm") or _row_get_str(row, "cod_cli", "cliente", "cod_cliente"),
+        "cod_cli_raw": _row_get_str(row, "cod_cli", "cliente", "cod_cliente"),
+        "ativo": row.get("ativo_norm") or _row_get_str(row, "ativo", "patrimonio", "equipamento", "serial"),
+        "data_raw": row.get("data_mov_iso") or _row_get_str(row, "data_mov", "data", "data_movimento"),
+        "os": _os_key(row),
+        "troca_contrato_num": _row_get_str(row, "contrato_num_norm", "contrato_num", "contraton", "contrato"),
+        "troca_cod_cli": _row_get_str(row, "cod_cli_norm", "cod_cli", "cliente", "cod_cliente"),
+        "troca_ativo_envio": row.get("ativo_novo_resolvido") or _row_get_str(row, "ativo", "patrimonio", "equipamento", "serial", "ativo_norm"),
+        "troca_ativo_retorno": row.get("ativo_antigo_resolvido") or _row_get_str(row, "ativo", "patrimonio", "equipamento", "serial", "ativo_norm"),
+    }
+
+def _canon(row: Dict[str, Any], cr: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    if cr is None:
+        cr = _canonize_row(row)
+    data_mov = _parse_data_mov(cr["data_raw"])
+    return {
+        "contrato_num": cr["contrato_num"],
+        "cod_cli": cr["cod_cli"],
+        "ativo": cr["ativo"],
+        "data_mov": data_mov,
+        "data_iso": data_mov.date().isoformat(),
+    }
+
+def _troca_campos(
+    envio_row: Dict[str, Any],
+    retorno_row: Dict[str, Any],
+    env_c: Optional[Dict[str, Any]] = None,
+    ret_c: Optional[Dict[str, Any]] = None,
+) -> Tuple[str, str, datetime]:
+    """(ativo_envio, ativo_retorno, data_mov) de um par de TROCA."""
+    if env_c is None:
+        env_c = _canonize_row(envio_row)
+    if ret_c is None:
+        ret_c = _canonize_row(retorno_row)
+    ativo_envio = env_c["troca_ativo_envio"]
+    ativo_retorno = ret_c["troca_ativo_retorno"]
+    if not ativo_envio or not ativo_retorno:
+        raise ValueError("TROCA: cada linha deve trazer o 'ativo' correspondente (ENVIO/RETORNO).")
+
+    data_mov = _parse_data_mov(ret_c["data_raw"] or env_c["data_raw"])
+    return ativo_envio, ativo_retorno, data_mov
+
+_STMT_MOV_HASHES = select(ContratoLog.mov_hash).where(ContratoLog.mov_hash.in_(bindparam("hashes", expanding=True)))
+
+def _existing_mov_hashes(sess: Session, hashes) -> set:
+    """Quais dos hashes já têm ContratoLog — um SELECT IN por bloco."""
+    hashes = list(hashes)
+    found: set = set()
+    for i in range(0, len(hashes), _IN_CHUNK):
+        found.update(sess.scalars(_STMT_MOV_HASHES, {"hashes": hashes[i:i + _IN_CHUNK]}))
+    return found
 
 def _fmt_exc(e: BaseException) -> str:
     msg = f"{e.__class__.__name__}: {e}"
@@ -523,7 +1040,18 @@ def _fmt_exc(e: BaseException) -> str:
 
 # ----------------------------- lote -------------------------------
 
+# liberado no commit/rollback da transação do chamador
+_LOCK_APLICAR_LOTE = text("SELECT pg_advisory_xact_lock(hashtext('app-contratos:aplicar_lote'))")
+
+def _lock_aplicacao(sess: Session) -> None:
+    """Serializa aplicar_lote entre processos (Postgres). O lote é aplicado sobre dados
+    pré-carregados; no SQLite a escrita já é exclusiva por banco."""
+    bind = sess.get_bind()
+    if bind is not None and bind.dialect.name == "postgresql":
+        sess.execute(_LOCK_APLICAR_LOTE)
+
 def aplicar_lote(sess: Session, lote_id: int) -> Dict[str, Any]:
+    _lock_aplicacao(sess)
     lote: MovimentacaoLote | None = sess.get(MovimentacaoLote, lote_id)
     if not lote:
         raise ValueError(f"Lote {lote_id} não encontrado.")
@@ -538,24 +1066,29 @@ def aplicar_lote(sess: Session, lote_id: int) -> Dict[str, Any]:
 
     ok = 0
     erros = 0
-    contratos_afetados: set[int] = set()
+    # cab.id afetados (dict como conjunto); devolvidos ordenados no fim
+    contratos_afetados: Dict[int, None] = {}
 
     # separar trocas (parear por OS) e unitários
     trocas: Dict[tuple[str, str, str], Dict[str, MovimentacaoItem]] = {}
     unitarios: List[MovimentacaoItem] = []
 
+    # payload de cada linha canonizado uma vez (por id do item)
+    canon_rows: Dict[int, Dict[str, Any]] = {}
+
     for it in itens:
         row = it.payload or {}
-        tp = _tp(row)
+        cr = canon_rows[id(it)] = _canonize_row(row)
+        tp = cr["tp"]
         if tp == "TROCA":
-            subtipo = _tipo_troca(row)
+            subtipo = cr["tp_troca"]
             if subtipo not in ("ENVIO", "RETORNO"):
                 it.erro_msg = "TROCA: 'Tipo de Movimento Troca' inválido (ENVIO/RETORNO)."
                 erros += 1
                 continue
-            contrato_num = _row_get_str(row, "contrato_num_norm", "contrato_num", "contraton", "contrato")
-            cod_cli = _row_get_str(row, "cod_cli_norm", "cod_cli", "cliente", "cod_cliente")
-            oskey = _os_key(row)
+            contrato_num = cr["troca_contrato_num"]
+            cod_cli = cr["troca_cod_cli"]
+            oskey = cr["os"]
             if not contrato_num or not oskey:
                 it.erro_msg = "TROCA: faltam contrato/OS."
                 erros += 1
@@ -570,48 +1103,141 @@ def aplicar_lote(sess: Session, lote_id: int) -> Dict[str, Any]:
         else:
             unitarios.append(it)
 
-    # 1) unitários (ENVIO / RETORNO)
+    # cabeçalhos de todo o lote numa consulta só (antes, 1–2 SELECTs por linha)
+    cab_keys = set()
+    for it in unitarios:
+        cr = canon_rows[id(it)]
+        contrato_num, cod_cli = cr["contrato_num"], cr["cod_cli"]
+        if contrato_num:
+            cab_keys.add(_cab_cache_key(contrato_num, cod_cli or None))
+    for contrato_num, cod_cli, _oskey in trocas:
+        cab_keys.add(_cab_cache_key(contrato_num, cod_cli or None))
+    cab_ids = _prefetch_cabecalhos(sess, cab_keys)
+
+    # unitários preparados uma vez (tp, campos canônicos, mov_hash), fora de savepoint;
+    # linha inválida guarda a exceção e vira erro no loop sem tocar o banco.
+    # Idempotência vira checagem em memória.
+    preparados: Dict[int, Any] = {}
+    validos: List[int] = []
+    campos_hash: List[tuple] = []  # -> make_mov_hashes, unitários e depois trocas
+    ativos_lote: set = set()
+    ocorrencias: Dict[str, int] = {}  # quantas linhas do lote mexem em cada ativo
     for it in unitarios:
         row = it.payload or {}
         try:
-            with sess.begin_nested():
-                tp = _tp(row)
-                c = _canon(row)
-                contrato_num, cod_cli, ativo, data_mov = c["contrato_num"], c["cod_cli"], c["ativo"], c["data_mov"]
-                if not tp or not contrato_num or not ativo:
-                    raise ValueError("Campos obrigatórios: tp_transacao, contrato_num, ativo (cod_cli opcional).")
+            tp = canon_rows[id(it)]["tp"]
+            c = _canon(row, canon_rows[id(it)])
+            if not tp or not c["contrato_num"] or not c["ativo"]:
+                raise ValueError("Campos obrigatórios: tp_transacao, contrato_num, ativo (cod_cli opcional).")
+            if tp not in ("ENVIO", "RETORNO"):
+                raise ValueError(f"tp_transacao inválido: {tp}")
+        except Exception as e:
+            preparados[id(it)] = e
+            continue
+        ativos_lote.add(c["ativo"])
+        ocorrencias[c["ativo"]] = ocorrencias.get(c["ativo"], 0) + 1
+        preparados[id(it)] = (tp, c)
+        validos.append(id(it))
+        campos_hash.append((c["contrato_num"], c["cod_cli"], tp, c["ativo"], c["data_iso"], ""))
+    chaves_troca: List[tuple] = []
+    for (contrato_num, cod_cli, oskey), sides in trocas.items():
+        if "ENVIO" not in sides or "RETORNO" not in sides:
+            continue
+        try:
+            ativo_envio, ativo_retorno, data_mov = _troca_campos(
+                sides["ENVIO"].payload or {}, sides["RETORNO"].payload or {},
+                canon_rows[id(sides["ENVIO"])], canon_rows[id(sides["RETORNO"])],
+            )
+        except Exception:
+            continue
+        ativos_lote.update((ativo_envio, ativo_retorno))
+        for a in (ativo_envio, ativo_retorno):
+            ocorrencias[a] = ocorrencias.get(a, 0) + 1
+        data_iso = data_mov.date().isoformat()
+        chaves_troca.append((contrato_num, cod_cli, oskey))
+        campos_hash.append((contrato_num, cod_cli, "TROCA-RETORNO", ativo_retorno, data_iso, oskey))
+        campos_hash.append((contrato_num, cod_cli, "TROCA-ENVIO", ativo_envio, data_iso, oskey))
+
+    hashes = make_mov_hashes(campos_hash)
+    for k, h in zip(validos, hashes):
+        preparados[k] = (*preparados[k], h)
+    hs_troca = hashes[len(validos):]
+    hash_troca: Dict[tuple, Tuple[str, str]] = {
+        chave: (hs_troca[2 * i], hs_troca[2 * i + 1]) for i, chave in enumerate(chaves_troca)
+    }
+    # mantido em sincronia com o banco: só recebe hashes de linhas cujo savepoint foi confirmado
+    hashes_existentes = _existing_mov_hashes(sess, set(hashes))
+
+    # itens ATIVO de todos os ativos do lote: uma consulta IN, depois só memória
+    abertos = _ItensAbertos(sess)
+    abertos.prefetch(ativos_lote)
+    logs = _LogsPendentes()
+
+    # ativos sem nenhuma linha em Contrato: o DELETE prévio do ENVIO é dispensado.
+    # Sai do conjunto ao primeiro ENVIO (mesmo se o savepoint falhar — no pior caso, um DELETE a mais).
+    sem_contrato = ativos_lote - _ativos_com_contrato(sess, ativos_lote)
+    cab_cache: Dict[Any, _CabDerivados] = {}
+    envios = _EnviosPendentes()
 
-                cab = _require_cabecalho(sess, contrato_num, cod_cli or None)
-                data_iso = data_mov.date().isoformat()
-                mov_hash = make_mov_hash(contrato_num, cod_cli, tp, ativo, data_iso, "")
+    # 1) unitários (ENVIO / RETORNO)
+    for it in unitarios:
+        row = it.payload or {}
+        prep = preparados[id(it)]
+        if isinstance(prep, BaseException):
+            it.erro_msg = _fmt_exc(prep)
+            erros += 1
+            continue
+        tp, c, mov_hash = prep
+        contrato_num, cod_cli, ativo, data_mov = c["contrato_num"], c["cod_cli"], c["ativo"], c["data_mov"]
 
-                # idempotência por hash — mas reprocessa quando necessário
-                dup = sess.execute(select(ContratoLog.id).where(ContratoLog.mov_hash == mov_hash)).first()
+        # idempotência por hash (conjunto pré-carregado) — mas reprocessa quando necessário.
+        # O duplicado que fica como está não toca o banco: decidido aqui, sem savepoint.
+        dup = mov_hash in hashes_existentes
+        if dup:
+            try:
+                cab = _require_cabecalho(sess, contrato_num, cod_cli or None, cab_ids)
+            except ValueError as e:
+                it.erro_msg = _fmt_exc(e)
+                erros += 1
+                continue
+            tem_aberto = abertos.find(cab.id, cod_cli, ativo) is not None
+            # ENVIO: reaplica se NÃO existe item ATIVO para esse ativo (foi apagado ou fechado)
+            # RETORNO: reaplica se AINDA existe item ATIVO para esse ativo
+            precisa_reaplicar = (not tem_aberto) if tp == "ENVIO" else tem_aberto
+            if not precisa_reaplicar:
+                it.erro_msg = ""  # duplicado silencioso
+                ok += 1  # conta como ok/idempotente
+                continue
+
+        try:
+            with sess.begin_nested():
+                cab = _require_cabecalho(sess, contrato_num, cod_cli or None, cab_ids)
                 if dup:
-                    precisa_reaplicar = False
-                    if tp == "ENVIO":
-                        # Reaplica se NÃO existe item ATIVO para esse ativo (foi apagado ou fechado)
-                        precisa_reaplicar = (_find_item_aberto(sess, cab.id, cod_cli, ativo) is None)
-                    elif tp == "RETORNO":
-                        # Reaplica se AINDA existe item ATIVO para esse ativo
-                        precisa_reaplicar = (_find_item_aberto(sess, cab.id, cod_cli, ativo) is not None)
-
-                    if precisa_reaplicar:
-                        sess.execute(delete(ContratoLog).where(ContratoLog.mov_hash == mov_hash))
-                    else:
-                        it.erro_msg = ""  # duplicado silencioso
-                        ok += 1  # conta como ok/idempotente
-                        continue
+                    logs.apagar(mov_hash)
 
                 if tp == "ENVIO":
-                    _pre_delete_envio(sess, ativo)
-                    _envio(sess, {"cod_cli": cod_cli, "ativo": ativo, **row}, cab, data_mov, mov_hash)
+                    ativo_novo = ativo in sem_contrato
+                    if ativo_novo:
+                        sem_contrato.discard(ativo)
+                    else:
+                        _pre_delete_envio(sess, ativo)
+                    abertos.drop_ativo(ativo)
+                    item_kwargs = None
+                    adiado = False
+                    # ativo novo, única linha do lote: ninguém vai procurar o item -> INSERT em lote
+                    if ativo_novo and not dup and ocorrencias.get(ativo) == 1:
+                        item_kwargs = _envio_kwargs(row, cab, data_mov, mov_hash, ativo=ativo, cod_cli=cod_cli, cab_cache=cab_cache)
+                    if item_kwargs is not None and _EnviosPendentes.aceita(item_kwargs):
+                        envios.add(it, mov_hash, cab.id, item_kwargs)
+                        adiado = True
+                    else:
+                        abertos.add(_envio(sess, row, cab, data_mov, mov_hash, ativo=ativo, cod_cli=cod_cli, cab_cache=cab_cache))
                 elif tp == "RETORNO":
-                    _retorno(sess, {"cod_cli": cod_cli, "ativo": ativo, **row}, cab, data_mov, mov_hash)
+                    _retorno(sess, row, cab, data_mov, mov_hash, abertos, ativo=ativo, cod_cli=cod_cli)
                 else:
                     raise ValueError(f"tp_transacao inválido: {tp}")
 
-                sess.add(ContratoLog(
+                logs.add(
                     contrato_cabecalho_id=cab.id,
                     cod_cli=cod_cli,
                     ativo=ativo,
@@ -620,13 +1246,32 @@ def aplicar_lote(sess: Session, lote_id: int) -> Dict[str, Any]:
                     mov_hash=mov_hash,
                     status="OK",
                     mensagem="",
-                ))
-                sess.flush()
-                contratos_afetados.add(cab.id)
+                )
+                # ENVIO adiado: o cabeçalho só conta depois que o INSERT em lote gravar
+                if not (tp == "ENVIO" and adiado):
+                    contratos_afetados[cab.id] = None
+            hashes_existentes.add(mov_hash)
+            abertos.commit()
+            logs.commit()
+            envios.commit()
             ok += 1
         except (SQLAlchemyError, Exception) as e:
+            abertos.rollback()
+            logs.rollback()
+            envios.rollback()
             it.erro_msg = _fmt_exc(e)
             erros += 1
+    gravados, falhas = envios.flush(sess)
+    for cab_id in gravados:
+        contratos_afetados[cab_id] = None
+    for it, mov_hash, e in falhas:
+        # ativo sem linha prévia: desfazer é só tirar o log e o hash da linha
+        logs.descartar(mov_hash)
+        hashes_existentes.discard(mov_hash)
+        it.erro_msg = _fmt_exc(e)
+        ok -= 1
+        erros += 1
+    logs.flush(sess)
 
     # 2) trocas (pareadas por OS)
     for (contrato_num, cod_cli, oskey), sides in trocas.items():
@@ -645,37 +1290,32 @@ def aplicar_lote(sess: Session, lote_id: int) -> Dict[str, Any]:
                 envio_row = envio_it.payload or {}
                 retorno_row = retorno_it.payload or {}
 
-                ativo_envio = envio_row.get("ativo_novo_resolvido") or _row_get_str(envio_row, "ativo", "patrimonio", "equipamento", "serial", "ativo_norm")
-                ativo_retorno = retorno_row.get("ativo_antigo_resolvido") or _row_get_str(retorno_row, "ativo", "patrimonio", "equipamento", "serial", "ativo_norm")
-                if not ativo_envio or not ativo_retorno:
-                    raise ValueError("TROCA: cada linha deve trazer o 'ativo' correspondente (ENVIO/RETORNO).")
-
-                data_mov = parse_data_mov(
-                    retorno_row.get("data_mov_iso")
-                    or _row_get_str(retorno_row, "data_mov", "data", "data_movimento")
-                    or envio_row.get("data_mov_iso")
-                    or _row_get_str(envio_row, "data_mov", "data", "data_movimento")
-                )
+                env_c, ret_c = canon_rows[id(envio_it)], canon_rows[id(retorno_it)]
+                ativo_envio, ativo_retorno, data_mov = _troca_campos(envio_row, retorno_row, env_c, ret_c)
+                cli_ret = cod_cli or ret_c["cod_cli_raw"]
+                cli_env = cod_cli or env_c["cod_cli_raw"]
 
-                cab = _require_cabecalho(sess, contrato_num, cod_cli or None)
+                cab = _require_cabecalho(sess, contrato_num, cod_cli or None, cab_ids)
                 data_iso = data_mov.date().isoformat()
 
                 # Captura a data_envio do item que vai retornar (antes de fechar), para herdar no ENVIO
-                aberto_ret_pre = _find_item_aberto(sess, cab.id, (cod_cli or _row_get_str(retorno_row, "cod_cli", "cliente", "cod_cliente")), ativo_retorno)
+                aberto_ret_pre = abertos.find(cab.id, cli_ret, ativo_retorno)
                 data_envio_herdada = getattr(aberto_ret_pre, "data_envio", None) if aberto_ret_pre is not None else None
 
-                h_ret = make_mov_hash(contrato_num, cod_cli, "TROCA-RETORNO", ativo_retorno, data_iso, oskey)
-                h_env = make_mov_hash(contrato_num, cod_cli, "TROCA-ENVIO", ativo_envio, data_iso, oskey)
+                h_ret, h_env = hash_troca.get((contrato_num, cod_cli, oskey)) or (
+                    make_mov_hash(contrato_num, cod_cli, "TROCA-RETORNO", ativo_retorno, data_iso, oskey),
+                    make_mov_hash(contrato_num, cod_cli, "TROCA-ENVIO", ativo_envio, data_iso, oskey),
+                )
 
                 # RETORNO - reprocessa se ainda houver item ativo
-                dup_ret = sess.execute(select(ContratoLog.id).where(ContratoLog.mov_hash == h_ret)).first()
-                ainda_ativo_ret = _find_item_aberto(sess, cab.id, (cod_cli or _row_get_str(retorno_row, "cod_cli", "cliente", "cod_cliente")), ativo_retorno) is not None
+                dup_ret = h_ret in hashes_existentes
+                ainda_ativo_ret = abertos.find(cab.id, cli_ret, ativo_retorno) is not None
                 if dup_ret and ainda_ativo_ret:
-                    sess.execute(delete(ContratoLog).where(ContratoLog.mov_hash == h_ret))
+                    logs.apagar(h_ret)
 
                 if not dup_ret or ainda_ativo_ret:
-                    _retorno(sess, {"cod_cli": (cod_cli or _row_get_str(retorno_row, "cod_cli", "cliente", "cod_cliente")), "ativo": ativo_retorno, **retorno_row}, cab, data_mov, h_ret)
-                    sess.add(ContratoLog(
+                    _retorno(sess, retorno_row, cab, data_mov, h_ret, abertos, ativo=ativo_retorno, cod_cli=cli_ret)
+                    logs.add(
                         contrato_cabecalho_id=cab.id,
                         cod_cli=cod_cli,
                         ativo=ativo_retorno,
@@ -684,27 +1324,38 @@ def aplicar_lote(sess: Session, lote_id: int) -> Dict[str, Any]:
                         mov_hash=h_ret,
                         status="OK",
                         mensagem=f"OS {oskey}",
-                    ))
-                    sess.flush()
+                    )
 
                 # ENVIO - reprocessa se não houver item ativo
-                dup_env = sess.execute(select(ContratoLog.id).where(ContratoLog.mov_hash == h_env)).first()
-                ainda_ativo_env = _find_item_aberto(sess, cab.id, (cod_cli or _row_get_str(envio_row, "cod_cli", "cliente", "cod_cliente")), ativo_envio) is not None
+                dup_env = h_env in hashes_existentes
+                ainda_ativo_env = abertos.find(cab.id, cli_env, ativo_envio) is not None
                 if dup_env and not ainda_ativo_env:
-                    sess.execute(delete(ContratoLog).where(ContratoLog.mov_hash == h_env))
+                    logs.apagar(h_env)
 
                 if not dup_env or not ainda_ativo_env:
-                    _pre_delete_envio(sess, ativo_envio)
-                    _envio(
+                    if ativo_envio in sem_contrato:
+                        sem_contrato.discard(ativo_envio)
+                    else:
+                        # sem autoflush: o UPDATE pendente do RETORNO tem de ir antes do DELETE
+                        # Core (synchronize_session=False), senão bate numa linha já apagada
+                        # quando o ativo que sai e o que entra são o mesmo (StaleDataError)
+                        sess.flush()
+                        _pre_delete_envio(sess, ativo_envio)
+                    abertos.drop_ativo(ativo_envio)
+                    novo = _envio(
                         sess,
-                        {"cod_cli": (cod_cli or _row_get_str(envio_row, "cod_cli", "cliente", "cod_cliente")), "ativo": ativo_envio, **envio_row},
+                        envio_row,
                         cab,
                         data_mov,
                         h_env,
+                        ativo=ativo_envio,
+                        cod_cli=cli_env,
                         override_data_envio=data_envio_herdada,  # <- herda do que retornou
                         data_troca=data_mov.date(),            # <- marca data_troca
+                        cab_cache=cab_cache,
                     )
-                    sess.add(ContratoLog(
+                    abertos.add(novo)
+                    logs.add(
                         contrato_cabecalho_id=cab.id,
                         cod_cli=cod_cli,
                         ativo=ativo_envio,
@@ -713,17 +1364,22 @@ def aplicar_lote(sess: Session, lote_id: int) -> Dict[str, Any]:
                         mov_hash=h_env,
                         status="OK",
                         mensagem=f"OS {oskey}",
-                    ))
-                    sess.flush()
+                    )
 
-                contratos_afetados.add(cab.id)
+                contratos_afetados[cab.id] = None
                 ok += 2
+            hashes_existentes.update((h_ret, h_env))
+            abertos.commit()
+            logs.commit()
         except (SQLAlchemyError, Exception) as e:
+            abertos.rollback()
+            logs.rollback()
             if envio_it:
                 envio_it.erro_msg = _fmt_exc(e)
             if retorno_it:
                 retorno_it.erro_msg = _fmt_exc(e)
             erros += 1
+    logs.flush(sess)
 
     lote.status = "PROCESSADO_COM_ERROS" if erros else "PROCESSADO"
 
@@ -0,0 +1,24 @@
+# Versão: 0.1.0 (2026-10-16)
+import pytest
+from scripts.fixup_lote_importado import parse_money
+
+@pytest.mark.parametrize("raw, esperado", [
+    ("1.234,56", 1234.56),        # BR
+    ("1,234.56", 1234.56),        # US
+    ("1234.56", 1234.56),         # US sem milhar
+    ("1.234", 1234.0),            # ambíguo: milhar BR
+    ("R$ 1.234", 1234.0),
+    ("12.345", 12345.0),
+    ("1.234.567,89", 1234567.89),
+    ("0.125", 0.125),             # parte inteira 0: decimal
+    ("1.23", 1.23),
+    ("1e5", 100000.0),            # notação científica: não perde o expoente
+    ("1.5E+3", 1500.0),
+    ("1,5E+3", 1500.0),
+    ("R$ 1e5", None),             # científica com lixo: inválido
+    (10, 10.0),
+    (None, None),
+    ("", None),
+])
+def test_parse_money(raw, esperado):
+    assert parse_money(raw) == esperado
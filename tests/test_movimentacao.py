@@ -75,3 +75,124 @@ def test_idempotencia(db_session):
 
     logs = db_session.query(ContratoLog).filter_by(contrato_cabecalho_id=cab.id).all()
     assert any(l.status=="OK" for l in logs)
+
+def _mk_cab(db_session, num, cli):
+    cab = ContratoCabecalho(nome_cliente=f"CLI {cli}", cnpj="33.333.333/3333-33",
+                            contrato_num=num, cod_cli=cli, prazo_contratual=12,
+                            indice_reajuste="IPCA", vendedor="Rui")
+    db_session.add(cab); db_session.flush()
+    return cab
+
+def _envio_completo(num, cli, ativo, data_mov):
+    # todas as colunas NOT NULL do item: ENVIO de ativo novo vai para o INSERT em lote
+    return {"tp_transacao":"ENVIO","contrato_num":num,"cod_cli":cli,"ativo":ativo,"data_mov":data_mov,
+            "cod_pro":"P1","descricao_produto":"Produto","nome_cli":f"CLI {cli}"}
+
+def test_envio_em_lote_falha_nao_conta_cabecalho(db_session, monkeypatch):
+    from sqlalchemy.exc import IntegrityError
+    cab_a = _mk_cab(db_session, "C-4", "004")
+    cab_b = _mk_cab(db_session, "C-5", "005")
+    lote = MovimentacaoLote(status="PREVIEW"); db_session.add(lote); db_session.flush()
+    for i, p in enumerate([_envio_completo("C-4", "004", "F1", "2025-08-01"),
+                           _envio_completo("C-5", "005", "F2", "2025-08-01")], start=1):
+        db_session.add(MovimentacaoItem(lote_id=lote.id, linha_idx=i, payload=p, status="OK"))
+    db_session.commit()
+
+    # INSERT (em lote ou por linha) que contenha o ativo F1 falha no banco
+    execute = db_session.execute
+    def execute_falhando(stmt, params=None, *args, **kwargs):
+        if isinstance(params, list) and any(isinstance(p, dict) and p.get("ativo") == "F1" for p in params):
+            raise IntegrityError("INSERT contratos", params, Exception("falha forçada"))
+        return execute(stmt, params, *args, **kwargs)
+    monkeypatch.setattr(db_session, "execute", execute_falhando)
+
+    with db_session.begin():
+        r = aplicar_lote(db_session, lote.id)
+
+    assert r["ok"] == 1 and r["erros"] == 1
+    assert r["contratos_afetados"] == [cab_b.id]
+    assert [e["linha_idx"] for e in r["erros_detalhes"]] == [1]
+    assert db_session.query(Contrato).filter_by(ativo="F1").count() == 0
+    assert db_session.query(Contrato).filter_by(ativo="F2").count() == 1
+    assert db_session.query(ContratoLog).filter_by(ativo="F1").count() == 0
+
+def _aplicar(db_session, payloads):
+    lote = MovimentacaoLote(status="PREVIEW"); db_session.add(lote); db_session.flush()
+    for i, p in enumerate(payloads, start=1):
+        db_session.add(MovimentacaoItem(lote_id=lote.id, linha_idx=i, payload=p, status="OK"))
+    db_session.commit()
+    with db_session.begin():
+        r = aplicar_lote(db_session, lote.id)
+    return lote, r
+
+def test_tp_invalido_rejeitado_na_preparacao(db_session):
+    _mk_cab(db_session, "C-6", "006")
+    invalido = dict(_envio_completo("C-6", "006", "T2", "2025-08-01"), tp_transacao="XYZ")
+    _, r = _aplicar(db_session, [_envio_completo("C-6", "006", "T1", "2025-08-01"), invalido])
+
+    assert r["ok"] == 1 and r["erros"] == 1
+    assert [e["linha_idx"] for e in r["erros_detalhes"]] == [2]
+    assert "tp_transacao inválido: XYZ" in r["erros_detalhes"][0]["mensagem"]
+    assert db_session.query(Contrato).filter_by(ativo="T2").count() == 0
+    assert db_session.query(ContratoLog).filter_by(ativo="T2").count() == 0
+
+def test_reaplicar_duplicado_fica_como_esta(db_session):
+    _mk_cab(db_session, "C-7", "007")
+    lote, r1 = _aplicar(db_session, [_envio_completo("C-7", "007", "D1", "2025-08-01")])
+    with db_session.begin():
+        r2 = aplicar_lote(db_session, lote.id)
+
+    assert r1["ok"] == 1 and r2["ok"] == 1 and r2["erros"] == 0
+    assert r2["erros_detalhes"] == []
+    assert db_session.query(Contrato).filter_by(ativo="D1").count() == 1
+    assert db_session.query(ContratoLog).filter_by(ativo="D1").count() == 1
+
+def test_reaplicar_envio_apagado_e_reaplicado(db_session):
+    _mk_cab(db_session, "C-8", "008")
+    lote, _ = _aplicar(db_session, [_envio_completo("C-8", "008", "D2", "2025-08-01")])
+    db_session.query(Contrato).filter_by(ativo="D2").delete()
+    db_session.commit()
+
+    with db_session.begin():
+        r = aplicar_lote(db_session, lote.id)
+
+    assert r["ok"] == 1 and r["erros"] == 0
+    assert db_session.query(Contrato).filter_by(ativo="D2", status="ATIVO").count() == 1
+    # o log antigo do mesmo mov_hash é trocado, não duplicado
+    assert db_session.query(ContratoLog).filter_by(ativo="D2").count() == 1
+
+def test_contratos_afetados_ordenados(db_session):
+    cab_a = _mk_cab(db_session, "C-10", "010")
+    cab_b = _mk_cab(db_session, "C-11", "011")
+    # arquivo traz o cabeçalho de id maior primeiro
+    _, r = _aplicar(db_session, [_envio_completo("C-11", "011", "O1", "2025-08-01"),
+                                 _envio_completo("C-10", "010", "O2", "2025-08-01")])
+
+    assert r["contratos_afetados"] == sorted([cab_a.id, cab_b.id])
+
+def test_envio_usa_ativo_e_cliente_canonicos(db_session):
+    cab = _mk_cab(db_session, "C-12", "012")
+    p = dict(_envio_completo("C-12", " 12 ", "n1 bruto", "2025-08-01"), ativo_norm="N-1", cod_cli_norm="012")
+    _, r = _aplicar(db_session, [p])
+
+    assert r["ok"] == 1
+    item = db_session.query(Contrato).filter_by(cabecalho_id=cab.id).one()
+    assert item.ativo == "N-1"
+    assert item.cod_cli == "012"
+
+def test_troca_usa_ativo_resolvido(db_session):
+    cab = _mk_cab(db_session, "C-13", "013")
+    db_session.add(Contrato(cabecalho_id=cab.id, ativo="X2", cod_cli="013", nome_cli="CLI 013",
+                            cod_pro="P1", descricao_produto="Produto",
+                            data_envio=dt.date(2025,8,1), status="ATIVO"))
+    db_session.commit()
+    comum = {"tp_transacao":"TROCA","os":"OS-13","contrato_num":"C-13","cod_cli":"013","data_mov":"2025-08-05"}
+    retorno = dict(comum, tipo_troca="RETORNO", ativo="X2")
+    envio = dict(comum, tipo_troca="ENVIO", ativo="y2 bruto", ativo_novo_resolvido="Y2",
+                 cod_pro="P1", descricao_produto="Produto", nome_cli="CLI 013")
+    _, r = _aplicar(db_session, [retorno, envio])
+
+    assert r["ok"] == 2 and r["erros"] == 0
+    assert db_session.query(Contrato).filter_by(cabecalho_id=cab.id, ativo="X2").one().status == "RETORNADO"
+    assert db_session.query(Contrato).filter_by(cabecalho_id=cab.id, ativo="Y2").one().status == "ATIVO"
+    assert db_session.query(Contrato).filter_by(ativo="y2 bruto").count() == 0
@@ -1,4 +1,5 @@
- # auth_middleware.py v1.1.2 (2025-08-11)
+ # auth_middleware.py v1.1.3 (2026-10-16)
+# - Perf: exact whitelist is a frozenset; prefix check is a single str.startswith(tuple).
 # - Fixed: safe ASCII header to avoid copy/paste issues.
 # - Behavior: whitelist items ending with '/' are treated as prefixes (e.g., '/static/').
 # - No '/' in whitelist by default. Checks whitelist BEFORE touching session.
@@ -36,7 +37,7 @@ class AuthRequiredMiddleware(BaseHTTPMiddleware):
                 prefixes.append(w)
             else:
                 exact.append(w)
-        self.exact_whitelist = tuple(exact)
+        self.exact_whitelist = frozenset(exact)
         self.prefix_whitelist = tuple(prefixes)
 
     async def dispatch(self, request: Request, call_next):
@@ -62,12 +63,8 @@ class AuthRequiredMiddleware(BaseHTTPMiddleware):
         return self._unauthorized_response(request)
 
     def _is_whitelisted(self, path: str) -> bool:
-        if path in self.exact_whitelist:
-            return True
-        for p in self.prefix_whitelist:
-            if path.startswith(p):
-                return True
-        return False
+        # startswith(tuple) scans all prefixes in C (empty tuple -> False)
+        return path in self.exact_whitelist or path.startswith(self.prefix_whitelist)
 
     def _unauthorized_response(self, request: Request):
         accepts = (request.headers.get("accept") or "").lower()
@@ -1,6 +1,18 @@
 # utils/mov_utils.py
-# Versão: 1.1.0 (2025-08-14)
+# Versão: 1.2.0 (2026-10-16)
 # CHANGELOG:
+# - make_mov_hashes: hashes de um lote inteiro numa passada (mesmo valor de make_mov_hash
+#   para cada tupla), para o serviço calcular tudo antes do loop e checar num SELECT IN.
+# - parse_data_mov: 'YYYY-MM-DD' vai direto por datetime.fromisoformat; textos de data
+#   memorizados (lru_cache), já que planilhas repetem a mesma data em muitas linhas.
+# - try_parse_decimal_to_float: memorizado (lru_cache) e, depois da troca de separadores,
+#   números simples vão direto para float(); Decimal fica para os demais casos.
+# - make_mov_hashes: o prefixo 'contrato|cliente|tp|' é absorvido uma vez por grupo num
+#   sha256 e cada linha parte de uma cópia (.copy()); bytes e hash continuam os mesmos.
+# - normalize_text_basic: " ".join(s.split()) no lugar do regex \s+ (mesmo conjunto de
+#   espaços Unicode, mesmo resultado).
+#
+# 1.1.0 (2025-08-14):
 # - parse_data_mov: agora aceita objetos date/datetime, inteiros/floats (serial do Excel),
 #   e mais formatos de data (%Y/%m/%d, %d.%m.%Y), mantendo compatibilidade.
 # - norm_tp: mapeia abreviações e variações comuns (e.g., "env", "e", "ret", "r", "trc", "t")
@@ -11,11 +23,12 @@
 
 from __future__ import annotations
 
+from functools import lru_cache
 from hashlib import sha256
 from datetime import datetime, date, timedelta
 from decimal import Decimal, InvalidOperation
 import re
-from typing import Optional
+from typing import Iterable, List, Optional, Tuple
 
 
 # ---------- Datas ----------
@@ -50,8 +63,19 @@ def parse_data_mov(s: object) -> datetime:
     text = (s or "").strip()
     if not text:
         raise ValueError("data_mov inválida: ''")
+    return _parse_data_mov_text(text)
 
-    # Tenta detectar AAAA-MM-DD ou similares rapidamente
+
+@lru_cache(maxsize=1024)
+def _parse_data_mov_text(text: str) -> datetime:
+    # Caminho rápido: AAAA-MM-DD (preview/JSON/date_to_iso) sem strptime
+    if len(text) == 10 and text[4] == "-" and text[7] == "-":
+        try:
+            return datetime.fromisoformat(text)
+        except ValueError:
+            pass
+
+    # Demais formatos
     fmts = (
         "%Y-%m-%d",
         "%d/%m/%Y",
@@ -121,19 +145,50 @@ def make_mov_hash(
     Gera hash idempotente da movimentação.
     IMPORTANTE: Mantém a mesma concatenação e normalização já usadas anteriormente
     para não invalidar hashes existentes.
+    O algoritmo (sha256 hex, 64 chars) também faz parte do contrato: o valor fica gravado
+    em ContratoLog.mov_hash/Contrato.mov_hash e é conferido por igualdade (índice
+    ix_contratos_logs_mov_hash). Trocar por blake2b/xxhash exigiria recalcular o histórico;
+    o custo do sha256 numa string curta é irrelevante perto da consulta ao banco.
     """
     base = f"{(contrato_num or '').strip()}|{(cod_cli or '').strip()}|{norm_tp(tp)}|{(ativo or '').strip()}|{(ativo_novo or '').strip()}|{data_mov_iso}"
     return sha256(base.encode("utf-8")).hexdigest()
 
+def make_mov_hashes(campos: Iterable[Tuple[str, str, str, str, str, str]]) -> List[str]:
+    """
+    make_mov_hash para várias movimentações: cada tupla é
+    (contrato_num, cod_cli, tp, ativo, data_mov_iso, ativo_novo), na ordem da assinatura.
+    Mesma concatenação (hash idêntico ao de make_mov_hash), numa passada só; norm_tp
+    é resolvido uma vez por grafia distinta de tp, e o prefixo comum
+    'contrato|cliente|tp|' entra uma vez por grupo num sha256 que cada linha copia.
+    """
+    tps: dict = {}
+    prefixos: dict = {}
+    out: List[str] = []
+    for contrato_num, cod_cli, tp, ativo, data_mov_iso, ativo_novo in campos:
+        tp_n = tps.get(tp)
+        if tp_n is None:
+            tp_n = tps[tp] = norm_tp(tp)
+        chave = ((contrato_num or '').strip(), (cod_cli or '').strip(), tp_n)
+        h = prefixos.get(chave)
+        if h is None:
+            h = prefixos[chave] = sha256(f"{chave[0]}|{chave[1]}|{tp_n}|".encode("utf-8"))
+        h = h.copy()
+        h.update(f"{(ativo or '').strip()}|{(ativo_novo or '').strip()}|{data_mov_iso}".encode("utf-8"))
+        out.append(h.hexdigest())
+    return out
 
-# ---------- Utilidades (opcionais) ----------
 
-_ws_re = re.compile(r"\s+")
+# ---------- Utilidades (opcionais) ----------
 
 def normalize_text_basic(s: Optional[str]) -> str:
     """strip + colapso de espaços internos; útil para campos livres (não afeta hash)."""
-    return _ws_re.sub(" ", (s or "").strip())
+    # str.split() sem argumento usa o mesmo conjunto de espaços que \s em regex Unicode
+    return " ".join((s or "").split())
+
+# depois da troca de separadores: só dígitos ASCII, sinal e ponto decimal
+_DEC_SIMPLES_RE = re.compile(r"[+-]?\d+(?:\.\d*)?", re.ASCII)
 
+@lru_cache(maxsize=4096)
 def try_parse_decimal_to_float(s: Optional[str]) -> Optional[float]:
     """
     Converte strings monetárias como '1.234,56' ou '1,234.56' em float.
@@ -151,6 +206,9 @@ def try_parse_decimal_to_float(s: Optional[str]) -> Optional[float]:
     # 3) se só vírgula, troca por ponto
     elif "," in txt and "." not in txt:
         txt = txt.replace(",", ".")
+    # float() de decimal simples é o mesmo valor que float(Decimal(...)), sem o Decimal
+    if _DEC_SIMPLES_RE.fullmatch(txt):
+        return float(txt)
     try:
         return float(Decimal(txt))
     except (InvalidOperation, ValueError) as e:
@@ -1,6 +1,18 @@
 # utils/recalc.py
-# Versão: 2.0.0 (2025-08-14)
+# Versão: 2.1.0 (2026-10-16)
 # CHANGELOG:
+# - Contas de valor global/presente de todos os itens num laço só (_recalc_kernel):
+#   taxa mensal calculada uma vez por contrato; o valor presente sai do mesmo
+#   _calc_valor_presente_tm usado por calc_valor_presente (fórmula num lugar só).
+# - Itens gravados num UPDATE em lote por id (executemany), só os que mudaram, em vez de
+#   session.add + UPDATE por objeto no flush; os objetos carregados recebem os valores
+#   como já gravados (set_committed_value).
+# - ativos_abertos e valor_mensal_total somados sobre a lista de itens já carregada
+#   (sem consulta extra): enxergam alterações ainda não gravadas (autoflush=False).
+# - meses_restantes de todos os itens de uma vez (_meses_restantes_lote): date.today()
+#   lido uma vez por recálculo e a diferença em meses calculada uma vez por data distinta.
+#
+# 2.0.0 (2025-08-14):
 # - Unificação com utils/recalculo_contratos.py (sem quebrar fórmulas existentes).
 # - Novo orquestrador recalc_contrato(session, cabecalho_id) que:
 #   * carrega cabeçalho e itens,
@@ -19,9 +31,11 @@
 
 from __future__ import annotations
 from datetime import date
+from typing import Dict, List, Tuple
 
-from sqlalchemy import select
+from sqlalchemy import select, update
 from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
 
 from models import Contrato, ContratoCabecalho
 
@@ -30,11 +44,50 @@ from utils.recalculo_contratos import (  # noqa: F401
     calc_meses_restantes,
     calc_valor_global,
     calc_valor_presente,
+    _calc_valor_presente_tm,
+    _taxa_mensal,
+    _to_float,
 )
 
 def _safe_date(d) -> date | None:
     return d if isinstance(d, date) else None
 
+def _meses_restantes_lote(inicios: List[date], prazo: int, fim: date) -> List[int]:
+    """
+    calc_meses_restantes para vários inícios com o mesmo prazo e a mesma data final:
+    mesma conta de _diff_meses, feita uma vez por data de início distinta.
+    """
+    if prazo <= 0:
+        return [0] * len(inicios)
+    base = fim.year * 12 + fim.month
+    por_data: Dict[date, int] = {}
+    meses: List[int] = []
+    for ini in inicios:
+        n = por_data.get(ini)
+        if n is None:
+            passados = base - (ini.year * 12 + ini.month) - (fim.day < ini.day)
+            n = por_data[ini] = max(0, prazo - max(0, passados))
+        meses.append(n)
+    return meses
+
+def _recalc_kernel(
+    valores_mensais: List[float],
+    meses_restantes: List[int],
+    prazo: int,
+    taxa_mensal: float,
+) -> Tuple[List[float], List[float]]:
+    """
+    (valor_global, valor_presente) de cada item — a conta de calc_valor_global e
+    _calc_valor_presente_tm (a de calc_valor_presente), com a taxa já convertida
+    uma vez para o contrato.
+    """
+    vg: List[float] = []
+    vp: List[float] = []
+    for vm, n in zip(valores_mensais, meses_restantes):
+        vg.append(round(vm * prazo, 2))
+        vp.append(_calc_valor_presente_tm(vm, n, taxa_mensal))
+    return vg, vp
+
 def recalc_contrato(session: Session, cabecalho_id: int, hoje: date | None = None) -> dict:
     """
     Recalcula campos derivados de TODOS os itens de um contrato (cabecalho_id):
@@ -73,41 +126,46 @@ def recalc_contrato(session: Session, cabecalho_id: int, hoje: date | None = Non
         select(Contrato).where(Contrato.cabecalho_id == cabecalho_id)
     ).scalars().all()
 
-    valor_mensal_total = 0.0
-    ativos_abertos = 0
-
-    for it in itens:
-        # Meses restantes com base no início (data_envio) e no PRAZO do cabeçalho.
-        inicio = _safe_date(it.data_envio) or hoje
-        it.meses_restantes = calc_meses_restantes(
-            data_inicio=inicio,
-            periodo_contratual_meses=prazo
-        )
-
-        # Valor global do contrato (por item) = valor_mensal * prazo
-        it.valor_global_contrato = calc_valor_global(
-            valor_mensal=it.valor_mensal,
-            periodo_contratual_meses=prazo
-        )
-
-        # Valor presente (por item) descontando pela taxa mensal equivalente do índice anual
-        it.valor_presente_contrato = calc_valor_presente(
-            valor_mensal=it.valor_mensal,
-            meses_restantes=it.meses_restantes,
-            indice_reajuste_anual=indice_anual
+    # Meses restantes com base no início (data_envio) e no PRAZO do cabeçalho, contados
+    # até a data de hoje (como em calc_meses_restantes)
+    meses = _meses_restantes_lote(
+        [_safe_date(it.data_envio) or hoje for it in itens], prazo, date.today()
+    )
+    # Valor global (valor_mensal * prazo) e valor presente (descontado pela taxa mensal
+    # equivalente do índice anual) de todos os itens de uma vez
+    valores_globais, valores_presentes = _recalc_kernel(
+        [_to_float(it.valor_mensal) for it in itens], meses, prazo, _taxa_mensal(indice_anual)
+    )
+
+    campos = ("meses_restantes", "valor_global_contrato", "valor_presente_contrato")
+    alterados = []
+    for it, n, vg, vp in zip(itens, meses, valores_globais, valores_presentes):
+        if (it.meses_restantes, it.valor_global_contrato, it.valor_presente_contrato) != (n, vg, vp):
+            alterados.append((it, (n, vg, vp)))
+
+    if alterados:
+        # ORM bulk UPDATE por chave primária: um executemany para todos os itens
+        session.execute(
+            update(Contrato),
+            [{"id": it.id, **dict(zip(campos, valores))} for it, valores in alterados],
         )
+        for it, valores in alterados:
+            for campo, valor in zip(campos, valores):
+                set_committed_value(it, campo, valor)
 
+    # Itens ATIVOS e total mensal corrente (somatório apenas dos ATIVOS), sobre os itens
+    # carregados — um agregado SQL não veria mudanças de status/valor ainda não gravadas
+    ativos_abertos = 0
+    valor_mensal_total = 0.0
+    for it in itens:
         if it.status == "ATIVO":
             ativos_abertos += 1
-            # Total mensal corrente (somatório apenas dos itens ATIVOS)
             try:
                 vm = float(it.valor_mensal or 0.0)
             except Exception:
                 vm = 0.0
             valor_mensal_total += vm
 
-        session.add(it)
-
     return {
         "cabecalho_id": cabecalho_id,
         "itens": len(itens),
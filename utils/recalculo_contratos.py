@@ -1,10 +1,18 @@
 # utils/recalculo_contratos.py
 from datetime import date
+from functools import lru_cache
 from typing import Optional
 from decimal import Decimal
 
 def _to_float(value) -> float:
     """Converte int/float/Decimal/str (ex: '0,06', '6%', '6') em float; defaults p/ 0.0."""
+    # caminho rápido pelo tipo exato: float/Decimal (coluna do banco) e int são quase
+    # todas as chamadas; subclasses e demais tipos seguem a cadeia de isinstance abaixo
+    cls = type(value)
+    if cls is float:
+        return value
+    if cls is Decimal or cls is int:
+        return float(value)
     if value is None:
         return 0.0
     if isinstance(value, (int, float)):
@@ -12,23 +20,28 @@ def _to_float(value) -> float:
     if isinstance(value, Decimal):
         return float(value)
     if isinstance(value, str):
-        s = value.strip().replace('%', '').replace(' ', '')
-        s = s.replace(',', '.')  # aceita "0,06"
-        if not s:
-            return 0.0
-        try:
-            f = float(s)
-        except ValueError:
-            return 0.0
-        # Se vier "6" (6%), normaliza para 0.06
-        if f > 1.0:
-            f = f / 100.0
-        return f
+        return _str_to_float(value)
     try:
         return float(value)
     except Exception:
         return 0.0
 
+@lru_cache(maxsize=256)
+def _str_to_float(value: str) -> float:
+    # índices/valores em texto se repetem muito na carteira ("6%", "0,06"): memorizado
+    s = value.strip().replace('%', '').replace(' ', '')
+    s = s.replace(',', '.')  # aceita "0,06"
+    if not s:
+        return 0.0
+    try:
+        f = float(s)
+    except ValueError:
+        return 0.0
+    # Se vier "6" (6%), normaliza para 0.06
+    if f > 1.0:
+        f = f / 100.0
+    return f
+
 def _diff_meses(inicio: date, fim: date) -> int:
     if not inicio:
         return 0
@@ -65,7 +78,14 @@ def calc_valor_presente(valor_mensal, meses_restantes: int, indice_reajuste_anua
     n = int(meses_restantes or 0)
     if n <= 0 or vm <= 0:
         return 0.0
-    i = _taxa_mensal(indice_reajuste_anual)
+    return _calc_valor_presente_tm(vm, n, _taxa_mensal(indice_reajuste_anual))
+
+def _calc_valor_presente_tm(vm: float, n: int, taxa_mensal: float) -> float:
+    """calc_valor_presente com valor já em float e taxa mensal já convertida
+    (quem recalcula vários itens do mesmo contrato converte o índice uma vez)."""
+    if n <= 0 or vm <= 0:
+        return 0.0
+    i = taxa_mensal
     if i <= 0:
         return round(vm * n, 2)
     pv = vm * (1 - (1 + i) ** (-n)) / i
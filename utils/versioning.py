@@ -1,16 +1,19 @@
 """
 Módulo: Versionamento de Endpoints
-Versão: 1.0.0
-Data: 2025-08-11
+Versão: 1.1.0
+Data: 2026-10-16
 Autor: Leonardo Muller
 
 Fornece:
 - @version("x.y.z"): anexa a versão ao callable do endpoint via atributo __version__
 - set_version_header: dependência que lê a versão do endpoint e adiciona X-Endpoint-Version na resposta
+
+Novidades 1.1.0:
+- @version devolve o próprio endpoint (só marca __version__), sem wrapper: uma chamada
+  e um await a menos por requisição; set_version_header continua lendo o atributo.
 """
 
-from functools import wraps
-from typing import Callable, Any, Awaitable, Optional
+from typing import Callable, Any, Optional
 from fastapi import Request, Response
 
 def version(v: str) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
@@ -19,29 +22,10 @@ def version(v: str) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
     Ex.: @version("1.2.3")
     """
     def decorator(func: Callable[..., Any]) -> Callable[..., Any]:
+        # O atributo fica no próprio endpoint (sync ou async): a assinatura que o FastAPI
+        # inspeciona é a original e não há wrapper no caminho da requisição.
         setattr(func, "__version__", v)
-
-        # Não precisamos necessariamente wrappar, mas envolvemos
-        # para garantir que __wrapped__ exista (útil em introspecção).
-        @wraps(func)
-        async def async_wrapper(*args, **kwargs):
-            return await func(*args, **kwargs)  # type: ignore[misc]
-
-        # Se o endpoint original for síncrono, preserve também
-        if not hasattr(func, "__call__") or func.__name__ == "async_wrapper":
-            return async_wrapper
-
-        # Detecta se é coroutine; se não for, cria wrapper síncrono
-        import inspect
-        if inspect.iscoroutinefunction(func):
-            return async_wrapper  # type: ignore[return-value]
-
-        @wraps(func)
-        def sync_wrapper(*args, **kwargs):
-            return func(*args, **kwargs)
-        # Copia a versão para o wrapper
-        setattr(sync_wrapper, "__version__", v)
-        return sync_wrapper
+        return func
     return decorator
 
 async def set_version_header(request: Request, response: Response) -> None: